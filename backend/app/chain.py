@@ -1,11 +1,19 @@
 import logging
 from operator import itemgetter
-from typing import Optional, Sequence
+from typing import Literal, Optional, Sequence, Union
 
-from constants import DB_COLLECTION_NAME
-from core.config import Settings, get_api_settings
-from core.storage import get_pgvector_connection_str
-from embedding import get_embeddings_model
+from core.config import LLMSettings, RephraseSettings, Settings, get_api_settings
+from core.constants import DB_COLLECTION_NAME, SQL_RECORD_MANAGAR_NAMESPACE
+from core.context_packing import ContextPacker, get_token_counter
+from core.metrics import register_metrics
+from core.rephrase import HistoryAwareRetrieval
+from core.reranking import CrossEncoderReranker, get_cross_encoder_scorer
+from core.retrieval import AsyncPGVectorRetriever, HybridPGVectorRetriever
+from core.retrieval_cache import CachedRetriever, get_cached_retriever
+from core.startup import LazyRunnable, startup_timings
+from core.vector_index import get_vector_type
+from database import async_engine, engine
+from embedding import get_query_embeddings
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from langchain.chat_models import ChatOpenAI
@@ -14,14 +22,13 @@ from langchain.schema import Document
 from langchain.schema.language_model import BaseLanguageModel
 from langchain.schema.messages import AIMessage, HumanMessage
 from langchain.schema.output_parser import StrOutputParser
-from langchain.schema.retriever import BaseRetriever
 from langchain.schema.runnable import (
     Runnable,
     RunnableBranch,
+    RunnableConfig,
     RunnableLambda,
     RunnableMap,
 )
-from langchain.vectorstores.pgvector import PGVector
 from pydantic.v1 import BaseModel
 
 RESPONSE_TEMPLATE = """\
@@ -85,28 +92,89 @@ app.add_middleware(
 )
 
 
+class ChatFilters(BaseModel):
+    """Metadata the retrieved chunks must have, tagged at ingestion"""
+
+    source_type: Optional[Literal["arxiv", "github", "docs"]]
+    # owner/name of a GitHub repository
+    repo: Optional[str]
+    # Of the code, or the language code of a page, e.g. "python" or "en"
+    language: Optional[str]
+
+
 class ChatRequest(BaseModel):
     question: str
     chat_history: Optional[list[dict[str, str]]]
+    filters: Optional[ChatFilters]
 
     class Config:
         arbitrary_types_allowed = True
 
 
-def get_retriever(settings: Settings) -> BaseRetriever:
-    pg_connection_str = get_pgvector_connection_str(settings.pgvector)
-    embedding = get_embeddings_model(settings.embed.name)
-    vectorstore = PGVector(
+def get_retriever(
+    settings: Settings,
+) -> Union[AsyncPGVectorRetriever, CachedRetriever]:
+    embedding = get_query_embeddings(settings)
+    register_metrics("query_embeddings", lambda: embedding.stats)
+    retriever_args = dict(
+        embedding=embedding,
+        engine=engine,
+        async_engine=async_engine,
         collection_name=DB_COLLECTION_NAME,
-        connection_string=pg_connection_str,
-        embedding_function=embedding,
-        logger=logger,
+        record_manager_namespace=SQL_RECORD_MANAGAR_NAMESPACE,
+        k=settings.context.fetch_k,
+        vector_type=get_vector_type(settings.embed),
+        rescore_candidates=(
+            settings.embed.rescore_candidates
+            if settings.embed.binary_first_pass
+            else None
+        ),
+        filter_exact_max_rows=settings.vector_index.filter_exact_max_rows,
+        filter_max_scan_tuples=settings.vector_index.filter_max_scan_tuples,
     )
-    return vectorstore.as_retriever(search_kwargs=dict(k=6))
+    if settings.retrieval.mode == "hybrid":
+        retriever = HybridPGVectorRetriever(
+            text_search_config=settings.retrieval.text_search_config,
+            rrf_k=settings.retrieval.rrf_k,
+            **retriever_args,
+        )
+    else:
+        retriever = AsyncPGVectorRetriever(**retriever_args)
+    if not settings.retrieval_cache.enabled:
+        return retriever
+    cached_retriever = get_cached_retriever(retriever, settings.retrieval_cache)
+    register_metrics("retrieval_cache", lambda: cached_retriever.cache.stats)
+    return cached_retriever
+
+
+def get_context_packer(settings: Settings) -> ContextPacker:
+    context_packer = ContextPacker(
+        get_token_counter(settings.context.tokenizer, settings.context.chars_per_token),
+        min_span_tokens=settings.context.min_span_tokens,
+    )
+    register_metrics("context_packing", lambda: context_packer.stats)
+    return context_packer
+
+
+def get_reranker(settings: Settings) -> Optional[CrossEncoderReranker]:
+    if not settings.rerank.enabled:
+        return None
+    reranker = CrossEncoderReranker(
+        get_cross_encoder_scorer(settings.rerank.model, settings.rerank.max_length),
+        top_k=settings.rerank.top_k,
+        batch_size=settings.rerank.batch_size,
+        workers=settings.rerank.workers,
+        budget=settings.rerank.budget_ms / 1000,
+        cache_size=settings.rerank.cache_size,
+    )
+    register_metrics("reranking", lambda: reranker.stats)
+    return reranker
 
 
 def create_retriever_chain(
-    llm: BaseLanguageModel, retriever: BaseRetriever
+    llm: BaseLanguageModel,
+    retriever: Union[AsyncPGVectorRetriever, CachedRetriever],
+    rephrase: RephraseSettings,
 ) -> Runnable:
     CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(REPHRASE_TEMPLATE)
     condense_question_chain = (
@@ -114,7 +182,28 @@ def create_retriever_chain(
     ).with_config(
         run_name="CondenseQuestion",
     )
-    conversation_chain = condense_question_chain | retriever
+    history_aware_retrieval = HistoryAwareRetrieval(
+        condense_question_chain,
+        retriever,
+        mode=rephrase.mode,
+        cache_size=rephrase.cache_size,
+        speculation_threshold=rephrase.speculation_threshold,
+    )
+    register_metrics("rephrase", lambda: history_aware_retrieval.stats)
+    conversation_chain = RunnableLambda(
+        history_aware_retrieval.invoke, afunc=history_aware_retrieval.ainvoke
+    )
+
+    def retrieve(inputs: dict, config: RunnableConfig) -> list[Document]:
+        return retriever.with_filter(inputs["metadata_filter"]).invoke(
+            inputs["question"], config
+        )
+
+    async def aretrieve(inputs: dict, config: RunnableConfig) -> list[Document]:
+        return await retriever.with_filter(inputs["metadata_filter"]).ainvoke(
+            inputs["question"], config
+        )
+
     return RunnableBranch(
         (
             RunnableLambda(lambda x: bool(x.get("chat_history"))).with_config(
@@ -122,12 +211,9 @@ def create_retriever_chain(
             ),
             conversation_chain.with_config(run_name="RetrievalChainWithHistory"),
         ),
-        (
-            RunnableLambda(itemgetter("question")).with_config(
-                run_name="Itemgetter:question"
-            )
-            | retriever
-        ).with_config(run_name="RetrievalChainWithNoHistory"),
+        RunnableLambda(retrieve, afunc=aretrieve).with_config(
+            run_name="RetrievalChainWithNoHistory"
+        ),
     ).with_config(run_name="RouteDependingOnChatHistory")
 
 
@@ -139,6 +225,29 @@ def format_docs(docs: Sequence[Document]) -> str:
     return "\n".join(formatted_docs)
 
 
+def get_context_budget(
+    inputs: dict, llm_settings: LLMSettings, context_packer: ContextPacker
+) -> int:
+    """Tokens left for the context by the prompt and the answer."""
+    count_tokens = context_packer.count_tokens
+    prompt_tokens = (
+        count_tokens(RESPONSE_TEMPLATE)
+        + count_tokens(inputs["question"])
+        + sum(count_tokens(message.content) for message in inputs["chat_history"])
+    )
+    return llm_settings.context_window - llm_settings.num_output - prompt_tokens
+
+
+def get_metadata_filter(request: ChatRequest) -> Optional[dict[str, str]]:
+    filters = request.get("filters")
+    if filters is None:
+        return None
+    # langserve only unpacks the request itself into a dict
+    if isinstance(filters, BaseModel):
+        filters = filters.dict()
+    return {key: value for key, value in filters.items() if value is not None} or None
+
+
 def serialize_history(request: ChatRequest):
     chat_history = request["chat_history"] or []
     converted_chat_history = []
@@ -152,11 +261,45 @@ def serialize_history(request: ChatRequest):
 
 def create_chain(
     llm: BaseLanguageModel,
-    retriever: BaseRetriever,
+    retriever: Union[AsyncPGVectorRetriever, CachedRetriever],
+    rephrase: RephraseSettings,
+    context_packer: ContextPacker,
+    llm_settings: LLMSettings,
+    reranker: Optional[CrossEncoderReranker] = None,
 ) -> Runnable:
-    retriever_chain = create_retriever_chain(
-        llm,
-        retriever,
+    # Tokens format_docs adds to each document
+    span_overhead_tokens = context_packer.count_tokens(
+        format_docs([Document(page_content="")])
+    )
+
+    def pack_context(inputs: dict) -> list[Document]:
+        return context_packer.pack(
+            inputs["docs"],
+            get_context_budget(inputs, llm_settings, context_packer),
+            span_overhead_tokens,
+        )
+
+    def rerank(inputs: dict) -> dict:
+        return {**inputs, "docs": reranker.rerank(inputs["question"], inputs["docs"])}
+
+    async def arerank(inputs: dict) -> dict:
+        docs = await reranker.arerank(inputs["question"], inputs["docs"])
+        return {**inputs, "docs": docs}
+
+    retriever_chain = RunnableMap(
+        {
+            "docs": create_retriever_chain(llm, retriever, rephrase),
+            "question": itemgetter("question"),
+            "chat_history": itemgetter("chat_history"),
+        }
+    )
+    if reranker is not None:
+        retriever_chain |= RunnableLambda(rerank, afunc=arerank).with_config(
+            run_name="Rerank"
+        )
+    retriever_chain = (
+        retriever_chain
+        | RunnableLambda(pack_context).with_config(run_name="PackContext")
     ).with_config(run_name="FindDocs")
     _context = RunnableMap(
         {
@@ -184,23 +327,46 @@ def create_chain(
             "chat_history": RunnableLambda(serialize_history).with_config(
                 run_name="SerializeHistory"
             ),
+            "metadata_filter": RunnableLambda(get_metadata_filter).with_config(
+                run_name="GetMetadataFilter"
+            ),
         }
         | _context
         | response_synthesizer
     )
 
 
-llm = ChatOpenAI(
-    model="zephyr",
-    streaming=True,
-    temperature=0.1,
-    verbose=False,
-    api_key="sk-invalid-because-its-local",
-    base_url="http://0.0.0.0:8000/v1",
-)
-settings = get_api_settings()
-retriever = get_retriever(settings)
-answer_chain = create_chain(
-    llm,
-    retriever,
+def build_answer_chain(settings: Settings) -> Runnable:
+    with startup_timings.time("llm"):
+        llm = ChatOpenAI(
+            model="zephyr",
+            streaming=True,
+            temperature=0.1,
+            verbose=False,
+            api_key="sk-invalid-because-its-local",
+            base_url="http://0.0.0.0:8000/v1",
+        )
+    with startup_timings.time("retriever"):
+        retriever = get_retriever(settings)
+    with startup_timings.time("context_packer"):
+        context_packer = get_context_packer(settings)
+    with startup_timings.time("reranker"):
+        reranker = get_reranker(settings)
+    return create_chain(
+        llm,
+        retriever,
+        settings.rephrase,
+        context_packer,
+        settings.llm,
+        reranker,
+    )
+
+
+answer_chain = LazyRunnable(
+    lambda: build_answer_chain(get_api_settings()),
+    input_type=ChatRequest,
+    output_type=str,
+    name="answer_chain",
 )
+if get_api_settings().startup.chain_init == "import":
+    answer_chain.get()
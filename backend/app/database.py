@@ -1,12 +1,17 @@
-from config import get_api_settings
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import sessionmaker
-from sqlmodel import Session, create_engine
-from storage import get_pgvector_connection_str
+from core.config import get_api_settings
+from core.metrics import register_metrics
+from core.storage import get_async_engine, get_engine, get_pool_stats
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlmodel import Session
 
 settings = get_api_settings()
-pg_connection_str = get_pgvector_connection_str(settings.pgvector, as_async=False)
-engine = create_engine(pg_connection_str, echo=True)
+# Shared with the vector store and the retriever of the process
+engine = get_engine(settings)
+async_engine = get_async_engine(settings)
+async_session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+
+register_metrics("db_pool", lambda: get_pool_stats(engine))
+register_metrics("db_async_pool", lambda: get_pool_stats(async_engine))
 
 
 def get_session() -> Session:
@@ -15,8 +20,5 @@ def get_session() -> Session:
 
 
 async def get_async_session() -> AsyncSession:
-    async_session = sessionmaker(
-        bind=engine, class_=AsyncSession, expire_on_commit=False, autocommit=False
-    )
-    async with async_session() as session:
+    async with async_session_factory() as session:
         yield session
@@ -1,6 +1,6 @@
 import sqlalchemy as sa
 from sqlalchemy import Column, String
-from sqlalchemy.dialects.postgresql import ARRAY, JSON
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlmodel import Field, SQLModel
 
 
@@ -12,5 +12,5 @@ class Embedding(SQLModel, table=True):
     )
     embedding: list[str] = Field(default_factory=list, sa_column=Column(ARRAY(String)))
     document: str = Field(sa_column=sa.Column(sa.TEXT, nullable=False, unique=True))
-    cmetadata: dict[str, str] = Field(default_factory=dict, sa_column=Column(JSON))
+    cmetadata: dict[str, str] = Field(default_factory=dict, sa_column=Column(JSONB))
     custom_id: str = Field(sa_column=sa.Column(sa.TEXT, nullable=False))
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -10,3 +12,9 @@ class CMetaData(BaseModel):
 class SourceAndTitle(BaseModel):
     source: str
     title: str
+
+
+class SourceAndTitlePage(BaseModel):
+    items: list[SourceAndTitle]
+    # Pass as cursor to get the next page, None on the last page
+    next_cursor: Optional[str]
@@ -1,12 +1,92 @@
 """Main entrypoint for the app."""
 
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import sqlalchemy as sa
 from chain import ChatRequest, answer_chain
+from core.config import Settings, get_api_settings
+from core.constants import DB_COLLECTION_NAME
+from core.metadata_index import create_metadata_index
+from core.metrics import register_metrics
+from core.startup import startup_timings
+from core.storage import dispose_engines, get_pgvector_connection_str
+from core.text_search import create_text_search_index
+from core.vector_index import create_vector_index, validate_vector_index
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from langserve import add_routes
-from router import document_metadata
+from router import chat, document_metadata, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_vector_index(settings: Settings) -> None:
+    if not settings.vector_index.ensure_on_startup:
+        return
+    # Not the shared engine, index builds outlast its statement timeout
+    engine = sa.create_engine(get_pgvector_connection_str(settings.pgvector))
+    try:
+        binary_quantized = settings.embed.binary_first_pass
+        create_vector_index(
+            engine,
+            DB_COLLECTION_NAME,
+            settings.vector_index,
+            binary_quantized=binary_quantized,
+        )
+        for problem in validate_vector_index(
+            engine, DB_COLLECTION_NAME, settings.vector_index, binary_quantized
+        ):
+            logger.warning(problem)
+    finally:
+        engine.dispose()
+
+
+def ensure_metadata_index(settings: Settings) -> None:
+    engine = sa.create_engine(get_pgvector_connection_str(settings.pgvector))
+    try:
+        create_metadata_index(engine)
+    finally:
+        engine.dispose()
+
 
-app = FastAPI(title="QuerySphere Endpoints based on LangChain Server")
+def ensure_text_search_index(settings: Settings) -> None:
+    if settings.retrieval.mode != "hybrid":
+        return
+    engine = sa.create_engine(get_pgvector_connection_str(settings.pgvector))
+    try:
+        create_text_search_index(engine, settings.retrieval.text_search_config)
+    finally:
+        engine.dispose()
+
+
+def ensure_schema(settings: Settings) -> None:
+    # One after the other, they alter the same table
+    with startup_timings.time("schema"):
+        ensure_vector_index(settings)
+        ensure_metadata_index(settings)
+        ensure_text_search_index(settings)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    settings = get_api_settings()
+    with startup_timings.time("startup"):
+        steps = [asyncio.to_thread(ensure_schema, settings)]
+        # Loads the models while the schema is checked
+        if settings.startup.chain_init == "lifespan":
+            steps.append(answer_chain.aget())
+        await asyncio.gather(*steps)
+    logger.info(f"Startup timings in seconds: {startup_timings.stats}")
+    yield
+    await dispose_engines()
+
+
+app = FastAPI(
+    title="QuerySphere Endpoints based on LangChain Server", lifespan=lifespan
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -15,12 +95,15 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"],
 )
+register_metrics("startup", lambda: startup_timings.stats)
 
 
 add_routes(
     app, answer_chain, path="/chat", input_type=ChatRequest, config_keys=["metadata"]
 )
 app.include_router(document_metadata.router, prefix="/api/v1")
+app.include_router(metrics.router, prefix="/api/v1")
+app.include_router(chat.router, prefix="/api/v1")
 
 if __name__ == "__main__":
     import uvicorn
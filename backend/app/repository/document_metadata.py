@@ -1,9 +1,64 @@
-from database_model import Embedding
-from dto import CMetaData
-from sqlmodel import Session, select
+from typing import Optional
 
+import sqlalchemy as sa
+from core.document_sources import (
+    DOCUMENT_SOURCE_TABLE,
+    SOURCE_EXPRESSION,
+    TITLE_EXPRESSION,
+)
+from core.vector_index import COLLECTION_TABLE, EMBEDDING_TABLE
+from dto import SourceAndTitle
+from sqlmodel import Session
 
-def get_all_doc_metadata(session: Session) -> list[CMetaData]:
-    query = select(Embedding.cmetadata)
-    metadata = session.exec(query).fetchall()
-    return [CMetaData(**meta) for meta in metadata]
+
+def get_doc_sources_and_titles(
+    session: Session,
+    collection_name: str,
+    after: Optional[SourceAndTitle],
+    limit: int,
+    materialized: bool,
+) -> list[SourceAndTitle]:
+    """Distinct sources and titles of a collection, ordered, after the given one.
+
+    Reads the materialized sources table if enabled and already created by an
+    ingest, a primary key range scan. Otherwise reads the chunks of the
+    collection in the order of the sources and titles index of
+    `core.metadata_index`, up to the chunks of the last source of the page.
+    """
+    # Only created by the first ingest with materialized sources
+    if (
+        materialized
+        and session.execute(
+            sa.text("SELECT to_regclass(:name) IS NULL"),
+            {"name": DOCUMENT_SOURCE_TABLE},
+        ).scalar_one()
+    ):
+        materialized = False
+    if materialized:
+        source, title = "s.source", "s.title"
+        from_clause = f"{DOCUMENT_SOURCE_TABLE} s"
+        collection_id = "s.collection_id"
+    else:
+        source, title = SOURCE_EXPRESSION, TITLE_EXPRESSION
+        from_clause = f"{EMBEDDING_TABLE} e"
+        collection_id = "e.collection_id"
+
+    # A constant for the planner to scan the index of the collection only
+    where_clause = (
+        f"{collection_id} = "
+        f"(SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :collection_name)"
+    )
+    params = {"collection_name": collection_name, "limit": limit}
+    if after is not None:
+        where_clause += f" AND ({source}, {title}) > (:after_source, :after_title)"
+        params.update(after_source=after.source, after_title=after.title)
+
+    rows = session.execute(
+        sa.text(
+            f"SELECT DISTINCT {source} AS source, {title} AS title "
+            f"FROM {from_clause} WHERE {where_clause} "
+            "ORDER BY source, title LIMIT :limit"
+        ),
+        params,
+    )
+    return [SourceAndTitle(source=row.source, title=row.title) for row in rows]
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Optional
+from uuid import UUID
+
+from chain import ChatRequest, answer_chain
+from core.config import get_api_settings
+from fastapi import APIRouter, Body, HTTPException, status
+from fastapi.responses import StreamingResponse
+from langchain.callbacks.base import AsyncCallbackHandler
+from pydantic.v1 import ValidationError
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# The retrieval step of the chain, its output are the documents of the prompt
+SOURCES_STEP_NAME = "FindDocs"
+
+Event = tuple[str, str]
+
+
+class SourcesCallbackHandler(AsyncCallbackHandler):
+    """Puts the sources of the answer on the queue once they are retrieved."""
+
+    def __init__(self, put: Any) -> None:
+        self.put = put
+        self._run_id: Optional[UUID] = None
+
+    async def on_chain_start(
+        self, serialized: dict, inputs: Any, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        if self._run_id is None and kwargs.get("name") == SOURCES_STEP_NAME:
+            self._run_id = run_id
+
+    async def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id != self._run_id:
+            return
+        # Wrapped by the callback manager if not a dict
+        docs = outputs.get("output", outputs) if isinstance(outputs, dict) else outputs
+        sources = [
+            {"url": doc.metadata.get("source"), "title": doc.metadata.get("title")}
+            for doc in docs
+        ]
+        await self.put(("sources", json.dumps(sources)))
+
+
+async def _generate(
+    inputs: dict,
+    config: dict,
+    queue: "asyncio.Queue[Event]",
+    send_timeout: float,
+) -> None:
+    async def put(event: Event) -> None:
+        await asyncio.wait_for(queue.put(event), send_timeout)
+
+    try:
+        async for token in answer_chain.astream(
+            inputs, {**config, "callbacks": [SourcesCallbackHandler(put)]}
+        ):
+            await put(("data", json.dumps(token)))
+        await put(("end", ""))
+    except asyncio.TimeoutError:
+        logger.warning("Client stopped reading the answer, dropping it")
+        # Replaces the unread events, so the client learns it was dropped
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(("error", json.dumps("Client too slow")))
+    except Exception as e:
+        logger.exception("Answering failed")
+        await queue.put(("error", json.dumps(str(e))))
+
+
+def _coalesce(events: list[Event]) -> list[Event]:
+    """Merge consecutive tokens, queued while the client was behind, into one."""
+    coalesced: list[Event] = []
+    tokens: list[str] = []
+    for event, data in events:
+        if event == "data":
+            tokens.append(json.loads(data))
+            continue
+        if tokens:
+            coalesced.append(("data", json.dumps("".join(tokens))))
+            tokens = []
+        coalesced.append((event, data))
+    if tokens:
+        coalesced.append(("data", json.dumps("".join(tokens))))
+    return coalesced
+
+
+async def _stream_events(
+    queue: "asyncio.Queue[Event]", producer: asyncio.Task
+) -> AsyncIterator[str]:
+    try:
+        while True:
+            events = [await queue.get()]
+            while not queue.empty():
+                events.append(queue.get_nowait())
+            for event, data in _coalesce(events):
+                yield f"event: {event}\ndata: {data}\n\n"
+                if event in ("end", "error"):
+                    return
+    finally:
+        # The client is gone or done, which stops the LLM call as well
+        producer.cancel()
+
+
+@router.post(
+    "/chat/stream",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+)
+async def stream_answer(
+    input: dict = Body(...),
+    config: Optional[dict] = Body(default=None),
+) -> StreamingResponse:
+    """Stream the sources of the answer as soon as they are retrieved, then its tokens.
+
+    Server-sent events: one `sources` event with the url and title of each
+    retrieved document, `data` events with the answer tokens as JSON strings,
+    then `end`, or `error` if answering failed.
+    """
+    try:
+        request = ChatRequest.parse_obj(input)
+    except ValidationError as e:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, e.errors())
+    settings = get_api_settings().streaming
+    queue: asyncio.Queue[Event] = asyncio.Queue(maxsize=settings.buffer_size)
+    producer = asyncio.create_task(
+        _generate(
+            request.dict(),
+            {"metadata": (config or {}).get("metadata", {})},
+            queue,
+            settings.send_timeout_s,
+        )
+    )
+    return StreamingResponse(
+        _stream_events(queue, producer),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,6 +1,10 @@
+from typing import Optional
+
+from core.config import get_api_settings
+from core.constants import DB_COLLECTION_NAME
 from database import get_session
-from dto import SourceAndTitle
-from fastapi import APIRouter, Depends, status
+from dto import SourceAndTitlePage
+from fastapi import APIRouter, Depends, Query, status
 from service import document_metadata as service_document_metadata
 from sqlmodel import Session
 
@@ -12,7 +16,16 @@ router = APIRouter()
     status_code=status.HTTP_200_OK,
 )
 def get_sources_and_titles(
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(default=None, ge=1),
     session: Session = Depends(get_session),
-) -> list[SourceAndTitle]:
-    sources_and_titles = service_document_metadata.get_doc_source_and_title(session)
+) -> SourceAndTitlePage:
+    settings = get_api_settings().doc_references
+    sources_and_titles = service_document_metadata.get_doc_source_and_title(
+        session,
+        DB_COLLECTION_NAME,
+        cursor,
+        min(limit or settings.page_size, settings.max_page_size),
+        settings.materialized,
+    )
     return sources_and_titles
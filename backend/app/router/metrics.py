@@ -0,0 +1,14 @@
+from typing import Any
+
+from core.metrics import get_metrics
+from fastapi import APIRouter, status
+
+router = APIRouter()
+
+
+@router.get(
+    "/metrics",
+    status_code=status.HTTP_200_OK,
+)
+def get_runtime_metrics() -> dict[str, dict[str, Any]]:
+    return get_metrics()
@@ -1,22 +1,42 @@
-from typing import Set
+import base64
+import json
+from typing import Optional
 
-from dto import SourceAndTitle
+from dto import SourceAndTitle, SourceAndTitlePage
+from fastapi import HTTPException, status
 from repository import document_metadata as repository_document_metadata
 from sqlmodel import Session
 
 
-def get_doc_source_and_title(session: Session) -> list[SourceAndTitle]:
-    metadata = repository_document_metadata.get_all_doc_metadata(session)
+def encode_cursor(last: SourceAndTitle) -> str:
+    payload = json.dumps([last.source, last.title]).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
 
-    duplicate_source_titles: Set[str] = set()
-    source_and_titles: list[SourceAndTitle] = []
 
-    for meta in metadata:
-        key = f"{meta.source}:{meta.title}"
-        if key not in duplicate_source_titles:
-            duplicate_source_titles.add(key)
-            source_and_titles.append(
-                SourceAndTitle(source=meta.source, title=meta.title)
-            )
+def decode_cursor(cursor: str) -> SourceAndTitle:
+    try:
+        source, title = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return SourceAndTitle(source=source, title=title)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        ) from e
 
-    return source_and_titles
+
+def get_doc_source_and_title(
+    session: Session,
+    collection_name: str,
+    cursor: Optional[str],
+    limit: int,
+    materialized: bool,
+) -> SourceAndTitlePage:
+    after = decode_cursor(cursor) if cursor else None
+    # One more than requested tells whether there is a next page
+    sources_and_titles = repository_document_metadata.get_doc_sources_and_titles(
+        session, collection_name, after, limit + 1, materialized
+    )
+    items = sources_and_titles[:limit]
+    has_more = len(sources_and_titles) > limit
+    return SourceAndTitlePage(
+        items=items, next_cursor=encode_cursor(items[-1]) if has_more else None
+    )
@@ -1,7 +1,9 @@
 """Configuration for QuerySphere."""
 
+import os
 from functools import lru_cache
 from pathlib import Path
+from typing import Literal, Optional
 
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -17,10 +19,77 @@ class Parser(BaseModel):
 
     chunk_size: int = Field(default=4000)
     chunk_overlap: int = Field(default=200)
+    # Both backends produce the same markdown, lxml is several times faster
+    html_backend: Literal["bs4", "lxml"] = Field(default="lxml")
+
+
+class IngestSettings(BaseModel):
+    """Ingestion configurations"""
+
+    block_size: int = Field(default=50)
+    # Processes parsing and splitting documents, 0 does it on the loader threads
+    workers: int = Field(default_factory=lambda: os.cpu_count() or 1)
+    source_concurrency: int = Field(default=4)
+    queue_size: int = Field(default=64)
+    # "incremental" only parses sitemap pages changed since the last ingest
+    sitemap_mode: Literal["full", "incremental"] = Field(default="incremental")
+    page_cache_path: str = Field(default="./data/page_cache")
+    fetch_concurrency: int = Field(default=8)
+    # Per host
+    requests_per_second: float = Field(default=5.0)
+
+
+class IndexingSettings(BaseModel):
+    """Indexing configurations, incl. the per stage concurrency of the pipelined mode"""
+
+    batch_size: int = Field(default=100)
+    cleanup_batch_size: int = Field(default=1_000)
+    pipelined: bool = Field(default=False)
+    queue_size: int = Field(default=4)
+    exists_workers: int = Field(default=1)
+    embed_workers: int = Field(default=2)
+    write_workers: int = Field(default=1)
+    # Binary COPY writes and batched deletes, see `core.vector_store.BulkPGVector`
+    bulk_write: bool = Field(default=True)
 
 
 class EmbedSettings(BaseModel):
     name: str = Field(default="BAAI/bge-small-en")
+    normalize: bool = Field(default=True)
+    cache_backend: Literal["none", "sqlite", "postgres"] = Field(default="none")
+    cache_path: str = Field(default="./data/embedding_cache.sqlite")
+    cache_max_entries: int = Field(default=1_000_000)
+    query_cache_size: int = Field(default=1024)
+    query_batch_window_ms: float = Field(default=5.0)
+    query_max_batch_size: int = Field(default=32)
+    # float16 stores halfvec, half the size. pgvector has no int8 vectors.
+    storage_precision: Literal["float32", "float16"] = Field(default="float32")
+    # Search the binary quantized embeddings first and rescore the candidates
+    # by their full vectors, see `core.vector_index.create_vector_index`. Meant
+    # for high dimension models, 1 bit per dimension keeps too little of small
+    # ones: at 384 dimensions, recall@10 is 0.47 with 100 candidates and 0.88
+    # with 400, see `scripts/vector_index.py recall`.
+    binary_first_pass: bool = Field(default=False)
+    rescore_candidates: int = Field(default=400)
+    # "onnx" runs an ONNX Runtime export of the model, see `core.onnx_embedding`
+    backend: Literal["sentence_transformers", "onnx"] = Field(
+        default="sentence_transformers"
+    )
+    # int8 weights, onnx backend only
+    quantize: bool = Field(default=False)
+    onnx_path: str = Field(default="./data/onnx")
+    # An export less similar to the model than this is rejected
+    onnx_min_similarity: float = Field(default=0.99)
+    batch_size: int = Field(default=32)
+    # Intra-op threads of the model, the runtime default if 0
+    threads: int = Field(default=0)
+    # Server sharing one model between the API workers and ingests, e.g.
+    # unix:///tmp/querysphere-embedding.sock or http://127.0.0.1:8765, see
+    # `core.embedding_server`. The model is loaded in-process if unset or down.
+    server_url: Optional[str] = Field(default=None)
+    server_timeout: float = Field(default=60.0)
+    server_batch_window_ms: float = Field(default=5.0)
+    server_max_batch_size: int = Field(default=64)
 
 
 # LLM and prompting related settings
@@ -30,6 +99,35 @@ class LLMSettings(BaseModel):
     temperature: float = Field(default=0.2)
 
 
+class ContextSettings(BaseModel):
+    """Packing of the retrieved chunks into the prompt, see `core.context_packing`"""
+
+    # Candidates retrieved, of which as many as fit into the budget are packed
+    fetch_k: int = Field(default=20)
+    # Tokenizer of the LLM on the Hugging Face hub for exact counts, e.g.
+    # HuggingFaceH4/zephyr-7b-beta. Estimated by the characters if unset.
+    tokenizer: Optional[str] = Field(default=None)
+    chars_per_token: float = Field(default=3.5)
+    # A span is truncated to the remaining budget only if this much is left
+    min_span_tokens: int = Field(default=64)
+
+
+class RerankSettings(BaseModel):
+    """Cross-encoder reranking of the retrieved chunks, see `core.reranking`"""
+
+    enabled: bool = Field(default=False)
+    model: str = Field(default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+    # Tokens of a question and chunk pair, longer chunks are truncated
+    max_length: int = Field(default=512)
+    # Of the context.fetch_k candidates, the best to pack into the prompt
+    top_k: int = Field(default=6)
+    batch_size: int = Field(default=8)
+    workers: int = Field(default=2)
+    # Chunks not scored by then keep their retrieval order behind the scored ones
+    budget_ms: float = Field(default=300.0)
+    cache_size: int = Field(default=4096)
+
+
 ## Database related settings
 class PGVectorSettings(BaseModel):
     driver: str = Field(default="psycopg2")
@@ -38,6 +136,92 @@ class PGVectorSettings(BaseModel):
     database: str = Field(default="app_db")
     user: str = Field(default="user")
     password: str = Field(default="password")
+    # Pool of each engine shared by a process, see `core.storage.get_engine`
+    pool_size: int = Field(default=5)
+    max_overflow: int = Field(default=10)
+    pool_timeout: float = Field(default=30.0)
+    pool_recycle: int = Field(default=1800)
+    pool_pre_ping: bool = Field(default=True)
+    # 0 disables the timeout
+    statement_timeout_ms: int = Field(default=30_000)
+
+
+class VectorIndexSettings(BaseModel):
+    """Approximate nearest neighbour index on the embeddings and its query parameters"""
+
+    method: Literal["none", "hnsw", "ivfflat"] = Field(default="none")
+    m: int = Field(default=16)
+    ef_construction: int = Field(default=64)
+    lists: int = Field(default=100)
+    ef_search: int = Field(default=40)
+    probes: int = Field(default=1)
+    ensure_on_startup: bool = Field(default=False)
+    # Filtered searches matching at most this many chunks skip the ANN index,
+    # more selective ones than an ANN scan of filter_max_scan_tuples rows can
+    # serve as well, see `core.retrieval.plan_filtered_search`
+    filter_exact_max_rows: int = Field(default=10_000)
+    filter_max_scan_tuples: int = Field(default=20_000)
+
+
+class RetrievalSettings(BaseModel):
+    """Retrieval by similarity only, or fused with a full text search"""
+
+    mode: Literal["vector", "hybrid"] = Field(default="vector")
+    # Fixed once the tsvector column is added, see `core.text_search`
+    text_search_config: str = Field(default="english")
+    # Constant of the reciprocal rank fusion, larger flattens the rank weights
+    rrf_k: int = Field(default=60)
+
+
+class RetrievalCacheSettings(BaseModel):
+    """Cache of retrieval results, invalidated whenever the index changes"""
+
+    enabled: bool = Field(default=True)
+    max_entries: int = Field(default=1024)
+    ttl_seconds: float = Field(default=300.0)
+    # Cosine similarity above which a differently phrased question is a hit,
+    # only identical normalized questions hit if unset
+    similarity_threshold: Optional[float] = Field(default=None)
+
+
+class RephraseSettings(BaseModel):
+    """When to condense a follow up question with the chat history by the LLM"""
+
+    mode: Literal["always", "heuristic", "speculative"] = Field(default="heuristic")
+    # Standalone questions cached per chat history and question
+    cache_size: int = Field(default=256)
+    # Cosine similarity of the query embeddings of a question and its standalone
+    # question above which the speculative retrieval for the question is kept
+    speculation_threshold: float = Field(default=0.9)
+
+
+class DocReferencesSettings(BaseModel):
+    """Pagination of the document references, optionally from a materialized table"""
+
+    page_size: int = Field(default=100)
+    max_page_size: int = Field(default=1_000)
+    # Read the sources table kept in sync by ingestion, instead of aggregating
+    # all chunks per page
+    materialized: bool = Field(default=False)
+
+
+class StreamingSettings(BaseModel):
+    """Answer streaming of /api/v1/chat/stream, see `router.chat`"""
+
+    # Events buffered for a client, the answer is generated no faster than
+    # it reads once they are full
+    buffer_size: int = Field(default=64)
+    # A client not reading for this long is dropped
+    send_timeout_s: float = Field(default=30.0)
+
+
+class StartupSettings(BaseModel):
+    """When the API builds the models and clients of the chain, see `core.startup`"""
+
+    # "import" builds them when the app is imported, so the workers forked by
+    # `gunicorn --preload` share them. "lifespan" builds them in each worker
+    # before it serves, "lazy" on the first request.
+    chain_init: Literal["import", "lifespan", "lazy"] = Field(default="lifespan")
 
 
 class Settings(BaseSettings, case_sensitive=False):
@@ -51,9 +235,22 @@ class Settings(BaseSettings, case_sensitive=False):
     )
 
     parser: Parser
+    ingest: IngestSettings = Field(default_factory=IngestSettings)
+    indexing: IndexingSettings = Field(default_factory=IndexingSettings)
     embed: EmbedSettings
     llm: LLMSettings
+    context: ContextSettings = Field(default_factory=ContextSettings)
+    rerank: RerankSettings = Field(default_factory=RerankSettings)
     pgvector: PGVectorSettings
+    vector_index: VectorIndexSettings = Field(default_factory=VectorIndexSettings)
+    retrieval: RetrievalSettings = Field(default_factory=RetrievalSettings)
+    retrieval_cache: RetrievalCacheSettings = Field(
+        default_factory=RetrievalCacheSettings
+    )
+    rephrase: RephraseSettings = Field(default_factory=RephraseSettings)
+    doc_references: DocReferencesSettings = Field(default_factory=DocReferencesSettings)
+    streaming: StreamingSettings = Field(default_factory=StreamingSettings)
+    startup: StartupSettings = Field(default_factory=StartupSettings)
 
 
 @lru_cache()
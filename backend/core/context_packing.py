@@ -0,0 +1,146 @@
+"""Module to pack retrieved chunks into the token budget of the prompt"""
+
+import threading
+from typing import Callable, Optional
+
+from langchain.schema import Document
+
+TokenCounter = Callable[[str], int]
+
+
+def get_token_counter(tokenizer: Optional[str], chars_per_token: float) -> TokenCounter:
+    """Exact counts with the tokenizer of the LLM if given, estimates otherwise."""
+    if tokenizer is None:
+        return lambda text: int(len(text) / chars_per_token) + 1
+
+    from transformers import AutoTokenizer
+
+    hf_tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+    return lambda text: len(hf_tokenizer.encode(text, add_special_tokens=False))
+
+
+def merge_overlapping(docs: list[Document]) -> list[Document]:
+    """Merge the chunks of a source whose `start_index` ranges overlap or touch.
+
+    Chunks overlap by the `chunk_overlap` of the splitter, neighbouring chunks
+    retrieved together would repeat it. A merged span keeps the position of its
+    best ranked chunk, chunks without `source` or `start_index` are kept as is.
+    """
+    spans: list[Optional[Document]] = list(docs)
+    # Positions in the ranking of the chunks of each source
+    by_source: dict[str, list[int]] = {}
+    for position, doc in enumerate(docs):
+        source = doc.metadata.get("source")
+        if source is not None and isinstance(doc.metadata.get("start_index"), int):
+            by_source.setdefault(source, []).append(position)
+
+    for positions in by_source.values():
+        if len(positions) < 2:
+            continue
+        positions.sort(key=lambda p: docs[p].metadata["start_index"])
+        best = positions[0]
+        start, text = docs[best].metadata["start_index"], docs[best].page_content
+        for position in positions[1:]:
+            doc = docs[position]
+            doc_start = doc.metadata["start_index"]
+            if doc_start <= start + len(text):
+                text += doc.page_content[start + len(text) - doc_start :]
+                spans[position] = None
+                if position < best:
+                    spans[best], best = None, position
+                continue
+            spans[best] = _span(docs[best], start, text)
+            best, start, text = position, doc_start, doc.page_content
+        spans[best] = _span(docs[best], start, text)
+    return [span for span in spans if span is not None]
+
+
+def _span(doc: Document, start: int, text: str) -> Document:
+    if start == doc.metadata["start_index"] and text == doc.page_content:
+        return doc
+    return Document(page_content=text, metadata={**doc.metadata, "start_index": start})
+
+
+def _truncate(text: str, ratio: float) -> str:
+    cut = text[: int(len(text) * ratio)]
+    # At a line or word boundary, if there is one in the last quarter
+    boundary = max(cut.rfind("\n"), cut.rfind(" "))
+    return cut[:boundary] if boundary > len(cut) * 3 / 4 else cut
+
+
+class ContextPacker:
+    """Greedily packs the best ranked spans of the retrieved chunks into a budget.
+
+    The retriever fetches more candidates than fit. Overlapping chunks of a
+    source are merged, see `merge_overlapping`, and the spans are taken in
+    ranking order while they fit into the token budget. A span larger than the
+    remaining budget is truncated to it if at least `min_span_tokens` remain,
+    and skipped for the smaller spans ranked after it otherwise.
+    """
+
+    def __init__(self, count_tokens: TokenCounter, min_span_tokens: int) -> None:
+        self.count_tokens = count_tokens
+        self.min_span_tokens = min_span_tokens
+        self._lock = threading.Lock()
+        self._counts = {
+            "requests": 0,
+            "candidates": 0,
+            "merged": 0,
+            "packed": 0,
+            "truncated": 0,
+            "budget_tokens": 0,
+            "context_tokens": 0,
+        }
+
+    def pack(
+        self, docs: list[Document], budget_tokens: int, span_overhead_tokens: int = 0
+    ) -> list[Document]:
+        """The spans to put into the prompt, best ranked first.
+
+        Args:
+            docs: Retrieved chunks, best ranked first.
+            budget_tokens: Tokens available for the context.
+            span_overhead_tokens: Tokens the formatting adds to each span.
+        """
+        spans = merge_overlapping(docs)
+        packed: list[Document] = []
+        truncated = 0
+        remaining = max(budget_tokens, 0)
+        for span in spans:
+            tokens = self.count_tokens(span.page_content) + span_overhead_tokens
+            if tokens <= remaining:
+                packed.append(span)
+                remaining -= tokens
+                continue
+            if remaining < self.min_span_tokens:
+                continue
+            available = remaining - span_overhead_tokens
+            text = _truncate(span.page_content, available / tokens)
+            # Counts are not linear in the length, shrink until it fits
+            while text and self.count_tokens(text) > available:
+                text = _truncate(text, 0.9)
+            if text:
+                packed.append(Document(page_content=text, metadata=span.metadata))
+                remaining -= self.count_tokens(text) + span_overhead_tokens
+                truncated += 1
+
+        with self._lock:
+            self._counts["requests"] += 1
+            self._counts["candidates"] += len(docs)
+            self._counts["merged"] += len(docs) - len(spans)
+            self._counts["packed"] += len(packed)
+            self._counts["truncated"] += truncated
+            self._counts["budget_tokens"] += max(budget_tokens, 0)
+            self._counts["context_tokens"] += max(budget_tokens, 0) - remaining
+        return packed
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            requests = self._counts["requests"] or 1
+            return {
+                **self._counts,
+                "candidates_avg": self._counts["candidates"] / requests,
+                "packed_avg": self._counts["packed"] / requests,
+                "context_tokens_avg": self._counts["context_tokens"] / requests,
+            }
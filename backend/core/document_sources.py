@@ -0,0 +1,58 @@
+"""Module to materialize the distinct sources and titles of a collection"""
+
+import sqlalchemy as sa
+from core.vector_index import COLLECTION_TABLE, EMBEDDING_TABLE
+from sqlalchemy.engine import Engine
+
+DOCUMENT_SOURCE_TABLE = "langchain_pg_document_source"
+
+# The json fields of the chunk metadata, missing ones sort first as ''
+SOURCE_EXPRESSION = "COALESCE(e.cmetadata->>'source', '')"
+TITLE_EXPRESSION = "COALESCE(e.cmetadata->>'title', '')"
+
+
+def create_document_sources_table(engine: Engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(
+            sa.text(
+                f"CREATE TABLE IF NOT EXISTS {DOCUMENT_SOURCE_TABLE} ("
+                "collection_id UUID NOT NULL, "
+                "source TEXT NOT NULL, "
+                "title TEXT NOT NULL, "
+                "PRIMARY KEY (collection_id, source, title))"
+            )
+        )
+
+
+def refresh_document_sources(engine: Engine, collection_name: str) -> int:
+    """Replace the materialized sources of a collection by the current ones.
+
+    Runs in one transaction, readers see either the old or the new sources.
+
+    Returns:
+        The number of distinct sources and titles.
+    """
+    create_document_sources_table(engine)
+    with engine.begin() as connection:
+        collection_id = connection.execute(
+            sa.text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name"),
+            {"name": collection_name},
+        ).scalar()
+        if collection_id is None:
+            return 0
+        connection.execute(
+            sa.text(
+                f"DELETE FROM {DOCUMENT_SOURCE_TABLE} "
+                "WHERE collection_id = :collection_id"
+            ),
+            {"collection_id": collection_id},
+        )
+        return connection.execute(
+            sa.text(
+                f"INSERT INTO {DOCUMENT_SOURCE_TABLE} (collection_id, source, title) "
+                f"SELECT DISTINCT e.collection_id, {SOURCE_EXPRESSION}, "
+                f"{TITLE_EXPRESSION} FROM {EMBEDDING_TABLE} e "
+                "WHERE e.collection_id = :collection_id"
+            ),
+            {"collection_id": collection_id},
+        ).rowcount
@@ -1,10 +1,95 @@
 """Module to work with embeddings"""
 
+from pathlib import Path
+
+import sqlalchemy as sa
+from core.config import EmbedSettings, Settings
+from core.embedding_cache import CachedEmbeddings, SQLEmbeddingStore
+from core.embedding_server import EmbeddingServerClient
+from core.onnx_embedding import (
+    MODEL_FILE,
+    QUANTIZED_MODEL_FILE,
+    OnnxEmbeddings,
+    export_model,
+)
+from core.query_embedding import QueryEmbeddings
+from core.storage import get_engine
 from langchain.embeddings import HuggingFaceBgeEmbeddings
+from langchain.schema.embeddings import Embeddings
+
+
+def get_embeddings_model(embed: EmbedSettings) -> Embeddings:
+    """Get the embeddings model on the configured backend, or of the server."""
+    if embed.server_url:
+        local_embed = embed.model_copy(update={"server_url": None})
+        client = EmbeddingServerClient(
+            embed.server_url,
+            embed.server_timeout,
+            fallback=lambda: get_embeddings_model(local_embed),
+        )
+        if client.connect(get_cache_model_name(embed), embed.normalize):
+            return client
+        return get_embeddings_model(local_embed)
+
+    if embed.backend == "onnx":
+        model_dir = export_model(
+            embed.name, embed.onnx_path, embed.quantize, embed.onnx_min_similarity
+        )
+        return OnnxEmbeddings(
+            model_dir,
+            QUANTIZED_MODEL_FILE if embed.quantize else MODEL_FILE,
+            batch_size=embed.batch_size,
+            threads=embed.threads,
+            normalize=embed.normalize,
+        )
 
-def get_embeddings_model(model_name: str):
+    if embed.threads:
+        import torch
+
+        # Process wide, torch has no per model thread count
+        torch.set_num_threads(embed.threads)
     return HuggingFaceBgeEmbeddings(
-        model_name=model_name,
+        model_name=embed.name,
         model_kwargs={"device": "cpu"},
-        encode_kwargs={"normalize_embeddings": True},
+        encode_kwargs={
+            "normalize_embeddings": embed.normalize,
+            "batch_size": embed.batch_size,
+        },
+    )
+
+
+def get_cache_model_name(embed: EmbedSettings) -> str:
+    # The int8 weights give slightly different embeddings than the model
+    if embed.backend == "onnx" and embed.quantize:
+        return f"{embed.name}:int8"
+    return embed.name
+
+
+def get_embeddings(settings: Settings) -> Embeddings:
+    """Get the embeddings model, wrapped in the configured embedding cache."""
+    embeddings = get_embeddings_model(settings.embed)
+    if settings.embed.cache_backend == "none":
+        return embeddings
+
+    if settings.embed.cache_backend == "sqlite":
+        cache_path = Path(settings.embed.cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        engine = sa.create_engine(f"sqlite:///{cache_path}")
+    else:
+        engine = get_engine(settings)
+    return CachedEmbeddings(
+        embeddings,
+        SQLEmbeddingStore(engine, max_entries=settings.embed.cache_max_entries),
+        model_name=get_cache_model_name(settings.embed),
+        normalize=settings.embed.normalize,
+    )
+
+
+def get_query_embeddings(settings: Settings) -> QueryEmbeddings:
+    """Get the embeddings model, with cached and micro-batched query encoding."""
+    return QueryEmbeddings(
+        get_embeddings_model(settings.embed),
+        cache_size=settings.embed.query_cache_size,
+        batch_window=settings.embed.query_batch_window_ms / 1000,
+        max_batch_size=settings.embed.query_max_batch_size,
     )
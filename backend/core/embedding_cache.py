@@ -0,0 +1,216 @@
+"""Module to cache document embeddings by content hash"""
+
+import hashlib
+import threading
+import time
+from array import array
+from typing import Iterator, Optional, Sequence
+
+import sqlalchemy as sa
+from langchain.schema.embeddings import Embeddings
+from langchain_core.stores import BaseStore
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+EMBEDDING_CACHE_TABLE = "embedding_cache"
+
+# Keep the IN lists below the bound parameter limit of SQLite
+_MAX_KEYS_PER_STATEMENT = 500
+# Share of `max_entries` an eviction frees, so that the table is only recounted
+# and evicted again after that many inserts
+_EVICTION_SLACK = 0.1
+
+
+class SQLEmbeddingStore(BaseStore[str, bytes]):
+    """Byte store on a SQL table with least recently used eviction.
+
+    Works on SQLite, as a local on disk cache, and on Postgres, as a cache shared
+    by all ingest runs against the same database. Every read refreshes the last
+    access time of the keys it hits. Once the table holds more than `max_entries`
+    rows, the least recently accessed rows are evicted down to 90% of it.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        max_entries: int,
+        table_name: str = EMBEDDING_CACHE_TABLE,
+    ) -> None:
+        self.engine = engine
+        self.max_entries = max_entries
+        metadata = sa.MetaData()
+        self.table = sa.Table(
+            table_name,
+            metadata,
+            sa.Column("key", sa.String, primary_key=True),
+            sa.Column("value", sa.LargeBinary, nullable=False),
+            sa.Column("last_access", sa.Float, nullable=False, index=True),
+        )
+        metadata.create_all(engine)
+        self._lock = threading.Lock()
+        with engine.connect() as connection:
+            self._num_entries = connection.execute(
+                sa.select(sa.func.count()).select_from(self.table)
+            ).scalar_one()
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        found: dict[str, bytes] = {}
+        with self.engine.begin() as connection:
+            for chunk in _chunks(keys):
+                rows = connection.execute(
+                    sa.select(self.table.c.key, self.table.c.value).where(
+                        self.table.c.key.in_(chunk)
+                    )
+                )
+                found.update((row.key, row.value) for row in rows)
+            for chunk in _chunks(list(found)):
+                connection.execute(
+                    self.table.update()
+                    .where(self.table.c.key.in_(chunk))
+                    .values(last_access=time.time())
+                )
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, bytes]]) -> None:
+        if not key_value_pairs:
+            return
+        now = time.time()
+        records = [
+            {"key": key, "value": value, "last_access": now}
+            for key, value in dict(key_value_pairs).items()
+        ]
+        insert = (
+            postgresql.insert
+            if self.engine.dialect.name == "postgresql"
+            else sqlite.insert
+        )
+        with self.engine.begin() as connection:
+            for i in range(0, len(records), _MAX_KEYS_PER_STATEMENT):
+                stmt = insert(self.table).values(
+                    records[i : i + _MAX_KEYS_PER_STATEMENT]
+                )
+                connection.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=[self.table.c.key],
+                        set_={
+                            "value": stmt.excluded.value,
+                            "last_access": stmt.excluded.last_access,
+                        },
+                    )
+                )
+        with self._lock:
+            # Overwritten keys are counted twice, which only makes eviction
+            # run early
+            self._num_entries += len(records)
+            if self._num_entries > self.max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        with self.engine.begin() as connection:
+            num_entries = connection.execute(
+                sa.select(sa.func.count()).select_from(self.table)
+            ).scalar_one()
+            # Also if the overwritten keys were all that crossed `max_entries`,
+            # or every following insert would recount again
+            overflow = num_entries - int(self.max_entries * (1 - _EVICTION_SLACK))
+            if overflow > 0:
+                oldest = (
+                    sa.select(self.table.c.key)
+                    .order_by(self.table.c.last_access)
+                    .limit(overflow)
+                    .scalar_subquery()
+                )
+                connection.execute(
+                    self.table.delete().where(self.table.c.key.in_(oldest))
+                )
+                num_entries -= overflow
+        self._num_entries = num_entries
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self.engine.begin() as connection:
+            for chunk in _chunks(keys):
+                connection.execute(
+                    self.table.delete().where(self.table.c.key.in_(chunk))
+                )
+        with self._lock:
+            self._num_entries = max(self._num_entries - len(keys), 0)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        query = sa.select(self.table.c.key)
+        if prefix is not None:
+            query = query.where(self.table.c.key.startswith(prefix, autoescape=True))
+        with self.engine.connect() as connection:
+            yield from connection.execute(query).scalars()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings which look up document embeddings in a cache first.
+
+    Keys are derived from the model name, whether the embeddings are normalized
+    and the hash of the text, so a re-ingest of unchanged text, or of a chunk whose
+    metadata changed but whose text did not, never reaches the model. Queries are
+    not cached here, they go straight to the underlying model.
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        store: BaseStore[str, bytes],
+        model_name: str,
+        normalize: bool,
+    ) -> None:
+        self.underlying = underlying
+        self.store = store
+        self.namespace = f"{model_name}:normalize={normalize}:"
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        return self.namespace + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(text) for text in texts]
+        cached = self.store.mget(keys)
+        vectors: list[Optional[list[float]]] = [
+            None if value is None else array("f", value).tolist() for value in cached
+        ]
+
+        missing = {key: text for key, text, v in zip(keys, texts, vectors) if v is None}
+        if missing:
+            computed = dict(
+                zip(missing, self.underlying.embed_documents(list(missing.values())))
+            )
+            self.store.mset(
+                [
+                    (key, array("f", vector).tobytes())
+                    for key, vector in computed.items()
+                ]
+            )
+            vectors = [
+                computed[key] if vector is None else vector
+                for key, vector in zip(keys, vectors)
+            ]
+
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.underlying.embed_query(text)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def _chunks(keys: Sequence[str]) -> Iterator[Sequence[str]]:
+    for i in range(0, len(keys), _MAX_KEYS_PER_STATEMENT):
+        yield keys[i : i + _MAX_KEYS_PER_STATEMENT]
@@ -0,0 +1,200 @@
+"""Module to share one embedding model between processes through a local server
+
+The server embeds the texts of all its clients through one `MicroBatcher`, so
+concurrent requests of API workers and ingests are encoded in common batches.
+It listens on a Unix socket, `unix:///path/to.sock`, or on localhost,
+`http://127.0.0.1:8765`, see `scripts/embedding_server.py`. Vectors are returned
+as raw float32, the precision of the models.
+"""
+
+import asyncio
+import http.client
+import logging
+import socket
+import threading
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+import numpy as np
+from core.query_embedding import MicroBatcher
+from fastapi import FastAPI, Response
+from langchain.schema.embeddings import Embeddings
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class EmbedRequest(BaseModel):
+    texts: list[str]
+
+
+class EmbeddingServerInfo(BaseModel):
+    model: str
+    normalize: bool
+    query_instruction: str
+
+
+def create_app(
+    model: Embeddings,
+    model_name: str,
+    normalize: bool,
+    batch_window: float,
+    max_batch_size: int,
+) -> FastAPI:
+    """The server app, embedding documents with `model`.
+
+    Queries are sent with the query instruction of the model prepended, which
+    `/info` returns along with the model name clients check before using it.
+    """
+    batcher: MicroBatcher[str, list[float]] = MicroBatcher(
+        model.embed_documents,
+        window=batch_window,
+        max_batch_size=max_batch_size,
+        name="embedding-server-batcher",
+    )
+    app = FastAPI(title="QuerySphere embedding server")
+
+    @app.get("/info")
+    def info() -> dict:
+        return {
+            "model": model_name,
+            "normalize": normalize,
+            "query_instruction": getattr(model, "query_instruction", ""),
+            **batcher.stats,
+        }
+
+    @app.post("/embed")
+    async def embed(request: EmbedRequest) -> Response:
+        # Each text is an item of the batcher, batched with those of other clients
+        vectors = await asyncio.gather(*map(batcher.asubmit, request.texts))
+        return Response(
+            np.asarray(vectors, dtype=np.float32).tobytes(),
+            media_type="application/octet-stream",
+        )
+
+    return app
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class EmbeddingServerClient(Embeddings):
+    """Embeddings computed by the embedding server, see `create_app`.
+
+    Each thread keeps a connection to the server. Texts are sent in requests of
+    at most `request_size` texts. If the server cannot be reached, the model is
+    loaded in-process by `fallback`, once, and used from then on.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float,
+        fallback: Callable[[], Embeddings],
+        request_size: int = 256,
+    ) -> None:
+        self.url = urlparse(url)
+        self.timeout = timeout
+        self.fallback = fallback
+        self.request_size = request_size
+        self.query_instruction = ""
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._fallback_model: Optional[Embeddings] = None
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        if self.url.scheme == "unix":
+            return _UnixHTTPConnection(self.url.path, self.timeout)
+        return http.client.HTTPConnection(
+            self.url.hostname, self.url.port, timeout=self.timeout
+        )
+
+    def _request(self, method: str, path: str, body: Optional[bytes] = None) -> bytes:
+        # A kept alive connection may have been closed by the server meanwhile,
+        # a fresh one is tried once
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            reused = connection is not None
+            if connection is None:
+                connection = self._local.connection = self._new_connection()
+            try:
+                connection.request(
+                    method, path, body, {"Content-Type": "application/json"}
+                )
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                self._local.connection = None
+                if reused and attempt == 0:
+                    continue
+                raise
+            if response.status != 200:
+                raise RuntimeError(
+                    f"Embedding server responded {response.status}: {data[:200]!r}"
+                )
+            return data
+
+    def connect(self, model_name: str, normalize: bool) -> bool:
+        """Whether the server is up and serves the given model."""
+        try:
+            info = EmbeddingServerInfo.model_validate_json(
+                self._request("GET", "/info")
+            )
+        except (OSError, http.client.HTTPException, RuntimeError) as e:
+            logger.warning(f"Embedding server {self.url.geturl()} unavailable: {e}")
+            return False
+        if info.model != model_name or info.normalize != normalize:
+            logger.warning(
+                f"Embedding server serves {info.model} (normalize={info.normalize}), "
+                f"configured is {model_name} (normalize={normalize})."
+            )
+            return False
+        self.query_instruction = info.query_instruction
+        return True
+
+    def _get_fallback(self) -> Embeddings:
+        with self._lock:
+            if self._fallback_model is None:
+                self._fallback_model = self.fallback()
+            return self._fallback_model
+
+    def _embed(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.request_size):
+            batch = texts[start : start + self.request_size]
+            data = self._request(
+                "POST",
+                "/embed",
+                EmbedRequest(texts=batch).model_dump_json().encode("utf-8"),
+            )
+            vectors.extend(
+                np.frombuffer(data, dtype=np.float32).reshape(len(batch), -1).tolist()
+            )
+        return vectors
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        if self._fallback_model is None:
+            try:
+                return self._embed(texts)
+            except (OSError, http.client.HTTPException) as e:
+                logger.warning(
+                    f"Embedding server {self.url.geturl()} failed, "
+                    f"loading the model in-process: {e}"
+                )
+        return self._get_fallback().embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        if self._fallback_model is not None:
+            return self._fallback_model.embed_query(text)
+        return self.embed_documents([self.query_instruction + text])[0]
@@ -0,0 +1,50 @@
+"""Module to count the changes of the indexed data, to invalidate caches on"""
+
+import threading
+
+import sqlalchemy as sa
+from langchain.indexes.base import RecordManager
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+INDEX_GENERATION_TABLE = "index_generation"
+
+_metadata = sa.MetaData()
+index_generation_table = sa.Table(
+    INDEX_GENERATION_TABLE,
+    _metadata,
+    sa.Column("namespace", sa.String, primary_key=True),
+    sa.Column("generation", sa.BigInteger, nullable=False),
+)
+
+_created_lock = threading.Lock()
+_created_for: set[str] = set()
+
+
+def bump_index_generation(record_manager: RecordManager) -> None:
+    """Increment the generation of the namespace of a record manager.
+
+    The generation lives next to the records, in the database of the record
+    manager. Record managers without an engine, e.g. in memory ones, have no
+    readers to invalidate and are skipped.
+    """
+    engine = getattr(record_manager, "engine", None)
+    if not isinstance(engine, Engine):
+        return
+
+    with _created_lock:
+        if str(engine.url) not in _created_for:
+            _metadata.create_all(engine)
+            _created_for.add(str(engine.url))
+
+    insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(index_generation_table).values(
+        namespace=record_manager.namespace, generation=1
+    )
+    with engine.begin() as connection:
+        connection.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[index_generation_table.c.namespace],
+                set_={"generation": index_generation_table.c.generation + 1},
+            )
+        )
@@ -1,7 +1,15 @@
 from __future__ import annotations
 
-from typing import Callable, Iterable, Literal, Optional, Sequence, Union, cast
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from typing import Any, Callable, Iterable, Literal, Optional, Sequence, Union, cast
 
+from core.config import IndexingSettings
+from core.index_generation import bump_index_generation
+from core.record_manager import PostgresRecordManager
 from langchain.document_loaders.base import BaseLoader
 from langchain.indexes._api import (
     IndexingResult,
@@ -14,6 +22,18 @@ from langchain.indexes.base import RecordManager
 from langchain.schema.document import Document
 from langchain.schema.vectorstore import VectorStore
 
+_STOP = object()
+
+
+class StagedIndexingResult(IndexingResult, total=False):
+    """Indexing result, extended with the per stage throughput of the pipelined mode.
+
+    `stage_throughput` maps each stage name to the documents it processed per
+    second of wall time between its first and its last batch.
+    """
+
+    stage_throughput: dict[str, float]
+
 
 def index(
     docs_source: Union[BaseLoader, Iterable[Document]],
@@ -25,7 +45,10 @@ def index(
     source_id_key: Union[str, Callable[[Document], str], None] = None,
     cleanup_batch_size: int = 1_000,
     force_update: bool = False,
-) -> IndexingResult:
+    pipeline: Optional[IndexingSettings] = None,
+    unchanged_source_ids: Optional[Sequence[str]] = None,
+    deleted_source_ids: Optional[Sequence[str]] = None,
+) -> StagedIndexingResult:
     """Index data from the loader into the vector store.
 
     Indexing functionality uses a manager to keep track of which documents
@@ -65,6 +88,14 @@ def index(
         cleanup_batch_size: Batch size to use when cleaning up documents.
         force_update: Force update documents even if they are present in the
             record manager. Useful if you are re-indexing with updated embeddings.
+        pipeline: Run hashing, the exists lookup, embedding and the writes as
+            overlapping stages connected by bounded queues, using the per stage
+            concurrency of the given settings. Sequential if None.
+        unchanged_source_ids: Sources left out of the docs because they are known
+            to be unchanged. Their records are refreshed, so that the cleanup
+            keeps their documents.
+        deleted_source_ids: Sources known to be deleted. Their documents are
+            deleted whatever the cleanup mode.
 
     Returns:
         Indexing result which contains information about how many documents
@@ -110,98 +141,570 @@ def index(
     num_updated = 0
     num_deleted = 0
 
-    for doc_batch in _batch(batch_size, doc_iterator):
-        hashed_docs = list(
-            _deduplicate_in_order(
-                [_HashedDocument.from_document(doc) for doc in doc_batch]
-            )
+    if unchanged_source_ids:
+        _refresh_sources(record_manager, unchanged_source_ids, index_start_dt)
+    if deleted_source_ids:
+        num_deleted += _delete_sources(
+            vector_store,
+            record_manager,
+            deleted_source_ids,
+            index_start_dt,
+            cleanup_batch_size,
         )
 
-        source_ids: Sequence[Optional[str]] = [
-            source_id_assigner(doc) for doc in hashed_docs
-        ]
-
-        if cleanup == "incremental":
-            # If the cleanup mode is incremental, source ids are required.
-            for source_id, hashed_doc in zip(source_ids, hashed_docs):
-                if source_id is None:
-                    raise ValueError(
-                        "Source ids are required when cleanup mode is incremental. "
-                        f"Document that starts with "
-                        f"content: {hashed_doc.page_content[:100]} was not assigned "
-                        f"as source id."
-                    )
-            # source ids cannot be None after for loop above.
-            source_ids = cast(Sequence[str], source_ids)  # type: ignore[assignment]
-
-        exists_batch = record_manager.exists([doc.uid for doc in hashed_docs])
-
-        # Filter out documents that already exist in the record store.
-        uids = []
-        docs_to_index = []
-        uids_to_refresh = []
-        for hashed_doc, doc_exists in zip(hashed_docs, exists_batch):
-            if doc_exists and not force_update:
-                uids_to_refresh.append(hashed_doc.uid)
-                continue
-            uids.append(hashed_doc.uid)
-            docs_to_index.append(hashed_doc.to_document())
-
-        # Update refresh timestamp
-        if uids_to_refresh:
-            record_manager.update(uids_to_refresh, time_at_least=index_start_dt)
-            num_skipped += len(uids_to_refresh)
-
-        # Be pessimistic and assume that all vector store write will fail.
-        # First write to vector store
-        if docs_to_index:
-            vector_store.add_documents(docs_to_index, ids=uids)
-            num_added += len(docs_to_index)
-
-        # And only then update the record store.
-        # Update ALL records, even if they already exist since we want to refresh
-        # their timestamp.
-        record_manager.update(
-            [doc.uid for doc in hashed_docs],
-            group_ids=source_ids,
-            time_at_least=index_start_dt,
+    stage_throughput: Optional[dict[str, float]] = None
+    if pipeline is not None:
+        pipelined_result = _index_pipelined(
+            doc_iterator,
+            record_manager,
+            vector_store,
+            pipeline,
+            batch_size=batch_size,
+            cleanup=cleanup,
+            source_id_assigner=source_id_assigner,
+            index_start_dt=index_start_dt,
+            force_update=force_update,
+            cleanup_batch_size=cleanup_batch_size,
         )
+        num_added = pipelined_result["num_added"]
+        num_updated = pipelined_result["num_updated"]
+        num_skipped = pipelined_result["num_skipped"]
+        # On top of the documents of the deleted sources
+        num_deleted += pipelined_result["num_deleted"]
+        stage_throughput = pipelined_result["stage_throughput"]
+    else:
+        for doc_batch in _batch(batch_size, doc_iterator):
+            hashed_docs, source_ids = _hash_batch(
+                doc_batch, source_id_assigner, cleanup
+            )
+
+            exists_batch = record_manager.exists([doc.uid for doc in hashed_docs])
 
-        # If source IDs are provided, we can do the deletion incrementally!
-        if cleanup == "incremental":
-            # Get the uids of the documents that were not returned by the loader.
+            # Filter out documents that already exist in the record store.
+            uids = []
+            docs_to_index = []
+            uids_to_refresh = []
+            num_to_update = 0
+            for hashed_doc, doc_exists in zip(hashed_docs, exists_batch):
+                if doc_exists and not force_update:
+                    uids_to_refresh.append(hashed_doc.uid)
+                    continue
+                # Rewritten although already indexed
+                num_to_update += doc_exists
+                uids.append(hashed_doc.uid)
+                docs_to_index.append(hashed_doc.to_document())
 
-            # mypy isn't good enough to determine that source ids cannot be None
-            # here due to a check that's happening above, so we check again.
-            for source_id in source_ids:
-                if source_id is None:
-                    raise AssertionError("Source ids cannot be None here.")
+            # Update refresh timestamp
+            if uids_to_refresh:
+                record_manager.update(uids_to_refresh, time_at_least=index_start_dt)
+                num_skipped += len(uids_to_refresh)
 
-            _source_ids = cast(Sequence[str], source_ids)
+            # Be pessimistic and assume that all vector store write will fail.
+            # First write to vector store
+            if docs_to_index:
+                vector_store.add_documents(docs_to_index, ids=uids)
+                bump_index_generation(record_manager)
+                num_added += len(docs_to_index) - num_to_update
+                num_updated += num_to_update
 
-            uids_to_delete = record_manager.list_keys(
-                group_ids=_source_ids, before=index_start_dt
+            # And only then update the record store.
+            # Update ALL records, even if they already exist since we want to refresh
+            # their timestamp.
+            record_manager.update(
+                [doc.uid for doc in hashed_docs],
+                group_ids=source_ids,
+                time_at_least=index_start_dt,
             )
-            if uids_to_delete:
-                # Then delete from vector store.
-                vector_store.delete(uids_to_delete)
-                # First delete from record store.
-                record_manager.delete_keys(uids_to_delete)
-                num_deleted += len(uids_to_delete)
-
-    if cleanup == "full":
+
+            # If source IDs are provided, we can do the deletion incrementally!
+            if cleanup == "incremental":
+                # Get the uids of the documents that were not returned by the loader.
+
+                # mypy isn't good enough to determine that source ids cannot be None
+                # here due to a check that's happening above, so we check again.
+                for source_id in source_ids:
+                    if source_id is None:
+                        raise AssertionError("Source ids cannot be None here.")
+
+                _source_ids = cast(Sequence[str], source_ids)
+
+                if _can_delete_stale(record_manager, vector_store):
+                    num_deleted += _delete_stale(
+                        vector_store,
+                        record_manager,
+                        index_start_dt,
+                        _source_ids,
+                        cleanup_batch_size,
+                    )
+                    continue
+
+                uids_to_delete = record_manager.list_keys(
+                    group_ids=_source_ids, before=index_start_dt
+                )
+                if uids_to_delete:
+                    # Then delete from vector store.
+                    _delete_from_vector_store(
+                        vector_store, record_manager, uids_to_delete
+                    )
+                    # First delete from record store.
+                    record_manager.delete_keys(uids_to_delete)
+                    num_deleted += len(uids_to_delete)
+
+    if cleanup == "full" and _can_delete_stale(record_manager, vector_store):
+        num_deleted += _delete_stale(
+            vector_store,
+            record_manager,
+            index_start_dt,
+            batch_size=cleanup_batch_size,
+        )
+    elif cleanup == "full":
         while uids_to_delete := record_manager.list_keys(
             before=index_start_dt, limit=cleanup_batch_size
         ):
             # First delete from record store.
-            vector_store.delete(uids_to_delete)
+            _delete_from_vector_store(vector_store, record_manager, uids_to_delete)
             # Then delete from record manager.
             record_manager.delete_keys(uids_to_delete)
             num_deleted += len(uids_to_delete)
 
-    return {
+    indexing_result: StagedIndexingResult = {
         "num_added": num_added,
         "num_updated": num_updated,
         "num_skipped": num_skipped,
         "num_deleted": num_deleted,
     }
+    if stage_throughput is not None:
+        indexing_result["stage_throughput"] = stage_throughput
+    return indexing_result
+
+
+def _delete_from_vector_store(
+    vector_store: VectorStore, record_manager: RecordManager, uids: Sequence[str]
+) -> None:
+    # The generation is bumped on both sides of the delete, so that results
+    # cached by a retrieval racing the delete are invalidated as well
+    bump_index_generation(record_manager)
+    vector_store.delete(uids)
+    bump_index_generation(record_manager)
+
+
+def _can_delete_stale(record_manager: RecordManager, vector_store: VectorStore) -> bool:
+    return isinstance(
+        record_manager, PostgresRecordManager
+    ) and record_manager.can_delete_stale(vector_store)
+
+
+def _delete_stale(
+    vector_store: VectorStore,
+    record_manager: PostgresRecordManager,
+    before: float,
+    group_ids: Optional[Sequence[str]] = None,
+    batch_size: Optional[int] = None,
+) -> int:
+    # Records and chunks are deleted together batch by batch, so bumping the
+    # generation afterwards is enough to invalidate results cached by a racing
+    # retrieval
+    num_deleted = record_manager.delete_stale(
+        vector_store, before, group_ids, batch_size
+    )
+    if num_deleted:
+        bump_index_generation(record_manager)
+    return num_deleted
+
+
+def _refresh_sources(
+    record_manager: RecordManager, source_ids: Sequence[str], time_at_least: float
+) -> None:
+    if isinstance(record_manager, PostgresRecordManager):
+        record_manager.refresh_groups(source_ids, time_at_least=time_at_least)
+        return
+    for source_id in source_ids:
+        keys = record_manager.list_keys(group_ids=[source_id])
+        if keys:
+            record_manager.update(
+                keys, group_ids=[source_id] * len(keys), time_at_least=time_at_least
+            )
+
+
+def _delete_sources(
+    vector_store: VectorStore,
+    record_manager: RecordManager,
+    source_ids: Sequence[str],
+    before: float,
+    batch_size: int,
+) -> int:
+    if _can_delete_stale(record_manager, vector_store):
+        return _delete_stale(
+            vector_store, record_manager, before, source_ids, batch_size
+        )
+    uids_to_delete = record_manager.list_keys(group_ids=source_ids, before=before)
+    if uids_to_delete:
+        _delete_from_vector_store(vector_store, record_manager, uids_to_delete)
+        record_manager.delete_keys(uids_to_delete)
+    return len(uids_to_delete)
+
+
+def _hash_batch(
+    doc_batch: Sequence[Document],
+    source_id_assigner: Callable[[Document], Optional[str]],
+    cleanup: Literal["incremental", "full", None],
+) -> tuple[list[_HashedDocument], Sequence[Optional[str]]]:
+    hashed_docs = list(
+        _deduplicate_in_order([_HashedDocument.from_document(doc) for doc in doc_batch])
+    )
+
+    source_ids: Sequence[Optional[str]] = [
+        source_id_assigner(doc) for doc in hashed_docs
+    ]
+
+    if cleanup == "incremental":
+        # If the cleanup mode is incremental, source ids are required.
+        for source_id, hashed_doc in zip(source_ids, hashed_docs):
+            if source_id is None:
+                raise ValueError(
+                    "Source ids are required when cleanup mode is incremental. "
+                    f"Document that starts with "
+                    f"content: {hashed_doc.page_content[:100]} was not assigned "
+                    f"as source id."
+                )
+        # source ids cannot be None after for loop above.
+        source_ids = cast(Sequence[str], source_ids)  # type: ignore[assignment]
+
+    return hashed_docs, source_ids
+
+
+class _PipelineBatch:
+    """A batch of documents as it travels through the stages of the pipeline."""
+
+    def __init__(
+        self,
+        hashed_docs: list[_HashedDocument],
+        source_ids: Sequence[Optional[str]],
+    ) -> None:
+        self.hashed_docs = hashed_docs
+        self.source_ids = source_ids
+        self.uids: list[str] = []
+        self.docs_to_index: list[Document] = []
+        self.uids_to_refresh: list[str] = []
+        self.num_to_update = 0
+        self.embeddings: Optional[list[list[float]]] = None
+
+
+class _StageStats:
+    """Thread safe bookkeeping of the documents a stage processed and when."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.num_docs = 0
+        self.first_start: Optional[float] = None
+        self.last_end: Optional[float] = None
+
+    def record(self, num_docs: int, start: float, end: float) -> None:
+        with self._lock:
+            self.num_docs += num_docs
+            if self.first_start is None or start < self.first_start:
+                self.first_start = start
+            if self.last_end is None or end > self.last_end:
+                self.last_end = end
+
+    @property
+    def throughput(self) -> float:
+        if self.first_start is None or self.last_end is None:
+            return 0.0
+        elapsed = self.last_end - self.first_start
+        return self.num_docs / elapsed if elapsed > 0 else 0.0
+
+
+class _Pipeline:
+    """Worker threads connected by bounded queues.
+
+    Every stage consumes batches from its inbox and puts its results into the
+    inbox of the next stage. The bounded queues apply backpressure, so at most
+    `queue_size` batches wait in front of every stage. The first exception
+    raised by any worker stops the whole pipeline and is re-raised by `join`.
+    """
+
+    _POLL_INTERVAL = 0.1
+
+    def __init__(self) -> None:
+        self._failed = threading.Event()
+        self._errors: list[BaseException] = []
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def failed(self) -> bool:
+        return self._failed.is_set()
+
+    def put(self, inbox: queue.Queue, item: Any) -> bool:
+        while not self._failed.is_set():
+            try:
+                inbox.put(item, timeout=self._POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, inbox: queue.Queue) -> Any:
+        while not self._failed.is_set():
+            try:
+                return inbox.get(timeout=self._POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def fail(self, error: BaseException) -> None:
+        self._errors.append(error)
+        self._failed.set()
+
+    def add_stage(
+        self,
+        name: str,
+        func: Callable[[_PipelineBatch], _PipelineBatch],
+        inbox: queue.Queue,
+        outbox: Optional[queue.Queue],
+        num_workers: int,
+        num_downstream_workers: int,
+        stats: _StageStats,
+    ) -> None:
+        """Start `num_workers` threads running `func` on the batches of `inbox`.
+
+        Once the last worker of the stage has stopped, the stage hands one stop
+        marker per downstream worker to `outbox`.
+        """
+        lock = threading.Lock()
+        running = [num_workers]
+
+        def work() -> None:
+            try:
+                while (batch := self.get(inbox)) is not _STOP:
+                    start = time.perf_counter()
+                    batch = func(batch)
+                    stats.record(len(batch.hashed_docs), start, time.perf_counter())
+                    if outbox is not None and not self.put(outbox, batch):
+                        break
+            except BaseException as e:
+                self.fail(e)
+            finally:
+                with lock:
+                    running[0] -= 1
+                    is_last = running[0] == 0
+                if is_last and outbox is not None:
+                    for _ in range(num_downstream_workers):
+                        self.put(outbox, _STOP)
+
+        for i in range(num_workers):
+            thread = threading.Thread(
+                target=work, name=f"index-{name}-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+
+def _index_pipelined(
+    doc_iterator: Iterable[Document],
+    record_manager: RecordManager,
+    vector_store: VectorStore,
+    pipeline: IndexingSettings,
+    *,
+    batch_size: int,
+    cleanup: Literal["incremental", "full", None],
+    source_id_assigner: Callable[[Document], Optional[str]],
+    index_start_dt: datetime,
+    force_update: bool,
+    cleanup_batch_size: int,
+) -> StagedIndexingResult:
+    """Index the documents with overlapping hash, exists, embed and write stages.
+
+    The calling thread hashes and deduplicates batches and feeds them into the
+    pipeline, while the record manager lookups, the embedding and the writes run
+    on their own worker threads. Embedding is only split off from the write if
+    the vector store accepts precomputed embeddings through `add_embeddings`,
+    otherwise `add_documents` embeds as part of the write stage.
+
+    The ordering guarantees of the sequential mode hold per batch: a batch is
+    written to the vector store before its records are updated in the record
+    manager.
+    """
+    for name in ("queue_size", "exists_workers", "embed_workers", "write_workers"):
+        if getattr(pipeline, name) < 1:
+            raise ValueError(
+                f"{name} should be at least 1. Got {getattr(pipeline, name)}."
+            )
+
+    embeddings = vector_store.embeddings
+    can_embed_separately = embeddings is not None and hasattr(
+        vector_store, "add_embeddings"
+    )
+
+    delete_stale = _can_delete_stale(record_manager, vector_store)
+    counts_lock = threading.Lock()
+    counts = {"num_added": 0, "num_updated": 0, "num_skipped": 0, "num_deleted": 0}
+
+    def count(key: str, value: int) -> None:
+        with counts_lock:
+            counts[key] += value
+
+    # Batches are looked up ahead of the writes of earlier batches. The incremental
+    # cleanup of an earlier batch must therefore not interleave with the lookup and
+    # refresh of a later one, or it deletes documents the later batch just skipped.
+    cleanup_lock = threading.RLock() if cleanup == "incremental" else nullcontext()
+    # Documents rewritten by force_update keep the timestamps of their records
+    # until the records are updated after the write. Another write worker's
+    # cleanup of the same sources must not run in between, or it deletes the
+    # vectors just written and leaves records without them.
+    write_lock = (
+        cleanup_lock
+        if force_update and cleanup == "incremental" and pipeline.write_workers > 1
+        else nullcontext()
+    )
+    # Uids of documents queued for writing, so that a document repeated in a later
+    # batch is not written twice before the record manager knows about it.
+    in_flight_lock = threading.Lock()
+    in_flight: set[str] = set()
+
+    def lookup(batch: _PipelineBatch) -> _PipelineBatch:
+        with cleanup_lock:
+            exists_batch = record_manager.exists(
+                [doc.uid for doc in batch.hashed_docs]
+            )
+            hashed_docs = []
+            source_ids = []
+            num_in_flight = 0
+            with in_flight_lock:
+                for hashed_doc, source_id, doc_exists in zip(
+                    batch.hashed_docs, batch.source_ids, exists_batch
+                ):
+                    if hashed_doc.uid in in_flight:
+                        num_in_flight += 1
+                        continue
+                    hashed_docs.append(hashed_doc)
+                    source_ids.append(source_id)
+                    # Filter out documents that already exist in the record store.
+                    if doc_exists and not force_update:
+                        batch.uids_to_refresh.append(hashed_doc.uid)
+                        continue
+                    # Rewritten although already indexed
+                    batch.num_to_update += doc_exists
+                    in_flight.add(hashed_doc.uid)
+                    batch.uids.append(hashed_doc.uid)
+                    batch.docs_to_index.append(hashed_doc.to_document())
+            batch.hashed_docs = hashed_docs
+            batch.source_ids = source_ids
+
+            # Update refresh timestamp
+            if batch.uids_to_refresh:
+                record_manager.update(
+                    batch.uids_to_refresh, time_at_least=index_start_dt
+                )
+        count("num_skipped", len(batch.uids_to_refresh) + num_in_flight)
+        return batch
+
+    def embed(batch: _PipelineBatch) -> _PipelineBatch:
+        if can_embed_separately and batch.docs_to_index:
+            batch.embeddings = embeddings.embed_documents(
+                [doc.page_content for doc in batch.docs_to_index]
+            )
+        return batch
+
+    def write(batch: _PipelineBatch) -> _PipelineBatch:
+        with write_lock:
+            # Be pessimistic and assume that all vector store write will fail.
+            # First write to vector store
+            if batch.docs_to_index:
+                if batch.embeddings is not None:
+                    vector_store.add_embeddings(
+                        texts=[doc.page_content for doc in batch.docs_to_index],
+                        embeddings=batch.embeddings,
+                        metadatas=[doc.metadata for doc in batch.docs_to_index],
+                        ids=batch.uids,
+                    )
+                else:
+                    vector_store.add_documents(batch.docs_to_index, ids=batch.uids)
+                bump_index_generation(record_manager)
+                count("num_added", len(batch.docs_to_index) - batch.num_to_update)
+                count("num_updated", batch.num_to_update)
+
+            # And only then update the record store. Empty if all documents of
+            # the batch were in flight already.
+            if batch.hashed_docs:
+                record_manager.update(
+                    [doc.uid for doc in batch.hashed_docs],
+                    group_ids=batch.source_ids,
+                    time_at_least=index_start_dt,
+                )
+            with in_flight_lock:
+                in_flight.difference_update(batch.uids)
+
+        if cleanup == "incremental" and delete_stale:
+            with cleanup_lock:
+                count(
+                    "num_deleted",
+                    _delete_stale(
+                        vector_store,
+                        record_manager,
+                        index_start_dt,
+                        cast(Sequence[str], batch.source_ids),
+                        cleanup_batch_size,
+                    ),
+                )
+        elif cleanup == "incremental":
+            with cleanup_lock:
+                uids_to_delete = record_manager.list_keys(
+                    group_ids=cast(Sequence[str], batch.source_ids),
+                    before=index_start_dt,
+                )
+                if uids_to_delete:
+                    _delete_from_vector_store(
+                        vector_store, record_manager, uids_to_delete
+                    )
+                    record_manager.delete_keys(uids_to_delete)
+                    count("num_deleted", len(uids_to_delete))
+        return batch
+
+    stages = [
+        ("exists", lookup, pipeline.exists_workers),
+        ("embed", embed, pipeline.embed_workers),
+        ("write", write, pipeline.write_workers),
+    ]
+    inboxes = [queue.Queue(maxsize=pipeline.queue_size) for _ in stages]
+    stats = {"hash": _StageStats(), **{name: _StageStats() for name, _, _ in stages}}
+
+    runner = _Pipeline()
+    for i, (name, func, num_workers) in enumerate(stages):
+        is_last = i == len(stages) - 1
+        runner.add_stage(
+            name,
+            func,
+            inboxes[i],
+            None if is_last else inboxes[i + 1],
+            num_workers,
+            0 if is_last else stages[i + 1][2],
+            stats[name],
+        )
+
+    try:
+        for doc_batch in _batch(batch_size, doc_iterator):
+            start = time.perf_counter()
+            hashed_docs, source_ids = _hash_batch(
+                doc_batch, source_id_assigner, cleanup
+            )
+            stats["hash"].record(len(hashed_docs), start, time.perf_counter())
+            if not runner.put(inboxes[0], _PipelineBatch(hashed_docs, source_ids)):
+                break
+    except BaseException as e:
+        runner.fail(e)
+    finally:
+        for _ in range(pipeline.exists_workers):
+            runner.put(inboxes[0], _STOP)
+        runner.join()
+
+    return {
+        **counts,
+        "stage_throughput": {name: stage.throughput for name, stage in stats.items()},
+    }
@@ -0,0 +1,94 @@
+"""Module to load and transform the documents of several sources concurrently"""
+
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence
+
+from langchain_core.documents import Document
+
+# A picklable function and its arguments, returning the transformed documents
+TransformTask = tuple[Callable[..., list[Document]], tuple[Any, ...]]
+
+_SOURCE_DONE = object()
+_POLL_INTERVAL = 0.1
+
+
+def transform_concurrently(
+    task_sources: Sequence[Iterable[TransformTask]],
+    workers: int,
+    source_concurrency: int,
+    queue_size: int,
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: tuple[Any, ...] = (),
+) -> Iterator[Document]:
+    """Run the transform tasks of several sources on a process pool.
+
+    Every source is iterated on its own loader thread, up to `source_concurrency`
+    at a time, so that fetching from one source overlaps with fetching from the
+    others. The tasks a source yields, e.g. parsing a page or splitting a file,
+    are CPU bound and run on a pool of `workers` processes, each set up with
+    `initializer`. With `workers=0` the tasks run on the loader threads instead.
+
+    At most `queue_size` tasks are in flight: loader threads block once the
+    consumer falls behind, so memory stays bounded. Documents are yielded in the
+    order the tasks were submitted per source, interleaved across sources.
+    """
+    if workers == 0 and initializer is not None:
+        initializer(*initargs)
+
+    results: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def load(tasks: Iterable[TransformTask], pool: Optional[ProcessPoolExecutor]):
+        try:
+            for func, args in tasks:
+                if pool is not None:
+                    future = pool.submit(func, *args)
+                else:
+                    future = Future()
+                    future.set_result(func(*args))
+                if not put(future):
+                    return
+        except BaseException as e:
+            put(e)
+        finally:
+            put(_SOURCE_DONE)
+
+    pool = (
+        ProcessPoolExecutor(
+            max_workers=workers, initializer=initializer, initargs=initargs
+        )
+        if workers > 0
+        else None
+    )
+    loaders = ThreadPoolExecutor(
+        max_workers=source_concurrency, thread_name_prefix="ingest-loader"
+    )
+    try:
+        for tasks in task_sources:
+            loaders.submit(load, tasks, pool)
+
+        num_done = 0
+        while num_done < len(task_sources):
+            item = results.get()
+            if item is _SOURCE_DONE:
+                num_done += 1
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                yield from item.result()
+    finally:
+        stop.set()
+        loaders.shutdown(wait=True, cancel_futures=True)
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
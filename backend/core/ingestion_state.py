@@ -0,0 +1,113 @@
+"""Module to remember which state of the git and sitemap sources was ingested"""
+
+from typing import Optional
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+INGESTED_COMMIT_TABLE = "ingested_commit"
+INGESTED_PAGE_TABLE = "ingested_page"
+
+_metadata = sa.MetaData()
+ingested_commit_table = sa.Table(
+    INGESTED_COMMIT_TABLE,
+    _metadata,
+    sa.Column("namespace", sa.String, primary_key=True),
+    sa.Column("clone_url", sa.String, primary_key=True),
+    sa.Column("commit_sha", sa.String, nullable=False),
+)
+ingested_page_table = sa.Table(
+    INGESTED_PAGE_TABLE,
+    _metadata,
+    sa.Column("namespace", sa.String, primary_key=True),
+    sa.Column("sitemap_url", sa.String, primary_key=True),
+    sa.Column("url", sa.String, primary_key=True),
+    sa.Column("content_hash", sa.String, nullable=False),
+)
+
+
+def get_ingested_commit(
+    engine: Engine, namespace: str, clone_url: str
+) -> Optional[str]:
+    """The last commit of the repository ingested into the namespace, if any.
+
+    The commits live next to the records of the namespace, so they are lost
+    together with them.
+    """
+    _metadata.create_all(engine)
+    with engine.connect() as connection:
+        return connection.execute(
+            sa.select(ingested_commit_table.c.commit_sha).where(
+                ingested_commit_table.c.namespace == namespace,
+                ingested_commit_table.c.clone_url == clone_url,
+            )
+        ).scalar()
+
+
+def set_ingested_commit(
+    engine: Engine, namespace: str, clone_url: str, commit_sha: str
+) -> None:
+    _metadata.create_all(engine)
+    insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(ingested_commit_table).values(
+        namespace=namespace, clone_url=clone_url, commit_sha=commit_sha
+    )
+    with engine.begin() as connection:
+        connection.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[
+                    ingested_commit_table.c.namespace,
+                    ingested_commit_table.c.clone_url,
+                ],
+                set_={"commit_sha": commit_sha},
+            )
+        )
+
+
+def get_ingested_pages(
+    engine: Engine, namespace: str, sitemap_url: str
+) -> dict[str, str]:
+    """The content hashes by url of the pages of the sitemap last ingested."""
+    _metadata.create_all(engine)
+    with engine.connect() as connection:
+        rows = connection.execute(
+            sa.select(ingested_page_table.c.url, ingested_page_table.c.content_hash)
+            .where(ingested_page_table.c.namespace == namespace)
+            .where(ingested_page_table.c.sitemap_url == sitemap_url)
+        )
+        return {row.url: row.content_hash for row in rows}
+
+
+def set_ingested_pages(
+    engine: Engine, namespace: str, sitemap_url: str, content_hashes: dict[str, str]
+) -> None:
+    """Replace the ingested pages of the sitemap."""
+    _metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            sa.delete(ingested_page_table)
+            .where(ingested_page_table.c.namespace == namespace)
+            .where(ingested_page_table.c.sitemap_url == sitemap_url)
+        )
+        if content_hashes:
+            connection.execute(
+                sa.insert(ingested_page_table),
+                [
+                    {
+                        "namespace": namespace,
+                        "sitemap_url": sitemap_url,
+                        "url": url,
+                        "content_hash": content_hash,
+                    }
+                    for url, content_hash in content_hashes.items()
+                ],
+            )
+
+
+def clear_ingestion_state(engine: Engine, namespace: str) -> None:
+    """Forget the ingested commits and pages, e.g. after the records were purged."""
+    _metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table in (ingested_commit_table, ingested_page_table):
+            connection.execute(sa.delete(table).where(table.c.namespace == namespace))
@@ -0,0 +1,97 @@
+"""Module to store the metadata of the chunks as indexed jsonb"""
+
+import logging
+
+import sqlalchemy as sa
+from core.vector_index import EMBEDDING_TABLE
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+METADATA_INDEX = f"ix_{EMBEDDING_TABLE}_cmetadata"
+SOURCE_TITLE_INDEX = f"ix_{EMBEDDING_TABLE}_source_title"
+
+# Serializes the schema changes of concurrently starting API workers and ingests
+_METADATA_INDEX_LOCK_ID = 1_829_441_339
+
+
+def _get_column_type(connection: sa.Connection) -> str:
+    return connection.execute(
+        sa.text(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = CAST(:table AS regclass) AND attname = 'cmetadata'"
+        ),
+        {"table": EMBEDDING_TABLE},
+    ).scalar_one()
+
+
+def create_metadata_index(engine: Engine) -> bool:
+    """Convert the metadata column to jsonb and index it for containment, if needed.
+
+    PGVector creates the column as json, which can neither be indexed nor
+    compared. As jsonb with a `jsonb_path_ops` GIN index, the `@>` filters of
+    the retrievers look the matching chunks up instead of scanning all of them.
+    The conversion rewrites the table once, best done on an empty table before
+    the first ingest. A btree index of the sources and titles per collection
+    lets a page of the document references read its sources in order and stop
+    at the limit.
+
+    Returns:
+        Whether the column was converted or the index created.
+    """
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        if connection.execute(
+            sa.text("SELECT to_regclass(:name) IS NULL"), {"name": EMBEDDING_TABLE}
+        ).scalar_one():
+            logger.warning(f"Table {EMBEDDING_TABLE} does not exist yet.")
+            return False
+        connection.execute(
+            sa.text("SELECT pg_advisory_lock(:id)"), {"id": _METADATA_INDEX_LOCK_ID}
+        )
+        # The rewrite and the index build outlast the timeout of the shared engines
+        connection.execute(sa.text("SET statement_timeout = 0"))
+        try:
+            created = False
+            if _get_column_type(connection) != "jsonb":
+                logger.info("Converting the metadata column to jsonb")
+                connection.execute(
+                    sa.text(
+                        f"ALTER TABLE {EMBEDDING_TABLE} ALTER COLUMN cmetadata "
+                        "TYPE jsonb USING CAST(cmetadata AS jsonb)"
+                    )
+                )
+                created = True
+            if connection.execute(
+                sa.text("SELECT to_regclass(:name) IS NULL"), {"name": METADATA_INDEX}
+            ).scalar_one():
+                logger.info(f"Building GIN index {METADATA_INDEX}")
+                connection.execute(
+                    sa.text(
+                        f"CREATE INDEX CONCURRENTLY {METADATA_INDEX} "
+                        f"ON {EMBEDDING_TABLE} USING gin (cmetadata jsonb_path_ops)"
+                    )
+                )
+                created = True
+            if connection.execute(
+                sa.text("SELECT to_regclass(:name) IS NULL"),
+                {"name": SOURCE_TITLE_INDEX},
+            ).scalar_one():
+                logger.info(f"Building index {SOURCE_TITLE_INDEX}")
+                # The expressions of `core.document_sources`
+                connection.execute(
+                    sa.text(
+                        f"CREATE INDEX CONCURRENTLY {SOURCE_TITLE_INDEX} "
+                        f"ON {EMBEDDING_TABLE} (collection_id, "
+                        "(COALESCE(cmetadata->>'source', '')), "
+                        "(COALESCE(cmetadata->>'title', '')))"
+                    )
+                )
+                created = True
+            return created
+        finally:
+            connection.execute(sa.text("RESET statement_timeout"))
+            connection.execute(
+                sa.text("SELECT pg_advisory_unlock(:id)"),
+                {"id": _METADATA_INDEX_LOCK_ID},
+            )
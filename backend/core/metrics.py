@@ -0,0 +1,17 @@
+"""Module to collect runtime metrics of long lived components"""
+
+from typing import Any, Callable
+
+_providers: dict[str, Callable[[], dict[str, Any]]] = {}
+
+
+def register_metrics(name: str, provider: Callable[[], dict[str, Any]]) -> None:
+    """Register a callable returning a snapshot of the metrics of a component.
+
+    Registering under an existing name replaces the previous provider.
+    """
+    _providers[name] = provider
+
+
+def get_metrics() -> dict[str, dict[str, Any]]:
+    return {name: provider() for name, provider in _providers.items()}
@@ -0,0 +1,232 @@
+"""Module to embed with an ONNX Runtime export of a sentence-transformers model
+
+Needs the optional `onnxruntime` package, `pip install onnxruntime`. The export
+itself runs once per model with torch and sentence-transformers.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from langchain_community.embeddings.huggingface import (
+    DEFAULT_QUERY_BGE_INSTRUCTION_EN,
+    DEFAULT_QUERY_BGE_INSTRUCTION_ZH,
+)
+
+logger = logging.getLogger(__name__)
+
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model_int8.onnx"
+CONFIG_FILE = "embedding_config.json"
+
+# Inputs of the exported transformer, in the order of its forward arguments
+_INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+# Texts the export is compared on, short and long
+_CHECK_TEXTS = [
+    "How do I use a retriever?",
+    "LangChain Expression Language composes runnables into chains with the pipe "
+    "operator, streaming and batching come for free.",
+    "def format_docs(docs):\n    return '\\n'.join(doc.page_content for doc in docs)",
+    " ".join(["Vector stores index the embeddings of the chunks."] * 40),
+]
+
+
+def get_model_dir(onnx_path: str, model_name: str) -> Path:
+    return Path(onnx_path) / model_name.replace("/", "--")
+
+
+def _get_pooling(model) -> str:
+    pooling = model[1].get_pooling_mode_str()
+    if pooling not in ("cls", "mean"):
+        raise ValueError(f"Pooling {pooling} of the model is not supported.")
+    return pooling
+
+
+def min_cosine_similarity(
+    reference: list[list[float]], candidate: list[list[float]]
+) -> float:
+    """Smallest cosine similarity of the corresponding vectors of two backends."""
+    a, b = np.asarray(reference), np.asarray(candidate)
+    similarities = (a * b).sum(axis=1) / (
+        np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    )
+    return float(similarities.min())
+
+
+def export_model(
+    model_name: str, onnx_path: str, quantize: bool, min_similarity: float
+) -> Path:
+    """Export the transformer of a sentence-transformers model to ONNX, if missing.
+
+    With `quantize`, the weights of the linear layers are additionally quantized
+    to int8 (dynamic quantization). The export is compared with the
+    sentence-transformers model on a few texts; it is rejected if any pair of
+    vectors has a cosine similarity below `min_similarity`.
+
+    Returns:
+        The directory with the model, its tokenizer and pooling configuration.
+    """
+    model_dir = get_model_dir(onnx_path, model_name)
+    model_file = QUANTIZED_MODEL_FILE if quantize else MODEL_FILE
+    if (model_dir / model_file).exists() and (model_dir / CONFIG_FILE).exists():
+        return model_dir
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    logger.info(f"Exporting {model_name} to {model_dir / model_file}")
+    model_dir.mkdir(parents=True, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer, tokenizer = model[0].auto_model, model.tokenizer
+    if not (model_dir / MODEL_FILE).exists():
+        encoded = tokenizer(["warmup"], return_tensors="pt")
+        input_names = [name for name in _INPUT_NAMES if name in encoded]
+        torch.onnx.export(
+            transformer,
+            tuple(encoded[name] for name in input_names),
+            str(model_dir / MODEL_FILE),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                name: {0: "batch", 1: "sequence"}
+                for name in input_names + ["last_hidden_state"]
+            },
+            opset_version=14,
+        )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            str(model_dir / MODEL_FILE),
+            str(model_dir / QUANTIZED_MODEL_FILE),
+            weight_type=QuantType.QInt8,
+        )
+    tokenizer.save_pretrained(str(model_dir))
+    config = {"pooling": _get_pooling(model), "max_length": model.max_seq_length}
+
+    exported = OnnxEmbeddings(
+        model_dir, model_file, config, batch_size=8, threads=0, normalize=True
+    )
+    similarity = min_cosine_similarity(
+        model.encode(_CHECK_TEXTS, normalize_embeddings=True).tolist(),
+        exported.embed_documents(_CHECK_TEXTS),
+    )
+    if similarity < min_similarity:
+        (model_dir / model_file).unlink()
+        raise ValueError(
+            f"The export of {model_name} deviates from the model, cosine "
+            f"similarity {similarity:.4f} is below {min_similarity}."
+        )
+    logger.info(f"Export matches the model, min cosine similarity {similarity:.4f}")
+    # Written last, its presence marks a complete and checked export
+    (model_dir / CONFIG_FILE).write_text(json.dumps(config))
+    return model_dir
+
+
+class OnnxEmbeddings(Embeddings):
+    """Embeddings of an ONNX Runtime export, see `export_model`.
+
+    Texts are tokenized once, sorted by their token count and encoded in
+    batches of `batch_size` padded to their longest text only, so a batch of
+    short queries does not pay for the longest chunk. `threads` is the intra-op
+    thread count of the session, the runtime default if 0. A warmup run on load
+    keeps the allocations off the first request. Queries are prefixed with the
+    instruction of the BGE models like by `HuggingFaceBgeEmbeddings`.
+    """
+
+    def __init__(
+        self,
+        model_dir: Path,
+        model_file: str,
+        config: Optional[dict] = None,
+        batch_size: int = 32,
+        threads: int = 0,
+        normalize: bool = True,
+    ) -> None:
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(
+                "The onnx embedding backend needs the onnxruntime package, "
+                "install it with `pip install onnxruntime`."
+            ) from e
+        from transformers import AutoTokenizer
+
+        if config is None:
+            config = json.loads((model_dir / CONFIG_FILE).read_text())
+        self.pooling: str = config["pooling"]
+        self.max_length: int = config["max_length"]
+        self.batch_size = batch_size
+        self.normalize = normalize
+        self.query_instruction = (
+            DEFAULT_QUERY_BGE_INSTRUCTION_ZH
+            if "-zh" in model_dir.name
+            else DEFAULT_QUERY_BGE_INSTRUCTION_EN
+        )
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            str(model_dir / model_file), options, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = [input.name for input in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        self._encode(["warmup"])
+
+    def _pad(self, encodings: dict[str, list[list[int]]]) -> dict[str, np.ndarray]:
+        # To the longest sequence of the batch only
+        lengths = [len(ids) for ids in encodings["input_ids"]]
+        padded = {}
+        for name, sequences in encodings.items():
+            pad_id = self.tokenizer.pad_token_id if name == "input_ids" else 0
+            array = np.full((len(sequences), max(lengths)), pad_id, dtype=np.int64)
+            for row, (sequence, length) in enumerate(zip(sequences, lengths)):
+                array[row, :length] = sequence
+            padded[name] = array
+        return padded
+
+    def _encode_batch(self, encodings: dict[str, list[list[int]]]) -> np.ndarray:
+        padded = self._pad(encodings)
+        hidden = self.session.run(
+            None, {name: padded[name] for name in self._input_names}
+        )[0]
+        if self.pooling == "cls":
+            vectors = hidden[:, 0]
+        else:
+            mask = padded["attention_mask"][..., None].astype(hidden.dtype)
+            vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self.normalize:
+            vectors = vectors / np.maximum(
+                np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12
+            )
+        return vectors
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        encodings = self.tokenizer(
+            texts, truncation=True, max_length=self.max_length, padding=False
+        )
+        order = sorted(range(len(texts)), key=lambda i: len(encodings["input_ids"][i]))
+        vectors: Optional[np.ndarray] = None
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            batch_vectors = self._encode_batch(
+                {name: [encodings[name][i] for i in batch] for name in encodings.keys()}
+            )
+            if vectors is None:
+                vectors = np.empty((len(texts), batch_vectors.shape[1]), np.float32)
+            vectors[batch] = batch_vectors
+        return vectors
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self._encode([text.replace("\n", " ") for text in texts]).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        text = text.replace("\n", " ")
+        return self._encode([self.query_instruction + text])[0].tolist()
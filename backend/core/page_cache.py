@@ -0,0 +1,201 @@
+"""Module to fetch web pages conditionally into a local content addressed cache"""
+
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedPage:
+    url: str
+    content_hash: str
+    encoding: Optional[str]
+    # Validators of the last response, for conditional requests
+    etag: Optional[str]
+    last_modified: Optional[str]
+    # The lastmod of the page in the sitemap when it was fetched
+    lastmod: Optional[str]
+
+
+@dataclass
+class FetchResult:
+    url: str
+    # None if the page could not be fetched and was never cached
+    content_hash: Optional[str]
+    status: Literal["lastmod", "not_modified", "fetched", "failed"]
+
+
+class PageCache:
+    """Pages on disk by the sha256 of their content, with the validators per url.
+
+    The contents live at `<root>/objects/<hash[:2]>/<hash>`, so a page moved to
+    another url, or changed back, is not stored twice. The validators of the
+    last fetch of each url live in `<root>/index.sqlite`.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+        (self.root / "objects").mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.root / "index.sqlite", check_same_thread=False
+        )
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS page ("
+                "url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, encoding TEXT, "
+                "etag TEXT, last_modified TEXT, lastmod TEXT)"
+            )
+
+    def _object_path(self, content_hash: str) -> Path:
+        return self.root / "objects" / content_hash[:2] / content_hash
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        """The page last fetched from the url, if its content is still cached."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT url, content_hash, encoding, etag, last_modified, lastmod "
+                "FROM page WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None or not self._object_path(row[1]).exists():
+            return None
+        return CachedPage(*row)
+
+    def put(self, page: CachedPage) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO page VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    page.url,
+                    page.content_hash,
+                    page.encoding,
+                    page.etag,
+                    page.last_modified,
+                    page.lastmod,
+                ),
+            )
+
+    def write(self, content: bytes) -> str:
+        """Store the content, returning its hash."""
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self._object_path(content_hash)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # Written aside and renamed, a crash never leaves a partial object
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(content)
+            tmp_path.replace(path)
+        return content_hash
+
+    def read_text(self, content_hash: str, encoding: Optional[str] = None) -> str:
+        return (
+            self._object_path(content_hash)
+            .read_bytes()
+            .decode(encoding or "utf-8", errors="replace")
+        )
+
+
+class HostRateLimiter:
+    """Spaces the requests to each host at least 1 / `requests_per_second` apart."""
+
+    def __init__(self, requests_per_second: float) -> None:
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0.0
+        self._next_at: dict[str, float] = {}
+
+    async def wait(self, url: str) -> None:
+        host = urlparse(url).netloc
+        now = asyncio.get_running_loop().time()
+        at = max(now, self._next_at.get(host, now))
+        # Reserved before sleeping, concurrent callers queue up behind each other
+        self._next_at[host] = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+async def _fetch_page(
+    session: aiohttp.ClientSession,
+    cache: PageCache,
+    url: str,
+    lastmod: Optional[str],
+    semaphore: asyncio.Semaphore,
+    rate_limiter: HostRateLimiter,
+) -> FetchResult:
+    cached = cache.get(url)
+    if cached is not None and lastmod is not None and cached.lastmod == lastmod:
+        return FetchResult(url, cached.content_hash, "lastmod")
+
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+    async with semaphore:
+        await rate_limiter.wait(url)
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304 and cached is not None:
+                    cached.etag = response.headers.get("ETag", cached.etag)
+                    cached.last_modified = response.headers.get(
+                        "Last-Modified", cached.last_modified
+                    )
+                    cached.lastmod = lastmod
+                    cache.put(cached)
+                    return FetchResult(url, cached.content_hash, "not_modified")
+                response.raise_for_status()
+                content = await response.read()
+                page = CachedPage(
+                    url=url,
+                    content_hash=cache.write(content),
+                    encoding=response.charset,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                    lastmod=lastmod,
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Error fetching {url}: {e!r}")
+            # A stale page is better than dropping the page from the index
+            return FetchResult(
+                url, cached.content_hash if cached is not None else None, "failed"
+            )
+    cache.put(page)
+    return FetchResult(url, page.content_hash, "fetched")
+
+
+async def fetch_pages(
+    pages: list[tuple[str, Optional[str]]],
+    cache: PageCache,
+    concurrency: int,
+    requests_per_second: float,
+    timeout_seconds: float = 30.0,
+) -> list[FetchResult]:
+    """Bring the cached pages up to date, by url and sitemap lastmod.
+
+    A page whose sitemap lastmod equals the one of its cached fetch is not
+    requested at all. Others are requested with the ETag and Last-Modified of
+    the cached fetch, so unchanged ones answer 304 without a body. At most
+    `concurrency` requests are in flight, and requests to a host are rate
+    limited.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    rate_limiter = HostRateLimiter(requests_per_second)
+    async with aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=timeout_seconds)
+    ) as session:
+        return await asyncio.gather(
+            *[
+                _fetch_page(session, cache, url, lastmod, semaphore, rate_limiter)
+                for url, lastmod in pages
+            ]
+        )
@@ -1,7 +1,18 @@
 import re
-from typing import Generator
+from typing import Generator, Optional
 
+import lxml.html
 from bs4 import BeautifulSoup, Doctype, NavigableString, Tag
+from lxml import etree
+
+# The tags of a docs page the extraction needs, for a SoupStrainer
+LANGCHAIN_DOCS_TAGS = ("article", "title", "html", "lang", "content")
+
+# Tags whose strings BeautifulSoup gives their own string type, which get_text of
+# any other tag skips
+_STRING_CONTAINERS = frozenset(["rt", "rp", "style", "script", "template"])
+_PRESERVE_WHITESPACE_TAGS = frozenset(["pre", "textarea"])
+_ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
 
 
 def langchain_docs_extractor(soup: BeautifulSoup) -> str:
@@ -108,3 +119,204 @@ def langchain_docs_extractor(soup: BeautifulSoup) -> str:
 
     joined = "".join(get_text(soup))
     return re.sub(r"\n\n+", "\n\n", joined).strip()
+
+
+def parse_html(html: str) -> lxml.html.HtmlElement:
+    """Parse html into the tree BeautifulSoup builds with its "lxml" parser.
+
+    Strings of ASCII whitespace outside of pre and textarea are collapsed into
+    one newline or space, as BeautifulSoup does.
+    """
+    parser = lxml.html.HTMLParser(encoding="utf-8")
+    try:
+        root = lxml.html.document_fromstring(html.encode("utf-8"), parser=parser)
+    except etree.ParserError:
+        # The document is empty
+        return lxml.html.Element("html")
+    _collapse_whitespace(root, False)
+    return root
+
+
+def _collapse_whitespace(element: lxml.html.HtmlElement, preserve: bool) -> None:
+    if element.tag in _PRESERVE_WHITESPACE_TAGS:
+        preserve = True
+    if not preserve:
+        if element.text and not element.text.strip(_ASCII_SPACES):
+            element.text = "\n" if "\n" in element.text else " "
+        for child in element:
+            if child.tag is etree.Comment:
+                if child.text and not child.text.strip(_ASCII_SPACES):
+                    child.text = "\n" if "\n" in child.text else " "
+            if child.tail and not child.tail.strip(_ASCII_SPACES):
+                child.tail = "\n" if "\n" in child.tail else " "
+    for child in element:
+        if isinstance(child.tag, str):
+            _collapse_whitespace(child, preserve)
+
+
+def get_lxml_text(element: lxml.html.HtmlElement, strip: bool = False) -> str:
+    """The text of an element, as `Tag.get_text` returns it for the same element.
+
+    Comments are skipped, as are strings within the string containers, unless the
+    element is such a container itself.
+    """
+    wanted = element.tag if element.tag in _STRING_CONTAINERS else None
+    container = None
+    for node in element.iterancestors(*_STRING_CONTAINERS):
+        container = node.tag
+        break
+    parts: list[str] = []
+    _collect_text(element, wanted, container, strip, parts)
+    return "".join(parts)
+
+
+def _collect_text(
+    element: lxml.html.HtmlElement,
+    wanted: Optional[str],
+    container: Optional[str],
+    strip: bool,
+    parts: list[str],
+) -> None:
+    if element.tag in _STRING_CONTAINERS:
+        container = element.tag
+
+    def add(text: Optional[str]) -> None:
+        if text and container == wanted:
+            if strip:
+                text = text.strip()
+                if not text:
+                    return
+            parts.append(text)
+
+    add(element.text)
+    for child in element:
+        if isinstance(child.tag, str):
+            _collect_text(child, wanted, container, strip, parts)
+        add(child.tail)
+
+
+def _has_class(element: lxml.html.HtmlElement, name: str) -> bool:
+    return name in element.get("class", "").split()
+
+
+def langchain_docs_extractor_lxml(root: lxml.html.HtmlElement) -> str:
+    """`langchain_docs_extractor` on an lxml tree, producing the same markdown.
+
+    Expects the root of a document parsed with `parse_html`. The tree is walked
+    once, without the repeated searches of the BeautifulSoup version.
+    """
+    SCAPE_TAGS = ["nav", "footer", "aside", "script", "style"]
+    for element in list(root.iter(*SCAPE_TAGS)):
+        element.drop_tree()
+
+    parts: list[str] = []
+    out = parts.append
+
+    def walk(element: lxml.html.HtmlElement) -> None:
+        if element.text:
+            out(element.text)
+        for child in element:
+            name = child.tag
+            if not isinstance(name, str):
+                # Comments and processing instructions, BeautifulSoup keeps them
+                # as strings
+                if name is etree.ProcessingInstruction:
+                    out(f"{child.target} {child.text or ''}")
+                elif child.text:
+                    out(child.text)
+            elif name in ("h1", "h2", "h3", "h4", "h5", "h6"):
+                out(f"{'#' * int(name[1:])} {get_lxml_text(child)}\n\n")
+            elif name == "a":
+                out(f"[{get_lxml_text(child)}]({child.get('href')})")
+            elif name == "img":
+                out(f"![{child.get('alt', '')}]({child.get('src')})")
+            elif name in ("strong", "b"):
+                out(f"**{get_lxml_text(child)}**")
+            elif name in ("em", "i"):
+                out(f"_{get_lxml_text(child)}_")
+            elif name == "br":
+                out("\n")
+            elif name == "code":
+                parent = child.getparent()
+                if parent is not None and parent.tag == "pre":
+                    language = next(
+                        (
+                            x
+                            for x in parent.get("class", "").split()
+                            if re.match(r"language-\w+", x)
+                        ),
+                        None,
+                    )
+                    language = "" if language is None else language.split("-")[1]
+                    lines = [
+                        "".join(
+                            get_lxml_text(token)
+                            for token in span.iterdescendants("span")
+                        )
+                        for span in child.iterdescendants("span")
+                        if _has_class(span, "token-line")
+                    ]
+                    code_content = "\n".join(lines)
+                    out(f"```{language}\n{code_content}\n```\n\n")
+                else:
+                    out(f"`{get_lxml_text(child)}`")
+            elif name == "p":
+                walk(child)
+                out("\n\n")
+            elif name == "ul":
+                for li in child:
+                    if li.tag == "li":
+                        out("- ")
+                        walk(li)
+                        out("\n\n")
+            elif name == "ol":
+                items = [li for li in child if li.tag == "li"]
+                for i, li in enumerate(items):
+                    out(f"{i + 1}. ")
+                    walk(li)
+                    out("\n\n")
+            elif name == "div" and _has_class(child, "tabs-container"):
+                tabs = [
+                    li for li in child.iterdescendants("li") if li.get("role") == "tab"
+                ]
+                tab_panels = [
+                    div
+                    for div in child.iterdescendants("div")
+                    if div.get("role") == "tabpanel"
+                ]
+                for tab, tab_panel in zip(tabs, tab_panels):
+                    out(f"{get_lxml_text(tab, strip=True)}\n")
+                    walk(tab_panel)
+            elif name == "table":
+                thead = next(child.iterdescendants("thead"), None)
+                if thead is not None:
+                    headers = list(thead.iterdescendants("th"))
+                    if headers:
+                        out("| ")
+                        out(" | ".join(get_lxml_text(header) for header in headers))
+                        out(" |\n")
+                        out("| ")
+                        out(" | ".join("----" for _ in headers))
+                        out(" |\n")
+
+                tbody = next(child.iterdescendants("tbody"), None)
+                if tbody is not None:
+                    for row in tbody.iterdescendants("tr"):
+                        out("| ")
+                        out(
+                            " | ".join(
+                                get_lxml_text(cell, strip=True)
+                                for cell in row.iterdescendants("td")
+                            )
+                        )
+                        out(" |\n")
+
+                out("\n\n")
+            elif name != "button":
+                walk(child)
+            if child.tail:
+                out(child.tail)
+
+    walk(root)
+    joined = "".join(parts)
+    return re.sub(r"\n\n+", "\n\n", joined).strip()
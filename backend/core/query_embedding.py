@@ -0,0 +1,180 @@
+"""Module to embed queries with an in-process cache and micro-batching"""
+
+import asyncio
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Generic, Optional, TypeVar
+
+from langchain.schema.embeddings import Embeddings
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """Coalesces concurrent single item calls into one batched call.
+
+    A background thread collects the items submitted within `window` seconds of
+    the first one, up to `max_batch_size`, and passes them to `func` in one call.
+    While a batch runs, new items queue up for the next one. `submit` blocks the
+    calling thread until the result of its item is available.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[list[T]], list[R]],
+        window: float,
+        max_batch_size: int,
+        name: str = "micro-batcher",
+    ) -> None:
+        self.func = func
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._queue: queue.Queue[tuple[T, Future]] = queue.Queue()
+        self._lock = threading.Lock()
+        self.num_batches = 0
+        self.num_items = 0
+        self.max_seen_batch_size = 0
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def submit(self, item: T) -> R:
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    async def asubmit(self, item: T) -> R:
+        """Like `submit`, awaiting the result instead of blocking the thread."""
+        future: Future = Future()
+        self._queue.put((item, future))
+        return await asyncio.wrap_future(future)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.max_batch_size:
+                    batch.append(self._queue.get(timeout=self.window))
+            except queue.Empty:
+                pass
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: list[tuple[T, Future]]) -> None:
+        with self._lock:
+            self.num_batches += 1
+            self.num_items += len(batch)
+            self.max_seen_batch_size = max(self.max_seen_batch_size, len(batch))
+        try:
+            results = self.func([item for item, _ in batch])
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                "batches": self.num_batches,
+                "items": self.num_items,
+                "mean_batch_size": (
+                    self.num_items / self.num_batches if self.num_batches else 0.0
+                ),
+                "max_batch_size": self.max_seen_batch_size,
+            }
+
+
+class QueryEmbeddings(Embeddings):
+    """Embeddings with a size bounded LRU cache and micro-batching for queries.
+
+    Cache misses of concurrent `embed_query` calls are encoded together through
+    `embed_documents` of the underlying model. The query instruction of the
+    underlying model, as used by the BGE models, is prepended, so the vectors
+    match what `embed_query` of the underlying model returns. Documents are passed
+    through unchanged.
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        cache_size: int,
+        batch_window: float,
+        max_batch_size: int,
+    ) -> None:
+        self.underlying = underlying
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._query_instruction: str = getattr(underlying, "query_instruction", "")
+        self._batcher: MicroBatcher[str, list[float]] = MicroBatcher(
+            self._embed_queries,
+            window=batch_window,
+            max_batch_size=max_batch_size,
+            name="query-embedding-batcher",
+        )
+
+    def _embed_queries(self, texts: list[str]) -> list[list[float]]:
+        # Identical queries arriving together are only encoded once
+        unique_texts = list(dict.fromkeys(texts))
+        vectors = self.underlying.embed_documents(
+            [self._query_instruction + text for text in unique_texts]
+        )
+        by_text = dict(zip(unique_texts, vectors))
+        return [by_text[text] for text in texts]
+
+    def _cache_get(self, text: str) -> Optional[list[float]]:
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(text)
+            self.hits += 1
+            return vector
+
+    def _cache_put(self, text: str, vector: list[float]) -> None:
+        with self._lock:
+            self._cache[text] = vector
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        text = text.replace("\n", " ")
+        vector = self._cache_get(text)
+        if vector is None:
+            vector = self._batcher.submit(text)
+            if self.cache_size > 0:
+                self._cache_put(text, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        # Cache hits return right away, misses wait for the batcher thread
+        # instead of occupying a worker of the default executor
+        text = text.replace("\n", " ")
+        vector = self._cache_get(text)
+        if vector is None:
+            vector = await self._batcher.asubmit(text)
+            if self.cache_size > 0:
+                self._cache_put(text, vector)
+        return vector
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            cache_stats = {
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+                "cache_hit_rate": self.hits / total if total else 0.0,
+                "cache_entries": len(self._cache),
+            }
+        return {**cache_stats, **self._batcher.stats}
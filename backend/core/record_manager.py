@@ -0,0 +1,188 @@
+"""Module with a record manager doing its bulk operations in set based statements"""
+
+from typing import Optional, Sequence
+
+import sqlalchemy as sa
+from core.vector_index import COLLECTION_TABLE, EMBEDDING_TABLE
+from langchain.indexes import SQLRecordManager
+from langchain.indexes._sql_record_manager import UpsertionRecord
+from langchain.schema.vectorstore import VectorStore
+from langchain.vectorstores.pgvector import PGVector
+
+RECORD_TABLE = UpsertionRecord.__tablename__
+
+UPSERT_QUERY = sa.text(
+    f"""
+INSERT INTO {RECORD_TABLE} (uuid, key, namespace, group_id, updated_at)
+SELECT CAST(gen_random_uuid() AS text), r.key, :namespace, r.group_id, :updated_at
+FROM unnest(CAST(:keys AS text[]), CAST(:group_ids AS text[])) AS r(key, group_id)
+ON CONFLICT ON CONSTRAINT uix_key_namespace
+DO UPDATE SET updated_at = excluded.updated_at, group_id = excluded.group_id
+"""
+)
+
+EXISTS_QUERY = sa.text(
+    f"""
+SELECT EXISTS (
+    SELECT 1 FROM {RECORD_TABLE} r
+    WHERE r.key = k.key AND r.namespace = :namespace
+)
+FROM unnest(CAST(:keys AS text[])) WITH ORDINALITY AS k(key, position)
+ORDER BY k.position
+"""
+)
+
+REFRESH_GROUPS_QUERY = sa.text(
+    f"""
+UPDATE {RECORD_TABLE} SET updated_at = :updated_at
+WHERE namespace = :namespace AND group_id = ANY(CAST(:group_ids AS text[]))
+"""
+)
+
+
+def _get_delete_stale_query(by_group: bool) -> sa.TextClause:
+    group_filter = "AND group_id = ANY(CAST(:group_ids AS text[]))" if by_group else ""
+    return sa.text(
+        f"""
+WITH stale AS (
+    DELETE FROM {RECORD_TABLE}
+    WHERE namespace = :namespace AND key IN (
+        SELECT key FROM {RECORD_TABLE}
+        WHERE namespace = :namespace AND updated_at < :before {group_filter}
+        LIMIT :batch_size
+    )
+    RETURNING key
+), deleted AS (
+    DELETE FROM {EMBEDDING_TABLE} e
+    USING stale
+    WHERE e.custom_id = stale.key AND e.collection_id = (
+        SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :collection_name
+    )
+)
+SELECT count(*) FROM stale
+"""
+    )
+
+
+class PostgresRecordManager(SQLRecordManager):
+    """Record manager for postgres, upserting and looking up keys in one statement.
+
+    `delete_stale` removes the stale records and their chunks in the PGVector
+    tables of the same database in one statement per batch, instead of listing
+    the keys and deleting them from both stores in separate round trips.
+    """
+
+    def _get_update_time(
+        self, connection: sa.Connection, time_at_least: Optional[float]
+    ) -> float:
+        update_time = float(
+            connection.execute(
+                sa.text("SELECT EXTRACT(EPOCH FROM CURRENT_TIMESTAMP)")
+            ).scalar()
+        )
+        if time_at_least and update_time < time_at_least:
+            # Safeguard against time sync issues
+            raise AssertionError(f"Time sync issue: {update_time} < {time_at_least}")
+        return update_time
+
+    def update(
+        self,
+        keys: Sequence[str],
+        *,
+        group_ids: Optional[Sequence[Optional[str]]] = None,
+        time_at_least: Optional[float] = None,
+    ) -> None:
+        if group_ids is None:
+            group_ids = [None] * len(keys)
+        if len(keys) != len(group_ids):
+            raise ValueError(
+                f"Number of keys ({len(keys)}) does not match number of "
+                f"group_ids ({len(group_ids)})"
+            )
+        if not keys:
+            return
+        # A conflict must not affect a row twice, the last group of a key wins
+        records = dict(zip(keys, group_ids))
+
+        with self.engine.begin() as connection:
+            update_time = self._get_update_time(connection, time_at_least)
+            connection.execute(
+                UPSERT_QUERY,
+                {
+                    "namespace": self.namespace,
+                    "updated_at": update_time,
+                    "keys": list(records),
+                    "group_ids": list(records.values()),
+                },
+            )
+
+    def exists(self, keys: Sequence[str]) -> list[bool]:
+        if not keys:
+            return []
+        with self.engine.connect() as connection:
+            return list(
+                connection.execute(
+                    EXISTS_QUERY, {"namespace": self.namespace, "keys": list(keys)}
+                ).scalars()
+            )
+
+    def refresh_groups(
+        self, group_ids: Sequence[str], *, time_at_least: Optional[float] = None
+    ) -> None:
+        """Set the update time of all records of the groups to now."""
+        with self.engine.begin() as connection:
+            update_time = self._get_update_time(connection, time_at_least)
+            connection.execute(
+                REFRESH_GROUPS_QUERY,
+                {
+                    "namespace": self.namespace,
+                    "updated_at": update_time,
+                    "group_ids": list(group_ids),
+                },
+            )
+
+    def can_delete_stale(self, vector_store: VectorStore) -> bool:
+        """Whether the chunks of the vector store live in the database of the records."""
+        return (
+            isinstance(vector_store, PGVector)
+            and vector_store._conn.engine.url == self.engine.url
+        )
+
+    def delete_stale(
+        self,
+        vector_store: PGVector,
+        before: float,
+        group_ids: Optional[Sequence[str]] = None,
+        batch_size: Optional[int] = None,
+    ) -> int:
+        """Delete the records updated before the given time and their chunks.
+
+        Each batch of records is deleted with its chunks in a transaction of its
+        own, so a large purge stays within the statement timeout of the engine.
+
+        Args:
+            vector_store: Store of the chunks, see `can_delete_stale`.
+            before: Records updated before are stale.
+            group_ids: Only delete records of these groups, all if None.
+            batch_size: Records deleted per statement, all at once if None.
+
+        Returns:
+            The number of deleted records.
+        """
+        params = {
+            "namespace": self.namespace,
+            "before": before,
+            "collection_name": vector_store.collection_name,
+            # LIMIT NULL is no limit
+            "batch_size": batch_size,
+        }
+        if group_ids is not None:
+            params["group_ids"] = list(group_ids)
+        query = _get_delete_stale_query(group_ids is not None)
+        num_deleted = 0
+        while True:
+            with self.engine.begin() as connection:
+                deleted = connection.execute(query, params).scalar()
+            num_deleted += deleted
+            if batch_size is None or deleted < batch_size:
+                return num_deleted
@@ -0,0 +1,217 @@
+"""Module to turn follow up questions into standalone questions, with fast paths"""
+
+import asyncio
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Literal, Optional, Union
+
+import numpy as np
+from core.retrieval import AsyncPGVectorRetriever
+from core.retrieval_cache import CachedRetriever, normalize_question
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.messages import BaseMessage
+from langchain.schema.retriever import BaseRetriever
+from langchain.schema.runnable import Runnable, RunnableConfig
+
+# Words which refer back to the conversation. A question without any of them is
+# taken to be standalone already.
+_ANAPHORA = re.compile(
+    r"\b("
+    r"it|its|it's|itself|this|that|these|those|they|them|their|theirs|"
+    r"he|him|his|she|her|hers|one|ones|former|latter|above|previous|"
+    r"same|such|other|another|else|also|too|again|more|there|here|"
+    r"then|so|instead|elaborate|how about|what about"
+    r")\b",
+    re.IGNORECASE,
+)
+# Questions this short are mostly follow ups, e.g. "and in JS?"
+_MIN_STANDALONE_WORDS = 4
+
+
+def needs_rephrasing(question: str) -> bool:
+    """Whether a follow up question may depend on the chat history."""
+    if len(question.split()) < _MIN_STANDALONE_WORDS:
+        return True
+    if re.match(r"\s*(and|or|but|what if)\b", question, re.IGNORECASE):
+        return True
+    return _ANAPHORA.search(question) is not None
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    a_vector = np.asarray(a, dtype=np.float32)
+    b_vector = np.asarray(b, dtype=np.float32)
+    norm = np.linalg.norm(a_vector) * np.linalg.norm(b_vector)
+    return float(a_vector @ b_vector / norm) if norm else 0.0
+
+
+def hash_history(chat_history: list[BaseMessage]) -> str:
+    digest = hashlib.sha256()
+    for message in chat_history:
+        digest.update(f"{message.type}\x00{message.content}\x00".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class HistoryAwareRetrieval:
+    """Retrieval for a question with chat history, condensing it only if needed.
+
+    In "always" mode every question goes through the condense chain, as before.
+    In "heuristic" mode, questions without pronouns or other references to the
+    conversation are retrieved for directly. In "speculative" mode, questions the
+    heuristic would rephrase are additionally retrieved for while the condense
+    chain runs. The result is kept if the query embedding of the standalone
+    question has at least `speculation_threshold` cosine similarity to the one of
+    the question, e.g. when the heuristic flagged a question which is standalone
+    already and the LLM merely rewords it. Standalone questions are cached by the hash of the history and the question.
+    """
+
+    def __init__(
+        self,
+        condense_question_chain: Runnable,
+        retriever: Union[AsyncPGVectorRetriever, CachedRetriever],
+        mode: Literal["always", "heuristic", "speculative"],
+        cache_size: int,
+        speculation_threshold: float = 0.9,
+    ) -> None:
+        self.condense_question_chain = condense_question_chain
+        self.retriever = retriever
+        self.mode = mode
+        self.cache_size = cache_size
+        self.speculation_threshold = speculation_threshold
+        self._cache: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {
+            "skipped": 0,
+            "cache_hits": 0,
+            "condensed": 0,
+            "speculation_kept": 0,
+            "speculation_discarded": 0,
+        }
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counts[key] += 1
+
+    def _cached(self, key: tuple[str, str]) -> Optional[str]:
+        with self._lock:
+            question = self._cache.get(key)
+            if question is not None:
+                self._cache.move_to_end(key)
+                self._counts["cache_hits"] += 1
+            return question
+
+    def _store(self, key: tuple[str, str], question: str) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = question
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _get_retriever(self, inputs: dict[str, Any]) -> BaseRetriever:
+        return self.retriever.with_filter(inputs.get("metadata_filter"))
+
+    def _plan(self, inputs: dict[str, Any]) -> tuple[tuple[str, str], Optional[str]]:
+        """The cache key and the question to retrieve for, if already known."""
+        question = inputs["question"]
+        key = (hash_history(inputs["chat_history"]), question)
+        if self.mode != "always" and not needs_rephrasing(question):
+            self._count("skipped")
+            return key, question
+        return key, self._cached(key)
+
+    def _get_embedding(self) -> Embeddings:
+        retriever = self.retriever
+        if isinstance(retriever, CachedRetriever):
+            retriever = retriever.retriever
+        return retriever.embedding
+
+    def _is_same(self, question: str, standalone: str) -> bool:
+        # The query embeddings are cached, the one of the question by the
+        # speculative retrieval, the one of the standalone question for its
+        # retrieval if the speculation is discarded
+        if normalize_question(question) == normalize_question(standalone):
+            return True
+        embedding = self._get_embedding()
+        similarity = cosine_similarity(
+            embedding.embed_query(question), embedding.embed_query(standalone)
+        )
+        return similarity >= self.speculation_threshold
+
+    async def _ais_same(self, question: str, standalone: str) -> bool:
+        if normalize_question(question) == normalize_question(standalone):
+            return True
+        embedding = self._get_embedding()
+        similarity = cosine_similarity(
+            *await asyncio.gather(
+                embedding.aembed_query(question), embedding.aembed_query(standalone)
+            )
+        )
+        return similarity >= self.speculation_threshold
+
+    def invoke(self, inputs: dict[str, Any], config: RunnableConfig) -> list[Document]:
+        key, standalone = self._plan(inputs)
+        retriever = self._get_retriever(inputs)
+        if standalone is not None:
+            return retriever.invoke(standalone, config)
+
+        if self.mode != "speculative":
+            standalone = self.condense_question_chain.invoke(inputs, config)
+            self._count("condensed")
+            self._store(key, standalone)
+            return retriever.invoke(standalone, config)
+
+        # Not waiting for a discarded speculation on shutdown
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            speculation = executor.submit(retriever.invoke, inputs["question"], config)
+            standalone = self.condense_question_chain.invoke(inputs, config)
+        finally:
+            executor.shutdown(wait=False)
+        self._count("condensed")
+        self._store(key, standalone)
+        if self._is_same(inputs["question"], standalone):
+            self._count("speculation_kept")
+            return speculation.result()
+        self._count("speculation_discarded")
+        return retriever.invoke(standalone, config)
+
+    async def ainvoke(
+        self, inputs: dict[str, Any], config: RunnableConfig
+    ) -> list[Document]:
+        key, standalone = self._plan(inputs)
+        retriever = self._get_retriever(inputs)
+        if standalone is not None:
+            return await retriever.ainvoke(standalone, config)
+
+        if self.mode != "speculative":
+            standalone = await self.condense_question_chain.ainvoke(inputs, config)
+            self._count("condensed")
+            self._store(key, standalone)
+            return await retriever.ainvoke(standalone, config)
+
+        speculation = asyncio.ensure_future(
+            retriever.ainvoke(inputs["question"], config)
+        )
+        try:
+            standalone = await self.condense_question_chain.ainvoke(inputs, config)
+        except BaseException:
+            speculation.cancel()
+            raise
+        self._count("condensed")
+        self._store(key, standalone)
+        if await self._ais_same(inputs["question"], standalone):
+            self._count("speculation_kept")
+            return await speculation
+        speculation.cancel()
+        self._count("speculation_discarded")
+        return await retriever.ainvoke(standalone, config)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {**self._counts, "cache_entries": len(self._cache)}
@@ -0,0 +1,171 @@
+"""Module to rerank retrieved chunks with a cross-encoder within a latency budget"""
+
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Optional, Sequence
+
+from langchain.schema import Document
+
+# Relevance scores of (question, chunk) pairs, higher is more relevant
+Scorer = Callable[[list[tuple[str, str]]], list[float]]
+
+
+def get_cross_encoder_scorer(model_name: str, max_length: int) -> Scorer:
+    """Score with a sentence-transformers cross-encoder on the CPU."""
+    from sentence_transformers import CrossEncoder
+
+    model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+
+    def score(pairs: list[tuple[str, str]]) -> list[float]:
+        return model.predict(pairs, batch_size=len(pairs)).tolist()
+
+    return score
+
+
+def _chunk_id(doc: Document) -> str:
+    return hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+
+class CrossEncoderReranker:
+    """Reorders retrieved chunks by the scores of a cross-encoder, keeping `top_k`.
+
+    The chunks are scored in batches of `batch_size` on a pool of `workers`
+    threads, with the scores cached per question and chunk. Batches are
+    submitted in retrieval order, so once `budget` seconds have passed the
+    unscored chunks are the ones retrieved last; they are not waited for and
+    follow the scored chunks in their retrieval order. Batches already running
+    finish in the background and still fill the cache.
+    """
+
+    def __init__(
+        self,
+        score: Scorer,
+        top_k: int,
+        batch_size: int,
+        workers: int,
+        budget: float,
+        cache_size: int,
+    ) -> None:
+        self.score = score
+        self.top_k = top_k
+        self.batch_size = batch_size
+        self.budget = budget
+        self.cache_size = cache_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="reranker"
+        )
+        self._cache: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_reranked = 0
+        self.num_scored = 0
+        self.num_cached = 0
+        self.num_unscored = 0
+        self.num_over_budget = 0
+
+    def _cache_get(self, key: tuple[str, str]) -> Optional[float]:
+        with self._lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _score_batch(
+        self, question: str, batch: list[tuple[str, Document]]
+    ) -> dict[str, float]:
+        scores = self.score([(question, doc.page_content) for _, doc in batch])
+        with self._lock:
+            self.num_scored += len(batch)
+            for (chunk_id, _), score in zip(batch, scores):
+                self._cache[(question, chunk_id)] = score
+                self._cache.move_to_end((question, chunk_id))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return {chunk_id: score for (chunk_id, _), score in zip(batch, scores)}
+
+    def _submit(
+        self, question: str, docs: Sequence[Document]
+    ) -> tuple[list[str], dict[str, float], list[Future]]:
+        chunk_ids = [_chunk_id(doc) for doc in docs]
+        scores: dict[str, float] = {}
+        misses: dict[str, Document] = {}
+        for chunk_id, doc in zip(chunk_ids, docs):
+            score = self._cache_get((question, chunk_id))
+            if score is not None:
+                scores[chunk_id] = score
+            else:
+                misses.setdefault(chunk_id, doc)
+        items = list(misses.items())
+        futures = [
+            self._executor.submit(
+                self._score_batch, question, items[start : start + self.batch_size]
+            )
+            for start in range(0, len(items), self.batch_size)
+        ]
+        with self._lock:
+            self.num_cached += len(docs) - len(items)
+        return chunk_ids, scores, futures
+
+    def _collect(
+        self,
+        docs: Sequence[Document],
+        chunk_ids: list[str],
+        scores: dict[str, float],
+        futures: list[Future],
+    ) -> list[Document]:
+        over_budget = False
+        for future in futures:
+            # Batches not started yet are dropped, running ones fill the cache
+            if not future.done():
+                future.cancel()
+                over_budget = True
+            elif future.exception() is None:
+                scores.update(future.result())
+            else:
+                raise future.exception()
+        scored = [
+            (scores[chunk_id], rank)
+            for rank, chunk_id in enumerate(chunk_ids)
+            if chunk_id in scores
+        ]
+        unscored = [
+            rank for rank, chunk_id in enumerate(chunk_ids) if chunk_id not in scores
+        ]
+        order = [rank for _, rank in sorted(scored, key=lambda x: -x[0])] + unscored
+        with self._lock:
+            self.num_reranked += 1
+            self.num_unscored += len(unscored)
+            self.num_over_budget += over_budget
+        return [docs[rank] for rank in order[: self.top_k]]
+
+    def rerank(self, question: str, docs: Sequence[Document]) -> list[Document]:
+        deadline = time.monotonic() + self.budget
+        chunk_ids, scores, futures = self._submit(question, docs)
+        if futures:
+            wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        return self._collect(docs, chunk_ids, scores, futures)
+
+    async def arerank(self, question: str, docs: Sequence[Document]) -> list[Document]:
+        deadline = time.monotonic() + self.budget
+        chunk_ids, scores, futures = self._submit(question, docs)
+        if futures:
+            await asyncio.wait(
+                [asyncio.wrap_future(future) for future in futures],
+                timeout=max(deadline - time.monotonic(), 0),
+            )
+        return self._collect(docs, chunk_ids, scores, futures)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                "reranked": self.num_reranked,
+                "scored": self.num_scored,
+                "cache_hits": self.num_cached,
+                "cache_entries": len(self._cache),
+                "unscored": self.num_unscored,
+                "over_budget": self.num_over_budget,
+            }
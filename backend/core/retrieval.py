@@ -0,0 +1,602 @@
+"""Module to retrieve documents from the vector store without blocking the event loop"""
+
+import asyncio
+import json
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Optional
+
+import sqlalchemy as sa
+from core.index_generation import INDEX_GENERATION_TABLE
+from core.text_search import TEXT_SEARCH_COLUMN
+from core.vector_index import (
+    COLLECTION_TABLE,
+    EMBEDDING_TABLE,
+    get_binary_quantized_expression,
+    get_vector_index_name,
+)
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.retriever import BaseRetriever
+from pydantic.v1 import PrivateAttr
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+# Containment on the jsonb metadata, see `core.metadata_index`
+METADATA_FILTER = "AND cmetadata @> CAST(:metadata_filter AS jsonb)"
+
+# The metadata as text, json columns are decoded by psycopg2 but not by asyncpg
+SIMILARITY_SEARCH_SQL = f"""
+SELECT document, CAST(cmetadata AS text) AS cmetadata
+FROM {EMBEDDING_TABLE}
+WHERE collection_id = :collection_id {{metadata_filter}}
+ORDER BY embedding <=> CAST(:embedding AS {{vector_type}})
+LIMIT :k
+"""
+
+# The candidates nearest by the hamming distance of the binary quantized
+# embeddings, rescored by the cosine distance of their full vectors
+RESCORED_SIMILARITY_SEARCH_SQL = f"""
+SELECT document, cmetadata
+FROM (
+    SELECT document, CAST(cmetadata AS text) AS cmetadata, embedding
+    FROM {EMBEDDING_TABLE}
+    WHERE collection_id = :collection_id {{metadata_filter}}
+    ORDER BY {{binary_quantized}}
+        <~> binary_quantize(CAST(:embedding AS {{vector_type}}))
+    LIMIT :candidates
+) AS candidates
+ORDER BY embedding <=> CAST(:embedding AS {{vector_type}})
+LIMIT :k
+"""
+
+# ts_rank_cd has no document frequencies like BM25, normalization 1 divides the
+# rank by the log of the chunk length
+LEXICAL_SEARCH_SQL = f"""
+WITH q AS (
+    SELECT websearch_to_tsquery(CAST(:config AS regconfig), :query) AS query
+)
+SELECT document, CAST(cmetadata AS text) AS cmetadata
+FROM {EMBEDDING_TABLE}, q
+WHERE collection_id = :collection_id AND {TEXT_SEARCH_COLUMN} @@ q.query
+    {{metadata_filter}}
+ORDER BY ts_rank_cd({TEXT_SEARCH_COLUMN}, q.query, 1) DESC
+LIMIT :k
+"""
+
+# Separate statements, a plan for optional filters fits neither case
+LEXICAL_SEARCH_QUERY = sa.text(LEXICAL_SEARCH_SQL.format(metadata_filter=""))
+FILTERED_LEXICAL_SEARCH_QUERY = sa.text(
+    LEXICAL_SEARCH_SQL.format(metadata_filter=METADATA_FILTER)
+)
+
+# The planner's estimates of the rows of a collection, without and with a filter
+ESTIMATE_ROWS_QUERY = sa.text(
+    f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {EMBEDDING_TABLE} "
+    "WHERE collection_id = :collection_id"
+)
+ESTIMATE_FILTERED_ROWS_QUERY = sa.text(
+    f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {EMBEDDING_TABLE} "
+    f"WHERE collection_id = :collection_id {METADATA_FILTER}"
+)
+
+# The ANN index of a collection and the pgvector version
+GET_VECTOR_INDEX_QUERY = sa.text(
+    "SELECT am.amname AS method, c.reloptions AS options, "
+    "(SELECT extversion FROM pg_extension WHERE extname = 'vector') AS version "
+    "FROM pg_class c JOIN pg_am am ON am.oid = c.relam "
+    "WHERE c.oid = to_regclass(:name)"
+)
+
+# Settings of the search transaction, see `FilteredSearchPlan`
+SET_LOCAL_QUERY = sa.text("SELECT set_config(:name, :value, true)")
+# Unset until pgvector is loaded by the session, greatest ignores null
+RAISE_LOCAL_QUERY = sa.text(
+    "SELECT set_config(:name, CAST(greatest("
+    "CAST(current_setting(:name, true) AS int), :value) AS text), true)"
+)
+
+# The estimates are rough, an ANN scan is sized for twice the matches needed
+FILTER_OVERFETCH = 2
+# The largest hnsw.ef_search of pgvector
+MAX_EF_SEARCH = 1000
+# Iterative index scans, hnsw.iterative_scan
+_MIN_ITERATIVE_SCAN_VERSION = (0, 8, 0)
+# Plans follow the estimates of the planner, which change with the data
+FILTER_PLAN_TTL_SECONDS = 300.0
+# The filters come from the requests, the least recently used plans are dropped
+FILTER_PLAN_CACHE_SIZE = 256
+
+GET_COLLECTION_ID_QUERY = sa.text(
+    f"SELECT CAST(uuid AS text) FROM {COLLECTION_TABLE} WHERE name = :name"
+)
+
+GET_GENERATION_QUERY = sa.text(
+    f"SELECT generation FROM {INDEX_GENERATION_TABLE} WHERE namespace = :namespace"
+)
+
+UNDEFINED_TABLE = "42P01"
+
+
+@lru_cache(maxsize=None)
+def get_similarity_search_query(
+    vector_type: str, filtered: bool, binary_dimensions: Optional[int] = None
+) -> sa.TextClause:
+    """The similarity search, with a binary first pass given the dimensions."""
+    metadata_filter = METADATA_FILTER if filtered else ""
+    if binary_dimensions is None:
+        return sa.text(
+            SIMILARITY_SEARCH_SQL.format(
+                metadata_filter=metadata_filter, vector_type=vector_type
+            )
+        )
+    return sa.text(
+        RESCORED_SIMILARITY_SEARCH_SQL.format(
+            metadata_filter=metadata_filter,
+            vector_type=vector_type,
+            binary_quantized=get_binary_quantized_expression(binary_dimensions),
+        )
+    )
+
+
+@dataclass(frozen=True)
+class FilteredSearchPlan:
+    """Server settings of a filtered search, see `plan_filtered_search`."""
+
+    settings: tuple[tuple[str, str], ...] = ()
+    # Raised to at least the value, never lowered below the configured one
+    minimums: tuple[tuple[str, int], ...] = ()
+
+
+# The ANN index is not scanned, the GIN index on the metadata selects the chunks
+EXACT_PLAN = FilteredSearchPlan(settings=(("enable_indexscan", "off"),))
+
+
+def plan_filtered_search(
+    method: str,
+    lists: int,
+    iterative_scan: bool,
+    collection_rows: float,
+    filtered_rows: float,
+    limit: int,
+    exact_max_rows: int,
+    max_scan_tuples: int,
+) -> FilteredSearchPlan:
+    """How a search for the `limit` nearest chunks matching a filter runs.
+
+    An ANN index scan visits the nearest chunks and drops those not matching the
+    filter afterwards, returning fewer than `limit` unless it visits enough. A
+    filter matching at most `exact_max_rows` chunks is searched exactly, ranking
+    the chunks the GIN index selects. Otherwise the ANN scan is sized by the
+    fraction of the collection the filter matches: iterative index scans of
+    pgvector 0.8 continue until enough chunks match, visiting at most
+    `max_scan_tuples`, older versions over-fetch with a raised `hnsw.ef_search`,
+    which sizes the first batch of an iterative scan too, IVFFlat probes more
+    lists. A filter too selective for that is searched
+    exactly as well.
+    """
+    if filtered_rows <= exact_max_rows:
+        return EXACT_PLAN
+    fraction = filtered_rows / max(collection_rows, filtered_rows)
+    scan = math.ceil(FILTER_OVERFETCH * limit / fraction)
+    if scan > max_scan_tuples:
+        return EXACT_PLAN
+    if method == "ivfflat":
+        probes = math.ceil(scan * lists / max(collection_rows, 1))
+        return FilteredSearchPlan(minimums=(("ivfflat.probes", probes),))
+    if iterative_scan:
+        # The first batch of candidates is sized like the over-fetch, as the
+        # matches of later batches are further from the query
+        return FilteredSearchPlan(
+            settings=(
+                ("hnsw.iterative_scan", "strict_order"),
+                ("hnsw.max_scan_tuples", str(max_scan_tuples)),
+            ),
+            minimums=(("hnsw.ef_search", min(scan, MAX_EF_SEARCH)),),
+        )
+    if scan > MAX_EF_SEARCH:
+        return EXACT_PLAN
+    return FilteredSearchPlan(minimums=(("hnsw.ef_search", scan),))
+
+
+def _get_plan_rows(plan: Any) -> float:
+    # The json of EXPLAIN, as text if the driver does not decode json
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+def _get_version(version: str) -> tuple[int, ...]:
+    return tuple(int(part) for part in version.split("."))
+
+
+def to_vector_literal(vector: list[float]) -> str:
+    return "[" + ",".join(map(str, vector)) + "]"
+
+
+def _to_documents(rows: Any) -> list[Document]:
+    return [
+        Document(page_content=row.document, metadata=json.loads(row.cmetadata))
+        for row in rows
+    ]
+
+
+def _is_undefined_table(error: sa.exc.DBAPIError) -> bool:
+    return getattr(error.orig, "pgcode", None) == UNDEFINED_TABLE
+
+
+class _FilterPlanCache:
+    """Size and time bounded LRU cache of the plans by metadata filter."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._plans: OrderedDict[str, tuple[float, FilteredSearchPlan]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[FilteredSearchPlan]:
+        with self._lock:
+            expires_at, plan = self._plans.get(key, (0.0, None))
+            if plan is None or expires_at <= time.monotonic():
+                return None
+            self._plans.move_to_end(key)
+            return plan
+
+    def put(self, key: str, plan: FilteredSearchPlan) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for expired in [k for k, (at, _) in self._plans.items() if at <= now]:
+                del self._plans[expired]
+            self._plans[key] = (now + self.ttl_seconds, plan)
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._plans)
+
+
+class AsyncPGVectorRetriever(BaseRetriever):
+    """Retriever running the similarity search of PGVector on the shared engines.
+
+    The async search is awaited on the event loop with the asyncpg engine, so
+    concurrent requests do not each hold a thread pool worker while the database
+    works, the sync search runs on the psycopg2 engine. Both return the same
+    documents as the PGVector retriever with cosine distance.
+
+    With a `metadata_filter`, only chunks whose metadata contain it are
+    searched, see `with_filter`. Whether the ANN index is scanned depends on
+    how many chunks the filter matches, see `plan_filtered_search`; plans are
+    cached per filter by all copies of the retriever, for the most recently
+    used `FILTER_PLAN_CACHE_SIZE` filters. With
+    `rescore_candidates`, the search is a first pass over the binary quantized
+    embeddings, see `core.vector_index.create_vector_index`, rescoring that
+    many candidates.
+    """
+
+    embedding: Embeddings
+    engine: Engine
+    async_engine: AsyncEngine
+    collection_name: str
+    record_manager_namespace: str
+    k: int = 6
+    metadata_filter: Optional[dict[str, str]] = None
+    # Of the embedding column, see `core.vector_index.set_vector_storage`
+    vector_type: str = "vector"
+    rescore_candidates: Optional[int] = None
+    # See `plan_filtered_search`
+    filter_exact_max_rows: int = 10_000
+    filter_max_scan_tuples: int = 20_000
+
+    _collection_id: Optional[str] = PrivateAttr(default=None)
+    # Shared with the copies of `with_filter`
+    _filter_plans: _FilterPlanCache = PrivateAttr(
+        default_factory=lambda: _FilterPlanCache(
+            FILTER_PLAN_CACHE_SIZE, FILTER_PLAN_TTL_SECONDS
+        )
+    )
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _set_collection_id(self, collection_id: Optional[str]) -> str:
+        if collection_id is None:
+            raise ValueError("Collection not found")
+        self._collection_id = collection_id
+        return collection_id
+
+    def with_filter(
+        self, metadata_filter: Optional[dict[str, str]]
+    ) -> "AsyncPGVectorRetriever":
+        """A copy of the retriever searching only chunks with the given metadata."""
+        if not metadata_filter:
+            return self
+        return self.copy(update={"metadata_filter": metadata_filter})
+
+    def _filter_params(self) -> dict[str, Any]:
+        if not self.metadata_filter:
+            return {}
+        return {"metadata_filter": json.dumps(self.metadata_filter)}
+
+    def _search_params(
+        self, collection_id: str, embedding: list[float]
+    ) -> dict[str, Any]:
+        params = {
+            "collection_id": collection_id,
+            "embedding": to_vector_literal(embedding),
+            "k": self.k,
+            **self._filter_params(),
+        }
+        if self.rescore_candidates:
+            params["candidates"] = self._get_ann_limit()
+        return params
+
+    def _get_ann_limit(self) -> int:
+        """The rows the ANN index scan has to return."""
+        if self.rescore_candidates:
+            return max(self.rescore_candidates, self.k)
+        return self.k
+
+    def _get_filter_key(self) -> str:
+        return json.dumps(self.metadata_filter, sort_keys=True)
+
+    def _get_cached_plan(self) -> Optional[FilteredSearchPlan]:
+        return self._filter_plans.get(self._get_filter_key())
+
+    def _plan(
+        self, index: Any, collection_rows: float = 0, filtered_rows: float = 0
+    ) -> FilteredSearchPlan:
+        if index is None:
+            # The planner picks the GIN index
+            plan = FilteredSearchPlan()
+        else:
+            options = dict(option.split("=", 1) for option in index.options or [])
+            plan = plan_filtered_search(
+                index.method,
+                lists=int(options.get("lists", 1)),
+                iterative_scan=(
+                    _get_version(index.version) >= _MIN_ITERATIVE_SCAN_VERSION
+                ),
+                collection_rows=collection_rows,
+                filtered_rows=filtered_rows,
+                limit=self._get_ann_limit(),
+                exact_max_rows=self.filter_exact_max_rows,
+                max_scan_tuples=self.filter_max_scan_tuples,
+            )
+        self._filter_plans.put(self._get_filter_key(), plan)
+        return plan
+
+    async def _aplan_filtered_search(
+        self, connection: AsyncConnection, collection_id: str
+    ) -> FilteredSearchPlan:
+        plan = self._get_cached_plan()
+        if plan is not None:
+            return plan
+        index = (
+            await connection.execute(
+                GET_VECTOR_INDEX_QUERY,
+                {"name": get_vector_index_name(self.collection_name)},
+            )
+        ).first()
+        if index is None:
+            return self._plan(None)
+        params = {"collection_id": collection_id, **self._filter_params()}
+        return self._plan(
+            index,
+            _get_plan_rows(await connection.scalar(ESTIMATE_ROWS_QUERY, params)),
+            _get_plan_rows(
+                await connection.scalar(ESTIMATE_FILTERED_ROWS_QUERY, params)
+            ),
+        )
+
+    def _plan_filtered_search(
+        self, connection: Connection, collection_id: str
+    ) -> FilteredSearchPlan:
+        plan = self._get_cached_plan()
+        if plan is not None:
+            return plan
+        index = connection.execute(
+            GET_VECTOR_INDEX_QUERY,
+            {"name": get_vector_index_name(self.collection_name)},
+        ).first()
+        if index is None:
+            return self._plan(None)
+        params = {"collection_id": collection_id, **self._filter_params()}
+        return self._plan(
+            index,
+            _get_plan_rows(connection.scalar(ESTIMATE_ROWS_QUERY, params)),
+            _get_plan_rows(connection.scalar(ESTIMATE_FILTERED_ROWS_QUERY, params)),
+        )
+
+    def _get_search_query(self, embedding: list[float]) -> sa.TextClause:
+        return get_similarity_search_query(
+            self.vector_type,
+            bool(self.metadata_filter),
+            len(embedding) if self.rescore_candidates else None,
+        )
+
+    async def _asearch(
+        self, connection: AsyncConnection, embedding: list[float]
+    ) -> list[Document]:
+        collection_id = self._collection_id or self._set_collection_id(
+            await connection.scalar(
+                GET_COLLECTION_ID_QUERY, {"name": self.collection_name}
+            )
+        )
+        if self.metadata_filter:
+            plan = await self._aplan_filtered_search(connection, collection_id)
+            for name, value in plan.settings:
+                await connection.execute(
+                    SET_LOCAL_QUERY, {"name": name, "value": value}
+                )
+            for name, value in plan.minimums:
+                await connection.execute(
+                    RAISE_LOCAL_QUERY, {"name": name, "value": value}
+                )
+        rows = await connection.execute(
+            self._get_search_query(embedding),
+            self._search_params(collection_id, embedding),
+        )
+        return _to_documents(rows)
+
+    def _search(self, connection: Connection, embedding: list[float]) -> list[Document]:
+        collection_id = self._collection_id or self._set_collection_id(
+            connection.scalar(GET_COLLECTION_ID_QUERY, {"name": self.collection_name})
+        )
+        if self.metadata_filter:
+            plan = self._plan_filtered_search(connection, collection_id)
+            for name, value in plan.settings:
+                connection.execute(SET_LOCAL_QUERY, {"name": name, "value": value})
+            for name, value in plan.minimums:
+                connection.execute(RAISE_LOCAL_QUERY, {"name": name, "value": value})
+        rows = connection.execute(
+            self._get_search_query(embedding),
+            self._search_params(collection_id, embedding),
+        )
+        return _to_documents(rows)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        embedding = await self.embedding.aembed_query(query)
+        async with self.async_engine.connect() as connection:
+            return await self._asearch(connection, embedding)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        embedding = self.embedding.embed_query(query)
+        with self.engine.connect() as connection:
+            return self._search(connection, embedding)
+
+    async def aget_generation(self) -> int:
+        """The generation of the indexed data, see `bump_index_generation`."""
+        async with self.async_engine.connect() as connection:
+            try:
+                generation = await connection.scalar(
+                    GET_GENERATION_QUERY, {"namespace": self.record_manager_namespace}
+                )
+            except sa.exc.ProgrammingError as e:
+                if not _is_undefined_table(e):
+                    raise
+                # Nothing was indexed yet
+                return 0
+        return generation or 0
+
+    def get_generation(self) -> int:
+        with self.engine.connect() as connection:
+            try:
+                generation = connection.scalar(
+                    GET_GENERATION_QUERY, {"namespace": self.record_manager_namespace}
+                )
+            except sa.exc.ProgrammingError as e:
+                if not _is_undefined_table(e):
+                    raise
+                return 0
+        return generation or 0
+
+
+def to_lexical_query(query: str) -> str:
+    """The words of the query or-ed, in the syntax of `websearch_to_tsquery`.
+
+    Chunks rarely contain every word of a question, so any word matches. Only
+    the words are kept, the operators of the syntax cannot be injected.
+    """
+    return " or ".join(
+        word for word in re.findall(r"\w+", query) if word.lower() != "or"
+    )
+
+
+def _doc_key(doc: Document) -> tuple[str, str]:
+    return doc.page_content, json.dumps(doc.metadata, sort_keys=True)
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[Document]], k: int, rrf_k: int = 60
+) -> list[Document]:
+    """The k best documents by the sum of 1 / (rrf_k + rank) over the rankings."""
+    scores: dict[tuple[str, str], float] = {}
+    docs: dict[tuple[str, str], Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = _doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    # Stable, ties keep the order of the first ranking they appear in
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+
+class HybridPGVectorRetriever(AsyncPGVectorRetriever):
+    """Retriever fusing the similarity search with a full text search.
+
+    Exact names, e.g. of classes, are matched by the full text search over the
+    tsvector column, see `core.text_search`, while the similarity search finds
+    paraphrases. Both fetch k candidates and are fused by reciprocal rank
+    fusion. The async search runs the full text search concurrently with the
+    embedding of the query and the similarity search.
+    """
+
+    text_search_config: str = "english"
+    rrf_k: int = 60
+
+    def _lexical_params(self, collection_id: str, query: str) -> dict[str, Any]:
+        return {
+            "collection_id": collection_id,
+            "config": self.text_search_config,
+            "query": to_lexical_query(query),
+            "k": self.k,
+            **self._filter_params(),
+        }
+
+    def _get_lexical_query(self) -> sa.TextClause:
+        if self.metadata_filter:
+            return FILTERED_LEXICAL_SEARCH_QUERY
+        return LEXICAL_SEARCH_QUERY
+
+    async def _alexical_search(self, query: str) -> list[Document]:
+        async with self.async_engine.connect() as connection:
+            collection_id = self._collection_id or self._set_collection_id(
+                await connection.scalar(
+                    GET_COLLECTION_ID_QUERY, {"name": self.collection_name}
+                )
+            )
+            rows = await connection.execute(
+                self._get_lexical_query(), self._lexical_params(collection_id, query)
+            )
+            return _to_documents(rows)
+
+    def _lexical_search(self, connection: Connection, query: str) -> list[Document]:
+        collection_id = self._collection_id or self._set_collection_id(
+            connection.scalar(GET_COLLECTION_ID_QUERY, {"name": self.collection_name})
+        )
+        rows = connection.execute(
+            self._get_lexical_query(), self._lexical_params(collection_id, query)
+        )
+        return _to_documents(rows)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector_docs, lexical_docs = await asyncio.gather(
+            super()._aget_relevant_documents(query, run_manager=run_manager),
+            self._alexical_search(query),
+        )
+        return reciprocal_rank_fusion([vector_docs, lexical_docs], self.k, self.rrf_k)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        embedding = self.embedding.embed_query(query)
+        with self.engine.connect() as connection:
+            vector_docs = self._search(connection, embedding)
+            lexical_docs = self._lexical_search(connection, query)
+        return reciprocal_rank_fusion([vector_docs, lexical_docs], self.k, self.rrf_k)
@@ -0,0 +1,244 @@
+"""Module to cache retrieval results until the indexed data changes"""
+
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+from core.config import RetrievalCacheSettings
+from core.retrieval import AsyncPGVectorRetriever
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.retriever import BaseRetriever
+
+
+def normalize_question(question: str) -> str:
+    """Case and whitespace folded question, without trailing punctuation."""
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?!. ")
+
+
+@dataclass
+class _Entry:
+    docs: list[Document]
+    expires_at: float
+    embedding: Optional[np.ndarray]
+    scope: str
+
+
+class RetrievalCache:
+    """Size and time bounded LRU cache of retrieved documents per question.
+
+    Entries belong to the index generation they were retrieved at. Looking up
+    under another generation drops all entries, and results retrieved while the
+    generation changed are not stored, so results never outlive a change of the
+    index. With a `similarity_threshold`, an entry also matches a
+    question whose normalized embedding has at least that cosine similarity to
+    the one of the cached question. Entries of different scopes, e.g. metadata
+    filters, never match each other.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        similarity_threshold: Optional[float] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_generation(self, generation: int) -> None:
+        # Not only newer generations, a recreated database starts over at 0
+        if generation != self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._generation = generation
+
+    def _find_similar(
+        self, embedding: np.ndarray, scope: str, now: float
+    ) -> Optional[_Entry]:
+        candidates = [
+            entry
+            for entry in self._entries.values()
+            if entry.embedding is not None
+            and entry.scope == scope
+            and entry.expires_at > now
+        ]
+        if not candidates:
+            return None
+        similarities = np.stack([entry.embedding for entry in candidates]) @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.similarity_threshold:
+            return candidates[best]
+        return None
+
+    def get(
+        self,
+        question: str,
+        generation: int,
+        embedding: Optional[list[float]] = None,
+        scope: str = "",
+    ) -> Optional[list[Document]]:
+        key = (scope, normalize_question(question))
+        now = time.monotonic()
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            elif self.similarity_threshold is not None and embedding is not None:
+                entry = self._find_similar(_unit(embedding), scope, now)
+                if entry is not None:
+                    self.similar_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            return _copy(entry.docs)
+
+    def put(
+        self,
+        question: str,
+        generation: int,
+        docs: list[Document],
+        embedding: Optional[list[float]] = None,
+        scope: str = "",
+    ) -> None:
+        with self._lock:
+            if generation != self._generation:
+                # The index changed while retrieving
+                return
+            key = (scope, normalize_question(question))
+            self._entries[key] = _Entry(
+                docs=_copy(docs),
+                expires_at=time.monotonic() + self.ttl_seconds,
+                embedding=None if embedding is None else _unit(embedding),
+                scope=scope,
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.similar_hits + self.misses
+            return {
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.similar_hits) / total if total else 0.0,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "generation": self._generation,
+            }
+
+
+def _unit(embedding: list[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _copy(docs: list[Document]) -> list[Document]:
+    # Callers may modify the metadata of the returned documents
+    return [
+        Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+        for doc in docs
+    ]
+
+
+class CachedRetriever(BaseRetriever):
+    """Retriever answering repeated questions from a `RetrievalCache`.
+
+    The index generation is read on every call, a primary key lookup, so that a
+    change of the index by `core.indexing.index` takes effect on the next call.
+    """
+
+    retriever: AsyncPGVectorRetriever
+    cache: RetrievalCache
+    # Only needed for the similarity lookup
+    embedding: Optional[Embeddings] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def with_filter(
+        self, metadata_filter: Optional[dict[str, str]]
+    ) -> "CachedRetriever":
+        """A copy searching only chunks with the given metadata, sharing the cache."""
+        if not metadata_filter:
+            return self
+        return self.copy(
+            update={"retriever": self.retriever.with_filter(metadata_filter)}
+        )
+
+    def _scope(self) -> str:
+        metadata_filter = self.retriever.metadata_filter
+        return json.dumps(metadata_filter, sort_keys=True) if metadata_filter else ""
+
+    def _use_embedding(self) -> bool:
+        return (
+            self.cache.similarity_threshold is not None and self.embedding is not None
+        )
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        generation = await self.retriever.aget_generation()
+        embedding = (
+            await self.embedding.aembed_query(query) if self._use_embedding() else None
+        )
+        docs = self.cache.get(query, generation, embedding, self._scope())
+        if docs is None:
+            docs = await self.retriever.aget_relevant_documents(
+                query, callbacks=run_manager.get_child()
+            )
+            self.cache.put(query, generation, docs, embedding, self._scope())
+        return docs
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        generation = self.retriever.get_generation()
+        embedding = self.embedding.embed_query(query) if self._use_embedding() else None
+        docs = self.cache.get(query, generation, embedding, self._scope())
+        if docs is None:
+            docs = self.retriever.get_relevant_documents(
+                query, callbacks=run_manager.get_child()
+            )
+            self.cache.put(query, generation, docs, embedding, self._scope())
+        return docs
+
+
+def get_cached_retriever(
+    retriever: AsyncPGVectorRetriever, settings: RetrievalCacheSettings
+) -> CachedRetriever:
+    return CachedRetriever(
+        retriever=retriever,
+        cache=RetrievalCache(
+            max_entries=settings.max_entries,
+            ttl_seconds=settings.ttl_seconds,
+            similarity_threshold=settings.similarity_threshold,
+        ),
+        embedding=retriever.embedding,
+    )
@@ -0,0 +1,127 @@
+"""Module to build heavy resources once per process and time the startup"""
+
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Callable, Iterator, Optional, Type
+
+from langchain.schema.runnable import Runnable, RunnableConfig
+
+
+class StartupTimings:
+    """Seconds spent per step of the startup, in the order the steps finished."""
+
+    def __init__(self) -> None:
+        self._timings: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, step: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._timings[step] = time.perf_counter() - start
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {step: round(seconds, 3) for step, seconds in self._timings.items()}
+
+
+startup_timings = StartupTimings()
+
+
+class LazyRunnable(Runnable):
+    """Runnable built by `factory` on first use, once per process.
+
+    Routes can be added and the app imported without loading models or
+    connecting to the database. `get` builds the runnable, e.g. in the lifespan
+    of the app; a first async call builds it on a worker thread instead of the
+    event loop. Calls are delegated to the built runnable, so its runs are the
+    ones streamed and logged.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Runnable],
+        input_type: Type,
+        output_type: Type,
+        name: str,
+    ) -> None:
+        self.factory = factory
+        self.input_type = input_type
+        self.output_type = output_type
+        self.name = name
+        self._runnable: Optional[Runnable] = None
+        self._lock = threading.Lock()
+
+    @property
+    def InputType(self) -> Type:
+        return self.input_type
+
+    @property
+    def OutputType(self) -> Type:
+        return self.output_type
+
+    @property
+    def is_built(self) -> bool:
+        return self._runnable is not None
+
+    def get(self) -> Runnable:
+        if self._runnable is None:
+            with self._lock:
+                if self._runnable is None:
+                    with startup_timings.time(self.name):
+                        self._runnable = self.factory()
+        return self._runnable
+
+    async def aget(self) -> Runnable:
+        if self._runnable is None:
+            return await asyncio.to_thread(self.get)
+        return self._runnable
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None) -> Any:
+        return self.get().invoke(input, config)
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Any:
+        return await (await self.aget()).ainvoke(input, config, **kwargs)
+
+    def batch(
+        self,
+        inputs: list[Any],
+        config: Optional[RunnableConfig | list[RunnableConfig]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Any,
+    ) -> list[Any]:
+        return self.get().batch(
+            inputs, config, return_exceptions=return_exceptions, **kwargs
+        )
+
+    async def abatch(
+        self,
+        inputs: list[Any],
+        config: Optional[RunnableConfig | list[RunnableConfig]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Any,
+    ) -> list[Any]:
+        return await (await self.aget()).abatch(
+            inputs, config, return_exceptions=return_exceptions, **kwargs
+        )
+
+    def stream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Iterator[Any]:
+        yield from self.get().stream(input, config, **kwargs)
+
+    async def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        async for chunk in (await self.aget()).astream(input, config, **kwargs):
+            yield chunk
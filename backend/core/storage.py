@@ -1,7 +1,25 @@
 """Module to organize storage related functionality"""
 
-from core.config import PGVectorSettings
-from langchain.indexes import SQLRecordManager
+import logging
+import threading
+import time
+from typing import Any, Optional, Union
+
+import sqlalchemy as sa
+from core.config import PGVectorSettings, Settings
+from core.constants import DB_COLLECTION_NAME
+from core.record_manager import PostgresRecordManager
+from core.vector_index import get_search_server_settings
+from core.vector_store import BulkPGVector, SharedEnginePGVector
+from langchain.schema.embeddings import Embeddings
+from langchain.vectorstores.pgvector import PGVector
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Engines shared by the process, by connection string and settings
+_engines: dict[tuple[str, str], Union[Engine, AsyncEngine]] = {}
+_engines_lock = threading.Lock()
 
 
 def get_pgvector_connection_str(
@@ -12,9 +30,181 @@ def get_pgvector_connection_str(
     return f"postgresql://{settings.user}:{settings.password}@{settings.host}:{settings.port}/{settings.database}"
 
 
-def get_sql_record_manager(
-    settings: PGVectorSettings, namespace: str
-) -> SQLRecordManager:
-    return SQLRecordManager(
-        namespace=namespace, db_url=get_pgvector_connection_str(settings)
+class CheckoutTimings:
+    """How long checkouts of a pool waited for a connection."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, wait_seconds: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += wait_seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+
+class _TimedCheckout:
+    """Pool mixin timing the checkouts, including opening new connections."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_overflow = kwargs.get("max_overflow", 10)
+        self.checkout_timings = CheckoutTimings()
+
+    def _do_get(self) -> Any:
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except sa.exc.TimeoutError:
+            self.checkout_timings.record_timeout()
+            raise
+        self.checkout_timings.record(time.perf_counter() - start)
+        return connection
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def _get_server_settings(settings: Settings) -> dict[str, str]:
+    server_settings = get_search_server_settings(settings.vector_index, settings.embed)
+    if settings.pgvector.statement_timeout_ms > 0:
+        server_settings["statement_timeout"] = str(
+            settings.pgvector.statement_timeout_ms
+        )
+    return server_settings
+
+
+def _get_pool_args(settings: PGVectorSettings) -> dict[str, Any]:
+    return {
+        "pool_size": settings.pool_size,
+        "max_overflow": settings.max_overflow,
+        "pool_timeout": settings.pool_timeout,
+        "pool_recycle": settings.pool_recycle,
+        "pool_pre_ping": settings.pool_pre_ping,
+    }
+
+
+def _get_shared(
+    connection_str: str, settings: Settings, create: Any
+) -> Union[Engine, AsyncEngine]:
+    key = (
+        connection_str,
+        settings.pgvector.model_dump_json(),
+        tuple(sorted(_get_server_settings(settings).items())),
+    )
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create()
+        return _engines[key]
+
+
+def get_engine(settings: Settings) -> Engine:
+    """Get the pooled psycopg2 engine shared by the process.
+
+    Connections run with the statement timeout and the query time parameters of
+    the vector index.
+    """
+    connection_str = get_pgvector_connection_str(settings.pgvector)
+    options = " ".join(
+        f"-c {name}={value}" for name, value in _get_server_settings(settings).items()
+    )
+    return _get_shared(
+        connection_str,
+        settings,
+        lambda: sa.create_engine(
+            connection_str,
+            poolclass=TimedQueuePool,
+            connect_args={"options": options},
+            **_get_pool_args(settings.pgvector),
+        ),
+    )
+
+
+def get_async_engine(settings: Settings) -> AsyncEngine:
+    """Get the pooled asyncpg engine shared by the process, see `get_engine`.
+
+    Its connections belong to the event loop they were opened in, so it is only
+    to be used in the event loop of the API.
+    """
+    connection_str = get_pgvector_connection_str(settings.pgvector, as_async=True)
+    return _get_shared(
+        connection_str,
+        settings,
+        lambda: create_async_engine(
+            connection_str,
+            poolclass=TimedAsyncAdaptedQueuePool,
+            connect_args={"server_settings": _get_server_settings(settings)},
+            **_get_pool_args(settings.pgvector),
+        ),
+    )
+
+
+def get_pool_stats(engine: Union[Engine, AsyncEngine]) -> dict[str, Any]:
+    """Utilization of the pool of a shared engine and its checkout wait times."""
+    pool = engine.pool
+    timings = pool.checkout_timings
+    capacity = pool.size() + max(pool.max_overflow, 0)
+    checked_out = pool.checkedout()
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": pool.max_overflow,
+        "connections": checked_out + pool.checkedin(),
+        "checked_out": checked_out,
+        "utilization": checked_out / capacity if capacity else 0.0,
+        "checkouts": timings.checkouts,
+        "checkout_timeouts": timings.timeouts,
+        "checkout_wait_ms_avg": (
+            1000 * timings.wait_seconds_total / timings.checkouts
+            if timings.checkouts
+            else 0.0
+        ),
+        "checkout_wait_ms_max": 1000 * timings.wait_seconds_max,
+    }
+
+
+async def dispose_engines() -> None:
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        if isinstance(engine, AsyncEngine):
+            await engine.dispose()
+        else:
+            engine.dispose()
+
+
+def get_sql_record_manager(settings: Settings, namespace: str) -> PostgresRecordManager:
+    return PostgresRecordManager(namespace=namespace, engine=get_engine(settings))
+
+
+def get_pgvector(
+    settings: Settings,
+    embedding: Embeddings,
+    logger: Optional[logging.Logger] = None,
+) -> PGVector:
+    """Get the vector store, with the query time parameters of the vector index."""
+    kwargs: dict[str, Any] = dict(
+        collection_name=DB_COLLECTION_NAME,
+        connection_string=get_pgvector_connection_str(settings.pgvector),
+        embedding_function=embedding,
+        logger=logger,
+        engine=get_engine(settings),
     )
+    if settings.indexing.bulk_write:
+        return BulkPGVector(
+            delete_batch_size=settings.indexing.cleanup_batch_size, **kwargs
+        )
+    return SharedEnginePGVector(**kwargs)
@@ -0,0 +1,83 @@
+"""Module to manage the full text search column and index on the chunks"""
+
+import logging
+
+import sqlalchemy as sa
+from core.vector_index import EMBEDDING_TABLE
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+TEXT_SEARCH_COLUMN = "document_tsv"
+TEXT_SEARCH_INDEX = f"ix_{EMBEDDING_TABLE}_{TEXT_SEARCH_COLUMN}"
+
+# Serializes the schema changes of concurrently starting API workers and ingests
+_TEXT_SEARCH_LOCK_ID = 1_829_441_338
+
+
+def _column_exists(connection: sa.Connection) -> bool:
+    return connection.execute(
+        sa.text(
+            "SELECT EXISTS (SELECT 1 FROM pg_attribute "
+            "WHERE attrelid = CAST(:table AS regclass) AND attname = :column "
+            "AND NOT attisdropped)"
+        ),
+        {"table": EMBEDDING_TABLE, "column": TEXT_SEARCH_COLUMN},
+    ).scalar_one()
+
+
+def create_text_search_index(engine: Engine, text_search_config: str) -> bool:
+    """Add the tsvector column of the chunks and its GIN index, if missing.
+
+    The column is generated from the `document` column, so postgres keeps it up
+    to date on every write of the ORM and COPY vector stores. Adding it rewrites
+    the table once, best done on an empty table before the first ingest. The
+    text search configuration, e.g. "english", is fixed when the column is
+    added; changing it requires dropping the column.
+
+    Returns:
+        Whether the column or the index was created.
+    """
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        if connection.execute(
+            sa.text("SELECT to_regclass(:name) IS NULL"), {"name": EMBEDDING_TABLE}
+        ).scalar_one():
+            logger.warning(f"Table {EMBEDDING_TABLE} does not exist yet.")
+            return False
+        connection.execute(
+            sa.text("SELECT pg_advisory_lock(:id)"), {"id": _TEXT_SEARCH_LOCK_ID}
+        )
+        # The rewrite and the index build outlast the timeout of the shared engines
+        connection.execute(sa.text("SET statement_timeout = 0"))
+        try:
+            created = False
+            if not _column_exists(connection):
+                logger.info(f"Adding the {text_search_config} text search column")
+                connection.execute(
+                    sa.text(
+                        f"ALTER TABLE {EMBEDDING_TABLE} ADD COLUMN "
+                        f"{TEXT_SEARCH_COLUMN} tsvector GENERATED ALWAYS AS "
+                        f"(to_tsvector('{text_search_config}', "
+                        "coalesce(document, ''))) STORED"
+                    )
+                )
+                created = True
+            if connection.execute(
+                sa.text("SELECT to_regclass(:name) IS NULL"),
+                {"name": TEXT_SEARCH_INDEX},
+            ).scalar_one():
+                logger.info(f"Building GIN index {TEXT_SEARCH_INDEX}")
+                connection.execute(
+                    sa.text(
+                        f"CREATE INDEX CONCURRENTLY {TEXT_SEARCH_INDEX} "
+                        f"ON {EMBEDDING_TABLE} USING gin ({TEXT_SEARCH_COLUMN})"
+                    )
+                )
+                created = True
+            return created
+        finally:
+            connection.execute(sa.text("RESET statement_timeout"))
+            connection.execute(
+                sa.text("SELECT pg_advisory_unlock(:id)"), {"id": _TEXT_SEARCH_LOCK_ID}
+            )
@@ -0,0 +1,416 @@
+"""Module to manage approximate nearest neighbour indexes on the embeddings"""
+
+import logging
+import statistics
+import time
+from collections import Counter
+from typing import Optional
+
+import sqlalchemy as sa
+from core.config import EmbedSettings, VectorIndexSettings
+from pydantic import BaseModel
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_TABLE = "langchain_pg_embedding"
+COLLECTION_TABLE = "langchain_pg_collection"
+
+# Serializes index builds of concurrently starting API workers
+_INDEX_BUILD_LOCK_ID = 1_829_441_337
+
+# pgvector types of the stored vectors by precision
+VECTOR_TYPES = {"float32": "vector", "float16": "halfvec"}
+# halfvec and binary_quantize
+_MIN_QUANTIZATION_VERSION = (0, 7, 0)
+
+
+class RecallReport(BaseModel):
+    method: str
+    rescore_candidates: Optional[int]
+    k: int
+    num_queries: int
+    recall: float
+    ann_latency_p50_ms: float
+    exact_latency_p50_ms: float
+
+
+def get_vector_index_name(collection_name: str) -> str:
+    return f"ix_{EMBEDDING_TABLE}_{collection_name}_ann"
+
+
+def get_vector_type(embed: EmbedSettings) -> str:
+    return VECTOR_TYPES[embed.storage_precision]
+
+
+def get_search_server_settings(
+    settings: VectorIndexSettings, embed: EmbedSettings
+) -> dict[str, str]:
+    """Server settings of a connection setting the query time ANN parameters.
+
+    The parameters are set once per connection, so every similarity search on
+    the shared engines runs with them. An HNSW scan returns at most ef_search
+    rows, so it is raised to the candidates of a binary first pass.
+    """
+    ef_search = settings.ef_search
+    if embed.binary_first_pass:
+        ef_search = max(ef_search, embed.rescore_candidates)
+    return {
+        "hnsw.ef_search": str(ef_search),
+        "ivfflat.probes": str(settings.probes),
+    }
+
+
+def _get_collection_id(connection: Connection, collection_name: str) -> Optional[str]:
+    return connection.execute(
+        sa.text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name"),
+        {"name": collection_name},
+    ).scalar()
+
+
+def _get_dimensions(connection: Connection, collection_id: str) -> Optional[int]:
+    return connection.execute(
+        sa.text(
+            f"SELECT vector_dims(embedding) FROM {EMBEDDING_TABLE} "
+            "WHERE collection_id = :collection_id LIMIT 1"
+        ),
+        {"collection_id": collection_id},
+    ).scalar()
+
+
+def _get_column_type(connection: Connection) -> str:
+    return connection.execute(
+        sa.text(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = CAST(:table AS regclass) AND attname = 'embedding'"
+        ),
+        {"table": EMBEDDING_TABLE},
+    ).scalar_one()
+
+
+def _get_base_type(column_type: str) -> str:
+    """The type without the dimensions, e.g. halfvec of halfvec(384)."""
+    return column_type.split("(", 1)[0]
+
+
+def get_binary_quantized_expression(dimensions: int) -> str:
+    """The bits of the embeddings, the expression of a binary quantized index."""
+    return f"CAST(binary_quantize(embedding) AS bit({dimensions}))"
+
+
+def _index_definition(
+    settings: VectorIndexSettings,
+    vector_type: str,
+    dimensions: int,
+    binary_quantized: bool,
+) -> str:
+    if binary_quantized:
+        column = f"({get_binary_quantized_expression(dimensions)}) bit_hamming_ops"
+    else:
+        column = f"embedding {vector_type}_cosine_ops"
+    if settings.method == "hnsw":
+        return (
+            f"USING hnsw ({column}) "
+            f"WITH (m = {settings.m}, ef_construction = {settings.ef_construction})"
+        )
+    if settings.method == "ivfflat":
+        return f"USING ivfflat ({column}) WITH (lists = {settings.lists})"
+    raise ValueError(f"Unsupported vector index method: {settings.method}")
+
+
+def _get_extension_version(connection: Connection) -> tuple[int, ...]:
+    version = connection.execute(
+        sa.text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    ).scalar_one()
+    return tuple(int(part) for part in version.split("."))
+
+
+def set_vector_storage(
+    engine: Engine, collection_name: str, embed: EmbedSettings, dimensions: int
+) -> bool:
+    """Type the embedding column with the configured precision and dimensions.
+
+    float16 stores halfvec, half the size of vector. The binary first pass
+    needs no column of its own, its index is on an expression, see
+    `create_vector_index`. Both need pgvector 0.7, the extension is updated if
+    the server provides it. Changing the type rewrites the table and drops the
+    ANN index of the collection, which is to be rebuilt.
+
+    Returns:
+        Whether the column type was changed.
+    """
+    vector_type = get_vector_type(embed)
+    column_type = f"{vector_type}({dimensions})"
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(
+            sa.text("SELECT pg_advisory_lock(:id)"), {"id": _INDEX_BUILD_LOCK_ID}
+        )
+        connection.execute(sa.text("SET statement_timeout = 0"))
+        try:
+            if (
+                vector_type != "vector" or embed.binary_first_pass
+            ) and _get_extension_version(connection) < _MIN_QUANTIZATION_VERSION:
+                connection.execute(sa.text("ALTER EXTENSION vector UPDATE"))
+                if _get_extension_version(connection) < _MIN_QUANTIZATION_VERSION:
+                    raise ValueError(
+                        "halfvec storage and the binary first pass need "
+                        "pgvector 0.7 or newer on the server."
+                    )
+
+            current_type = _get_column_type(connection)
+            if current_type == column_type:
+                return False
+            if current_type not in ("vector", "halfvec"):
+                index_name = get_vector_index_name(collection_name)
+                logger.warning(f"Dropping {index_name}, rebuild it for {column_type}")
+                connection.execute(
+                    sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+                )
+            logger.info(f"Storing the embeddings as {column_type}")
+            connection.execute(
+                sa.text(
+                    f"ALTER TABLE {EMBEDDING_TABLE} ALTER COLUMN embedding "
+                    f"TYPE {column_type} USING CAST(embedding AS {column_type})"
+                )
+            )
+            return True
+        finally:
+            connection.execute(sa.text("RESET statement_timeout"))
+            connection.execute(
+                sa.text("SELECT pg_advisory_unlock(:id)"), {"id": _INDEX_BUILD_LOCK_ID}
+            )
+
+
+def create_vector_index(
+    engine: Engine,
+    collection_name: str,
+    settings: VectorIndexSettings,
+    rebuild: bool = False,
+    binary_quantized: bool = False,
+) -> bool:
+    """Create the ANN index on the embeddings of a collection.
+
+    pgvector can only index a column of a fixed dimension, while PGVector creates
+    the embedding column without one. The column is therefore typed with the
+    dimension of the stored embeddings first, which requires at least one
+    embedding in the collection. The index is partial on the collection, matching
+    the collection filter of every similarity search, and built concurrently so
+    ingestion is not blocked. With `rebuild`, an existing index is dropped first,
+    e.g. to apply new index parameters. A `binary_quantized` index is on the
+    binary quantized embeddings, for the first pass of a search rescoring its
+    candidates by their full vectors.
+
+    Returns:
+        Whether an index was built.
+    """
+    if settings.method == "none":
+        logger.info("No vector index method configured, skipping.")
+        return False
+
+    index_name = get_vector_index_name(collection_name)
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(
+            sa.text("SELECT pg_advisory_lock(:id)"), {"id": _INDEX_BUILD_LOCK_ID}
+        )
+        try:
+            collection_id = _get_collection_id(connection, collection_name)
+            if collection_id is None:
+                logger.warning(f"Collection {collection_name} not found.")
+                return False
+            dimensions = _get_dimensions(connection, collection_id)
+            if dimensions is None:
+                logger.warning(f"Collection {collection_name} has no embeddings yet.")
+                return False
+
+            column_type = _get_column_type(connection)
+            vector_type = _get_base_type(column_type)
+            if column_type == vector_type:
+                logger.info(f"Setting the embedding dimension to {dimensions}")
+                connection.execute(
+                    sa.text(
+                        f"ALTER TABLE {EMBEDDING_TABLE} "
+                        f"ALTER COLUMN embedding TYPE {vector_type}({dimensions})"
+                    )
+                )
+
+            if rebuild:
+                connection.execute(
+                    sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+                )
+            elif _index_exists(connection, index_name):
+                return False
+
+            logger.info(f"Building {settings.method} index {index_name}")
+            start = time.perf_counter()
+            definition = _index_definition(
+                settings, vector_type, dimensions, binary_quantized
+            )
+            connection.execute(
+                sa.text(
+                    f"CREATE INDEX CONCURRENTLY {index_name} ON {EMBEDDING_TABLE} "
+                    f"{definition} WHERE collection_id = '{collection_id}'"
+                )
+            )
+            logger.info(f"Built {index_name} in {time.perf_counter() - start:.1f}s")
+            return True
+        finally:
+            connection.execute(
+                sa.text("SELECT pg_advisory_unlock(:id)"), {"id": _INDEX_BUILD_LOCK_ID}
+            )
+
+
+def _index_exists(connection: Connection, index_name: str) -> bool:
+    return connection.execute(
+        sa.text("SELECT to_regclass(:name) IS NOT NULL"), {"name": index_name}
+    ).scalar_one()
+
+
+def validate_vector_index(
+    engine: Engine,
+    collection_name: str,
+    settings: VectorIndexSettings,
+    binary_quantized: bool = False,
+) -> list[str]:
+    """Check the ANN index of a collection against the settings.
+
+    Returns:
+        Problems found, empty if the index is usable and matches the settings.
+    """
+    index_name = get_vector_index_name(collection_name)
+    with engine.connect() as connection:
+        row = connection.execute(
+            sa.text(
+                "SELECT am.amname AS method, ix.indisvalid AS is_valid, "
+                "c.reloptions AS options, "
+                "ix.indexprs IS NOT NULL AS is_binary_quantized "
+                "FROM pg_class c "
+                "JOIN pg_index ix ON ix.indexrelid = c.oid "
+                "JOIN pg_am am ON am.oid = c.relam "
+                "WHERE c.oid = to_regclass(:name)"
+            ),
+            {"name": index_name},
+        ).first()
+
+    if row is None:
+        if settings.method == "none":
+            return []
+        return [f"Index {index_name} does not exist."]
+
+    problems = []
+    if settings.method == "none":
+        problems.append(f"Index {index_name} exists, but no method is configured.")
+    elif row.method != settings.method:
+        problems.append(
+            f"Index {index_name} uses {row.method}, configured is {settings.method}."
+        )
+    if not row.is_valid:
+        problems.append(f"Index {index_name} is invalid, a build failed. Rebuild it.")
+    if row.is_binary_quantized != binary_quantized:
+        problems.append(
+            f"Index {index_name} is {'' if row.is_binary_quantized else 'not '}"
+            "on the binary quantized embeddings, the binary first pass is "
+            f"{'enabled' if binary_quantized else 'disabled'}. Rebuild it."
+        )
+
+    expected = {"hnsw": {"m", "ef_construction"}, "ivfflat": {"lists"}}
+    options = dict(option.split("=", 1) for option in row.options or [])
+    for name in expected.get(row.method, set()):
+        configured = str(getattr(settings, name))
+        if options.get(name, configured) != configured:
+            problems.append(
+                f"Index {index_name} has {name}={options[name]}, "
+                f"configured is {configured}."
+            )
+    return problems
+
+
+def measure_recall(
+    engine: Engine,
+    collection_name: str,
+    settings: VectorIndexSettings,
+    k: int = 10,
+    num_queries: int = 50,
+    rescore_candidates: Optional[int] = None,
+) -> RecallReport:
+    """Compare the ANN search to an exact search, for the tuning of the index.
+
+    Stored embeddings of the collection serve as query vectors. The ANN search
+    is the one of the retrievers, with `rescore_candidates` the binary first
+    pass rescoring that many candidates, see `create_vector_index`. The exact
+    search runs with index scans disabled, so it is a sequential scan over the
+    full vectors of the collection.
+    """
+    # The retrievers depend on this module
+    from core.retrieval import get_similarity_search_query
+
+    with engine.connect() as connection:
+        with connection.begin():
+            collection_id = _get_collection_id(connection, collection_name)
+            if collection_id is None:
+                raise ValueError(f"Collection {collection_name} not found.")
+            vector_type = _get_base_type(_get_column_type(connection))
+            dimensions = _get_dimensions(connection, collection_id)
+            queries = (
+                connection.execute(
+                    sa.text(
+                        f"SELECT CAST(embedding AS text) FROM {EMBEDDING_TABLE} "
+                        "WHERE collection_id = :collection_id "
+                        "ORDER BY random() LIMIT :num_queries"
+                    ),
+                    {"collection_id": collection_id, "num_queries": num_queries},
+                )
+                .scalars()
+                .all()
+            )
+
+        exact_search = get_similarity_search_query(vector_type, filtered=False)
+        ann_search = get_similarity_search_query(
+            vector_type,
+            filtered=False,
+            binary_dimensions=dimensions if rescore_candidates else None,
+        )
+        # As set on the connections of the retrievers
+        ef_search = max(settings.ef_search, rescore_candidates or 0)
+
+        def run(query: str, exact: bool) -> tuple[Counter, float]:
+            params = {"collection_id": collection_id, "embedding": query, "k": k}
+            with connection.begin():
+                if exact:
+                    connection.execute(sa.text("SET LOCAL enable_indexscan = off"))
+                else:
+                    connection.execute(
+                        sa.text(f"SET LOCAL hnsw.ef_search = {ef_search}")
+                    )
+                    connection.execute(
+                        sa.text(f"SET LOCAL ivfflat.probes = {settings.probes}")
+                    )
+                    if rescore_candidates:
+                        params["candidates"] = max(rescore_candidates, k)
+                start = time.perf_counter()
+                rows = connection.execute(
+                    exact_search if exact else ann_search, params
+                ).all()
+                # Chunks by content, duplicates count as often as they are found
+                return Counter(map(tuple, rows)), (time.perf_counter() - start) * 1000
+
+        recalls, ann_latencies, exact_latencies = [], [], []
+        for query in queries:
+            ann_chunks, ann_latency = run(query, exact=False)
+            exact_chunks, exact_latency = run(query, exact=True)
+            recalls.append(
+                (ann_chunks & exact_chunks).total() / max(exact_chunks.total(), 1)
+            )
+            ann_latencies.append(ann_latency)
+            exact_latencies.append(exact_latency)
+
+    return RecallReport(
+        method=settings.method,
+        rescore_candidates=rescore_candidates,
+        k=k,
+        num_queries=len(queries),
+        recall=statistics.fmean(recalls) if recalls else 0.0,
+        ann_latency_p50_ms=statistics.median(ann_latencies) if queries else 0.0,
+        exact_latency_p50_ms=statistics.median(exact_latencies) if queries else 0.0,
+    )
@@ -0,0 +1,194 @@
+"""Module with PGVector stores writing through a shared engine"""
+
+import io
+import json
+import struct
+import uuid
+from typing import Any, Iterable, Optional
+
+import numpy as np
+import sqlalchemy as sa
+from core.vector_index import COLLECTION_TABLE, EMBEDDING_TABLE
+from langchain.vectorstores.pgvector import PGVector
+from sqlalchemy.engine import Engine
+
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+_NULL = struct.pack("!i", -1)
+_COPY_COLUMNS = (
+    "uuid",
+    "collection_id",
+    "embedding",
+    "document",
+    "cmetadata",
+    "custom_id",
+)
+# Version of the binary jsonb format
+_JSONB_VERSION = b"\x01"
+
+
+class SharedEnginePGVector(PGVector):
+    """PGVector running on a shared engine instead of a connection of its own.
+
+    Every operation checks a connection out of the pool of the engine and
+    returns it afterwards.
+    """
+
+    def __init__(self, *args: Any, engine: Engine, **kwargs: Any) -> None:
+        # Sessions and transactions of PGVector work on an engine as well
+        super().__init__(*args, connection=engine, **kwargs)
+
+    def __del__(self) -> None:
+        # The engine is not owned by the vector store
+        pass
+
+
+def encode_vector(embedding: list[float]) -> bytes:
+    """The binary format of a pgvector `vector`, dimensions and float4 values."""
+    vector = np.asarray(embedding, dtype=">f4")
+    return struct.pack("!hh", len(vector), 0) + vector.tobytes()
+
+
+def encode_halfvec(embedding: list[float]) -> bytes:
+    """The binary format of a pgvector `halfvec`, dimensions and float2 values."""
+    vector = np.asarray(embedding, dtype=">f2")
+    return struct.pack("!hh", len(vector), 0) + vector.tobytes()
+
+
+# By the type of the embedding column, see `core.vector_index.set_vector_storage`
+_VECTOR_ENCODERS = {"vector": encode_vector, "halfvec": encode_halfvec}
+
+
+def _write_field(buffer: io.BytesIO, value: Optional[bytes]) -> None:
+    if value is None:
+        buffer.write(_NULL)
+    else:
+        buffer.write(struct.pack("!i", len(value)))
+        buffer.write(value)
+
+
+class BulkPGVector(SharedEnginePGVector):
+    """PGVector writing with binary `COPY` and deleting with batched `ANY` deletes.
+
+    The ORM of PGVector inserts one row per chunk; here a batch is one `COPY`
+    in one transaction. The rows are the same, so stores and retrievers reading
+    the table are not affected. Writes need the psycopg2 driver.
+    """
+
+    def __init__(
+        self, *args: Any, engine: Engine, delete_batch_size: int = 1_000, **kwargs: Any
+    ) -> None:
+        self.delete_batch_size = delete_batch_size
+        super().__init__(*args, engine=engine, **kwargs)
+
+    def create_tables_if_not_exists(self) -> None:
+        super().create_tables_if_not_exists()
+        # Deletes look chunks up by their ids, which upstream does not index
+        with self._conn.begin() as connection:
+            connection.execute(
+                sa.text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{EMBEDDING_TABLE}_custom_id "
+                    f"ON {EMBEDDING_TABLE} (custom_id)"
+                )
+            )
+
+    def _get_column_types(self, connection: sa.Connection) -> dict[str, str]:
+        # Looked up per write, `create_metadata_index` converts the metadata to
+        # jsonb and `set_vector_storage` may store the embeddings as halfvec
+        rows = connection.execute(
+            sa.text(
+                "SELECT attname, format_type(atttypid, NULL) FROM pg_attribute "
+                "WHERE attrelid = CAST(:table AS regclass) "
+                "AND attname IN ('embedding', 'cmetadata')"
+            ),
+            {"table": EMBEDDING_TABLE},
+        )
+        return dict(rows.tuples().all())
+
+    def _encode_rows(
+        self,
+        collection_id: uuid.UUID,
+        texts: list[str],
+        embeddings: list[list[float]],
+        metadatas: list[dict],
+        ids: list[str],
+        column_types: dict[str, str],
+    ) -> io.BytesIO:
+        encode_embedding = _VECTOR_ENCODERS[column_types["embedding"]]
+        buffer = io.BytesIO()
+        buffer.write(_COPY_HEADER)
+        field_count = struct.pack("!h", len(_COPY_COLUMNS))
+        for text, embedding, metadata, id in zip(texts, embeddings, metadatas, ids):
+            cmetadata = json.dumps(metadata).encode("utf-8")
+            if column_types["cmetadata"] == "jsonb":
+                cmetadata = _JSONB_VERSION + cmetadata
+            buffer.write(field_count)
+            _write_field(buffer, uuid.uuid4().bytes)
+            _write_field(buffer, collection_id.bytes)
+            _write_field(buffer, encode_embedding(embedding))
+            _write_field(buffer, None if text is None else text.encode("utf-8"))
+            _write_field(buffer, cmetadata)
+            _write_field(buffer, None if id is None else id.encode("utf-8"))
+        buffer.write(_COPY_TRAILER)
+        buffer.seek(0)
+        return buffer
+
+    def add_embeddings(
+        self,
+        texts: Iterable[str],
+        embeddings: list[list[float]],
+        metadatas: Optional[list[dict]] = None,
+        ids: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        if ids is None:
+            ids = [str(uuid.uuid1()) for _ in texts]
+        if not metadatas:
+            metadatas = [{} for _ in texts]
+        if not texts:
+            return ids
+
+        with self._conn.begin() as connection:
+            collection_id = connection.execute(
+                sa.text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name"),
+                {"name": self.collection_name},
+            ).scalar()
+            if collection_id is None:
+                raise ValueError("Collection not found")
+            buffer = self._encode_rows(
+                uuid.UUID(str(collection_id)),
+                texts,
+                embeddings,
+                metadatas,
+                ids,
+                self._get_column_types(connection),
+            )
+            cursor = connection.connection.cursor()
+            try:
+                cursor.copy_expert(
+                    f"COPY {EMBEDDING_TABLE} ({', '.join(_COPY_COLUMNS)}) "
+                    "FROM STDIN WITH (FORMAT binary)",
+                    buffer,
+                )
+            finally:
+                cursor.close()
+        return ids
+
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> None:
+        if not ids:
+            return
+        # Unlike upstream, only the chunks of this collection are deleted
+        with self._conn.begin() as connection:
+            for start in range(0, len(ids), self.delete_batch_size):
+                connection.execute(
+                    sa.text(
+                        f"DELETE FROM {EMBEDDING_TABLE} "
+                        "WHERE custom_id = ANY(:ids) AND collection_id = "
+                        f"(SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name)"
+                    ),
+                    {
+                        "ids": list(ids[start : start + self.delete_batch_size]),
+                        "name": self.collection_name,
+                    },
+                )
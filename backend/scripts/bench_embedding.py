@@ -0,0 +1,109 @@
+"""Compare the throughput and the vectors of the embedding backends.
+
+Embeds the same chunks, those of the indexed collection or synthetic ones of
+varying length, as one ingest workload through `embed_documents`, and short
+questions one at a time through `embed_query` as the query workload. Prints
+chunks per second of both workloads per backend, and the smallest cosine
+similarity of its vectors to those of the sentence-transformers backend.
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+import sqlalchemy as sa
+from core.config import get_api_settings
+from core.constants import DB_COLLECTION_NAME
+from core.embedding import get_embeddings_model
+from core.onnx_embedding import min_cosine_similarity
+from core.storage import get_pgvector_connection_str
+from core.vector_index import COLLECTION_TABLE, EMBEDDING_TABLE
+
+WORDS = (
+    "chain retriever vector store embedding prompt template agent tool memory "
+    "document loader splitter callback runnable stream batch invoke model"
+).split()
+
+
+def load_chunks(connection_str: str, num_chunks: int) -> list[str]:
+    engine = sa.create_engine(connection_str)
+    try:
+        with engine.connect() as connection:
+            return list(
+                connection.execute(
+                    sa.text(
+                        f"SELECT e.document FROM {EMBEDDING_TABLE} e "
+                        f"JOIN {COLLECTION_TABLE} c ON c.uuid = e.collection_id "
+                        "WHERE c.name = :name ORDER BY random() LIMIT :limit"
+                    ),
+                    {"name": DB_COLLECTION_NAME, "limit": num_chunks},
+                ).scalars()
+            )
+    finally:
+        engine.dispose()
+
+
+def generate_texts(num_texts: int, min_words: int, max_words: int) -> list[str]:
+    rnd = random.Random(0)
+    return [
+        " ".join(rnd.choices(WORDS, k=rnd.randint(min_words, max_words)))
+        for _ in range(num_texts)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--from-collection", action="store_true")
+    args = parser.parse_args()
+
+    settings = get_api_settings()
+    chunks = (
+        load_chunks(get_pgvector_connection_str(settings.pgvector), args.chunks)
+        if args.from_collection
+        else generate_texts(args.chunks, 20, 600)
+    )
+    if not chunks:
+        raise SystemExit("No chunks, is the collection empty?")
+    queries = generate_texts(args.queries, 4, 16)
+
+    backends = {
+        "sentence_transformers": settings.embed.model_copy(
+            update={"backend": "sentence_transformers"}
+        ),
+        "onnx": settings.embed.model_copy(
+            update={"backend": "onnx", "quantize": False}
+        ),
+        "onnx_int8": settings.embed.model_copy(
+            update={"backend": "onnx", "quantize": True}
+        ),
+    }
+    reference = None
+    for name, embed in backends.items():
+        model = get_embeddings_model(embed)
+
+        start = time.perf_counter()
+        vectors = model.embed_documents(chunks)
+        ingest_seconds = time.perf_counter() - start
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            model.embed_query(query)
+            latencies.append(time.perf_counter() - start)
+
+        if reference is None:
+            reference = vectors
+        print(
+            f"{name:>21}: "
+            f"ingest {len(chunks) / ingest_seconds:8.1f} chunks/s, "
+            f"query {len(queries) / sum(latencies):8.1f} chunks/s "
+            f"(p50 {statistics.median(latencies) * 1000:6.1f} ms), "
+            f"min cosine similarity {min_cosine_similarity(reference, vectors):.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
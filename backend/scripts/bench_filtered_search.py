@@ -0,0 +1,153 @@
+"""Compare the latency and recall of filtered and unfiltered similarity searches.
+
+Stored embeddings of the collection serve as query vectors. Each metadata
+filter, given as key=value or every source_type of the collection by default,
+is searched as planned by the retriever, see
+`core.retrieval.plan_filtered_search`, and exactly, ranking the chunks the GIN
+index of the metadata selects. The exact results are the ground truth of the
+recall@k of the planned search. Prints the chunks each filter matches, the plan
+and p50/p95 latency per search, next to the unfiltered search.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import sqlalchemy as sa
+from core.config import get_api_settings
+from core.constants import DB_COLLECTION_NAME, SQL_RECORD_MANAGAR_NAMESPACE
+from core.retrieval import AsyncPGVectorRetriever
+from core.storage import get_async_engine, get_engine
+from core.vector_index import COLLECTION_TABLE, EMBEDDING_TABLE, get_vector_type
+from langchain.embeddings import FakeEmbeddings
+
+
+def load_query_vectors(engine: sa.Engine, num_queries: int) -> list[list[float]]:
+    with engine.connect() as connection:
+        return [
+            [float(value) for value in vector.strip("[]").split(",")]
+            for vector in connection.execute(
+                sa.text(
+                    f"SELECT CAST(e.embedding AS text) FROM {EMBEDDING_TABLE} e "
+                    f"JOIN {COLLECTION_TABLE} c ON c.uuid = e.collection_id "
+                    "WHERE c.name = :name ORDER BY random() LIMIT :limit"
+                ),
+                {"name": DB_COLLECTION_NAME, "limit": num_queries},
+            ).scalars()
+        ]
+
+
+def load_filters(engine: sa.Engine) -> list[dict[str, str]]:
+    with engine.connect() as connection:
+        return [
+            {"source_type": source_type}
+            for source_type in connection.execute(
+                sa.text(
+                    f"SELECT DISTINCT e.cmetadata->>'source_type' "
+                    f"FROM {EMBEDDING_TABLE} e "
+                    f"JOIN {COLLECTION_TABLE} c ON c.uuid = e.collection_id "
+                    "WHERE c.name = :name AND e.cmetadata ? 'source_type'"
+                ),
+                {"name": DB_COLLECTION_NAME},
+            ).scalars()
+        ]
+
+
+def count_matches(engine: sa.Engine, metadata_filter: dict[str, str]) -> int:
+    with engine.connect() as connection:
+        return connection.execute(
+            sa.text(
+                f"SELECT count(*) FROM {EMBEDDING_TABLE} e "
+                f"JOIN {COLLECTION_TABLE} c ON c.uuid = e.collection_id "
+                "WHERE c.name = :name "
+                "AND e.cmetadata @> CAST(:metadata_filter AS jsonb)"
+            ),
+            {
+                "name": DB_COLLECTION_NAME,
+                "metadata_filter": json.dumps(metadata_filter),
+            },
+        ).scalar_one()
+
+
+def search(
+    retriever: AsyncPGVectorRetriever, vectors: list[list[float]]
+) -> tuple[list[list[str]], list[float]]:
+    results, latencies = [], []
+    for vector in vectors:
+        with retriever.engine.connect() as connection:
+            start = time.perf_counter()
+            docs = retriever._search(connection, vector)
+            latencies.append((time.perf_counter() - start) * 1000)
+        results.append([doc.page_content for doc in docs])
+    return results, latencies
+
+
+def _summary(latencies: list[float]) -> str:
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else 0.0
+    return f"p50 {statistics.median(latencies):7.1f} ms, p95 {p95:7.1f} ms"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "filters", nargs="*", help="key=value, one filter of one key each"
+    )
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=6)
+    args = parser.parse_args()
+
+    settings = get_api_settings()
+    engine = get_engine(settings)
+    vectors = load_query_vectors(engine, args.queries)
+    if not vectors:
+        raise SystemExit("No embeddings, is the collection empty?")
+    filters = [dict([f.split("=", 1)]) for f in args.filters] or load_filters(engine)
+
+    retriever_args = dict(
+        embedding=FakeEmbeddings(size=len(vectors[0])),
+        engine=engine,
+        async_engine=get_async_engine(settings),
+        collection_name=DB_COLLECTION_NAME,
+        record_manager_namespace=SQL_RECORD_MANAGAR_NAMESPACE,
+        k=args.k,
+        vector_type=get_vector_type(settings.embed),
+        rescore_candidates=(
+            settings.embed.rescore_candidates
+            if settings.embed.binary_first_pass
+            else None
+        ),
+        filter_max_scan_tuples=settings.vector_index.filter_max_scan_tuples,
+    )
+    planned = AsyncPGVectorRetriever(
+        filter_exact_max_rows=settings.vector_index.filter_exact_max_rows,
+        **retriever_args,
+    )
+    # Separate instances, the plans are cached per retriever and its copies
+    exact = AsyncPGVectorRetriever(filter_exact_max_rows=sys.maxsize, **retriever_args)
+
+    # Warms up the connections and the caches of the server
+    search(planned, vectors)
+    _, latencies = search(planned, vectors)
+    print(f"{'unfiltered':>32}: {_summary(latencies)}")
+    for metadata_filter in filters:
+        name = ",".join(f"{key}={value}" for key, value in metadata_filter.items())
+        matches = count_matches(engine, metadata_filter)
+        exact_results, exact_latencies = search(
+            exact.with_filter(metadata_filter), vectors
+        )
+        filtered = planned.with_filter(metadata_filter)
+        search(filtered, vectors)
+        results, latencies = search(filtered, vectors)
+        recall = statistics.fmean(
+            len(set(result) & set(expected)) / max(len(expected), 1)
+            for result, expected in zip(results, exact_results)
+        )
+        print(f"{name:>32}: {matches} chunks, plan {filtered._get_cached_plan()}")
+        print(f"{'exact':>32}: {_summary(exact_latencies)}")
+        print(f"{'planned':>32}: {_summary(latencies)}, recall@{args.k} {recall:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Compare the quality and latency of the vector and the hybrid retriever.
+
+Queries come from a JSON lines file of {"question": ..., "sources": [...]}, or
+are generated from the indexed chunks: a class or function name of a random
+chunk is asked for, and the page of the chunk is the relevant source. Prints
+per query the rank of the first relevant document and the latency of each
+retriever, and a summary of hit rate, MRR and latency percentiles.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import statistics
+import time
+
+import sqlalchemy as sa
+from core.config import get_api_settings
+from core.constants import DB_COLLECTION_NAME, SQL_RECORD_MANAGAR_NAMESPACE
+from core.embedding import get_query_embeddings
+from core.retrieval import AsyncPGVectorRetriever, HybridPGVectorRetriever
+from core.storage import dispose_engines, get_async_engine, get_engine
+from core.text_search import create_text_search_index
+from core.vector_index import COLLECTION_TABLE, EMBEDDING_TABLE
+
+# CamelCase class names and snake_case function names
+IDENTIFIER = re.compile(
+    r"\b([A-Z][a-z0-9]+(?:[A-Z][a-z0-9]*)+|[a-z]+(?:_[a-z0-9]+)+)\b"
+)
+
+
+def generate_queries(engine: sa.Engine, num_queries: int) -> list[tuple[str, set[str]]]:
+    with engine.connect() as connection:
+        rows = connection.execute(
+            sa.text(
+                f"SELECT e.document, e.cmetadata->>'source' AS source "
+                f"FROM {EMBEDDING_TABLE} e JOIN {COLLECTION_TABLE} c "
+                "ON c.uuid = e.collection_id WHERE c.name = :name "
+                "ORDER BY random() LIMIT :limit"
+            ),
+            {"name": DB_COLLECTION_NAME, "limit": num_queries * 10},
+        ).all()
+    rnd = random.Random(0)
+    queries = []
+    for row in rows:
+        names = IDENTIFIER.findall(row.document)
+        if names:
+            queries.append((f"How do I use {rnd.choice(names)}?", {row.source}))
+        if len(queries) == num_queries:
+            break
+    return queries
+
+
+def load_queries(path: str) -> list[tuple[str, set[str]]]:
+    with open(path) as f:
+        return [
+            (query["question"], set(query["sources"]))
+            for query in map(json.loads, f)
+            if query
+        ]
+
+
+def _percentile(values: list[float], percentile: int) -> float:
+    return (
+        statistics.quantiles(values, n=100)[percentile - 1]
+        if len(values) > 1
+        else values[0]
+    )
+
+
+async def bench(
+    retrievers: dict[str, AsyncPGVectorRetriever],
+    queries: list[tuple[str, set[str]]],
+) -> None:
+    # Loads the embedding model and opens the connections
+    for retriever in retrievers.values():
+        await retriever.ainvoke(queries[0][0])
+
+    ranks: dict[str, list[int]] = {name: [] for name in retrievers}
+    latencies: dict[str, list[float]] = {name: [] for name in retrievers}
+    for question, sources in queries:
+        line = []
+        for name, retriever in retrievers.items():
+            start = time.perf_counter()
+            docs = await retriever.ainvoke(question)
+            latency = (time.perf_counter() - start) * 1000
+            rank = next(
+                (
+                    rank
+                    for rank, doc in enumerate(docs, start=1)
+                    if doc.metadata.get("source") in sources
+                ),
+                0,
+            )
+            ranks[name].append(rank)
+            latencies[name].append(latency)
+            line.append(f"{name} rank {rank or '-':>2} {latency:7.1f} ms")
+        print(f"{question[:60]:<60} | " + " | ".join(line))
+
+    print()
+    for name in retrievers:
+        hits = [rank for rank in ranks[name] if rank]
+        print(
+            f"{name:>6}: hit rate {len(hits) / len(queries):.2f}, "
+            f"MRR {sum(1 / rank for rank in hits) / len(queries):.3f}, "
+            f"p50 {_percentile(latencies[name], 50):.1f} ms, "
+            f"p95 {_percentile(latencies[name], 95):.1f} ms"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--queries-file")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    settings = get_api_settings()
+    engine = get_engine(settings)
+    create_text_search_index(engine, settings.retrieval.text_search_config)
+    queries = (
+        load_queries(args.queries_file)
+        if args.queries_file
+        else generate_queries(engine, args.queries)
+    )
+    if not queries:
+        raise SystemExit("No queries, is the collection empty?")
+
+    retriever_args = dict(
+        embedding=get_query_embeddings(settings),
+        engine=engine,
+        async_engine=get_async_engine(settings),
+        collection_name=DB_COLLECTION_NAME,
+        record_manager_namespace=SQL_RECORD_MANAGAR_NAMESPACE,
+        k=args.k,
+    )
+    retrievers = {
+        "vector": AsyncPGVectorRetriever(**retriever_args),
+        "hybrid": HybridPGVectorRetriever(
+            text_search_config=settings.retrieval.text_search_config,
+            rrf_k=settings.retrieval.rrf_k,
+            **retriever_args,
+        ),
+    }
+
+    async def run() -> None:
+        try:
+            await bench(retrievers, queries)
+        finally:
+            await dispose_engines()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Time the lxml html extractor against the BeautifulSoup one.
+
+Without arguments the golden page of the parser tests is timed; pass html files,
+or a sitemap url to sample pages from, to time real pages. As the tests check
+on the golden page, the markdown of both backends must be byte-identical, pages
+where it differs are printed with their diff and exit with 1.
+"""
+
+import argparse
+import asyncio
+import difflib
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+from bs4 import BeautifulSoup, SoupStrainer
+from core.parser import (
+    LANGCHAIN_DOCS_TAGS,
+    langchain_docs_extractor,
+    langchain_docs_extractor_lxml,
+    parse_html,
+)
+from langchain.document_loaders import SitemapLoader
+
+# The golden page of tests/test_parser.py, covering the handled tags
+SAMPLE_PAGE = Path(__file__).parents[1] / "tests" / "data" / "docs_page.html"
+
+
+def extract_bs4(html: str) -> str:
+    soup = BeautifulSoup(
+        html, "lxml", parse_only=SoupStrainer(name=LANGCHAIN_DOCS_TAGS)
+    )
+    return langchain_docs_extractor(soup)
+
+
+def extract_lxml(html: str) -> str:
+    return langchain_docs_extractor_lxml(parse_html(html))
+
+
+def load_sitemap_pages(sitemap_url: str, limit: int) -> dict[str, str]:
+    loader = SitemapLoader(sitemap_url)
+    sitemap = loader._scrape(loader.web_path, parser="xml")
+    urls = [el["loc"].strip() for el in loader.parse_sitemap(sitemap) if "loc" in el]
+    urls = urls[:limit]
+    return dict(zip(urls, asyncio.run(loader.fetch_all(urls))))
+
+
+def time_extractor(
+    extract: Callable[[str], str], pages: list[str], rounds: int
+) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for html in pages:
+            extract(html)
+    return (time.perf_counter() - start) / (rounds * len(pages)) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="*", type=Path, help="html files to compare")
+    parser.add_argument("--sitemap", help="sitemap url to sample pages from")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    pages = {str(path): path.read_text(encoding="utf-8") for path in args.files}
+    if args.sitemap:
+        pages.update(load_sitemap_pages(args.sitemap, args.limit))
+    if not pages:
+        pages = {"sample": SAMPLE_PAGE.read_text(encoding="utf-8")}
+
+    num_different = 0
+    for name, html in pages.items():
+        expected, actual = extract_bs4(html), extract_lxml(html)
+        if expected != actual:
+            num_different += 1
+            print(f"Difference for {name}:")
+            sys.stdout.writelines(
+                difflib.unified_diff(
+                    expected.splitlines(keepends=True),
+                    actual.splitlines(keepends=True),
+                    fromfile="bs4",
+                    tofile="lxml",
+                )
+            )
+    print(f"{len(pages) - num_different}/{len(pages)} pages identical")
+
+    bs4_ms = time_extractor(extract_bs4, list(pages.values()), args.rounds)
+    lxml_ms = time_extractor(extract_lxml, list(pages.values()), args.rounds)
+    print(f"bs4:  {bs4_ms:.2f} ms/page")
+    print(f"lxml: {lxml_ms:.2f} ms/page ({bs4_ms / lxml_ms:.1f}x)")
+    if num_different:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Compare the size, latency and recall of the vector storage modes.
+
+Writes the same embeddings, random ones or those of the indexed collection, to
+one scratch schema per mode: float32 and float16 storage, each with and without
+a binary first pass. Builds the configured ANN index and searches with stored
+embeddings plus noise, against the exact float32 neighbours as ground truth.
+Prints table and index size, p50 latency and recall@k of each mode; the scratch
+schemas are dropped afterwards. float16 and the binary first pass need
+pgvector 0.7, modes the server does not support are skipped.
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+import numpy as np
+import sqlalchemy as sa
+from core.config import EmbedSettings, get_api_settings
+from core.constants import DB_COLLECTION_NAME
+from core.retrieval import get_similarity_search_query, to_vector_literal
+from core.storage import get_pgvector_connection_str
+from core.vector_index import (
+    COLLECTION_TABLE,
+    EMBEDDING_TABLE,
+    create_vector_index,
+    get_search_server_settings,
+    get_vector_index_name,
+    get_vector_type,
+    set_vector_storage,
+)
+from core.vector_store import BulkPGVector
+from langchain.embeddings import FakeEmbeddings
+
+COLLECTION_NAME = "bench_vector_storage"
+MODES = [
+    EmbedSettings(storage_precision="float32"),
+    EmbedSettings(storage_precision="float16"),
+    EmbedSettings(storage_precision="float32", binary_first_pass=True),
+    EmbedSettings(storage_precision="float16", binary_first_pass=True),
+]
+
+
+def load_embeddings(engine: sa.Engine, rows: int) -> np.ndarray:
+    with engine.connect() as connection:
+        embeddings = connection.execute(
+            sa.text(
+                f"SELECT CAST(e.embedding AS text) FROM {EMBEDDING_TABLE} e "
+                f"JOIN {COLLECTION_TABLE} c ON c.uuid = e.collection_id "
+                "WHERE c.name = :name LIMIT :limit"
+            ),
+            {"name": DB_COLLECTION_NAME, "limit": rows},
+        ).scalars()
+        return np.array([json.loads(embedding) for embedding in embeddings])
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _mode_name(embed: EmbedSettings) -> str:
+    return embed.storage_precision + ("_binary" if embed.binary_first_pass else "")
+
+
+def bench(
+    connection_str: str,
+    embed: EmbedSettings,
+    embeddings: np.ndarray,
+    queries: np.ndarray,
+    truth: list[set[int]],
+    k: int,
+    batch_size: int,
+) -> None:
+    settings = get_api_settings()
+    schema = f"{COLLECTION_NAME}_{_mode_name(embed)}"
+    server_settings = get_search_server_settings(settings.vector_index, embed)
+    options = " ".join(
+        [f"-c search_path={schema},public"]
+        + [f"-c {name}={value}" for name, value in server_settings.items()]
+    )
+    admin_engine = sa.create_engine(connection_str)
+    with admin_engine.begin() as connection:
+        connection.execute(sa.text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+        connection.execute(sa.text(f"CREATE SCHEMA {schema}"))
+    # The ORM of PGVector creates and writes the tables of the scratch schema
+    # even when public has them, the SQL of the modules finds them first
+    engine = sa.create_engine(
+        connection_str, connect_args={"options": options}
+    ).execution_options(schema_translate_map={None: schema})
+    try:
+        store = BulkPGVector(
+            collection_name=COLLECTION_NAME,
+            connection_string=connection_str,
+            embedding_function=FakeEmbeddings(size=embeddings.shape[1]),
+            engine=engine,
+        )
+        try:
+            set_vector_storage(engine, COLLECTION_NAME, embed, embeddings.shape[1])
+        except ValueError as e:
+            print(f"{_mode_name(embed):>15}: skipped, {e}")
+            return
+        for offset in range(0, len(embeddings), batch_size):
+            batch = range(offset, min(offset + batch_size, len(embeddings)))
+            store.add_embeddings(
+                texts=[str(i) for i in batch],
+                embeddings=embeddings[offset : batch.stop].tolist(),
+                ids=[str(i) for i in batch],
+            )
+        create_vector_index(
+            engine,
+            COLLECTION_NAME,
+            settings.vector_index,
+            binary_quantized=embed.binary_first_pass,
+        )
+
+        with engine.connect() as connection:
+            connection.execute(sa.text(f"ANALYZE {EMBEDDING_TABLE}"))
+            table_size, index_size = connection.execute(
+                sa.text(
+                    "SELECT pg_total_relation_size(to_regclass(:table)), "
+                    "coalesce(pg_relation_size(to_regclass(:index)), 0)"
+                ),
+                {
+                    "table": EMBEDDING_TABLE,
+                    "index": get_vector_index_name(COLLECTION_NAME),
+                },
+            ).one()
+            collection_id = connection.execute(
+                sa.text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name"),
+                {"name": COLLECTION_NAME},
+            ).scalar_one()
+
+            query = get_similarity_search_query(
+                get_vector_type(embed),
+                False,
+                embeddings.shape[1] if embed.binary_first_pass else None,
+            )
+            latencies, recalls = [], []
+            for embedding, expected in zip(queries, truth):
+                params = {
+                    "collection_id": collection_id,
+                    "embedding": to_vector_literal(embedding.tolist()),
+                    "k": k,
+                    "candidates": max(embed.rescore_candidates, k),
+                }
+                start = time.perf_counter()
+                rows = connection.execute(query, params).all()
+                latencies.append((time.perf_counter() - start) * 1000)
+                found = {int(row.document) for row in rows}
+                recalls.append(len(found & expected) / k)
+
+        print(
+            f"{_mode_name(embed):>15}: "
+            f"table {table_size / 2**20:8.1f} MiB, "
+            f"index {index_size / 2**20:8.1f} MiB, "
+            f"p50 {statistics.median(latencies):6.2f} ms, "
+            f"recall@{k} {statistics.mean(recalls):.3f}"
+        )
+    finally:
+        engine.dispose()
+        with admin_engine.begin() as connection:
+            connection.execute(sa.text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+        admin_engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--from-collection", action="store_true")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1_000)
+    args = parser.parse_args()
+
+    settings = get_api_settings()
+    connection_str = get_pgvector_connection_str(settings.pgvector)
+    rng = np.random.default_rng(0)
+    if args.from_collection:
+        engine = sa.create_engine(connection_str)
+        try:
+            embeddings = load_embeddings(engine, args.rows)
+        finally:
+            engine.dispose()
+        if not len(embeddings):
+            raise SystemExit("No embeddings, is the collection empty?")
+    else:
+        embeddings = rng.standard_normal((args.rows, args.dimensions))
+    embeddings = _normalize(embeddings).astype(np.float32)
+
+    picked = rng.choice(len(embeddings), size=args.queries, replace=False)
+    queries = _normalize(
+        embeddings[picked]
+        + args.noise * rng.standard_normal((args.queries, embeddings.shape[1]))
+    )
+    # Exact cosine neighbours of the float32 embeddings
+    similarities = queries @ embeddings.T
+    truth = [
+        set(np.argpartition(-row, args.k)[: args.k].tolist()) for row in similarities
+    ]
+
+    print(f"{len(embeddings)} embeddings of {embeddings.shape[1]} dimensions")
+    for embed in MODES:
+        embed = embed.model_copy(
+            update={"rescore_candidates": settings.embed.rescore_candidates}
+        )
+        bench(
+            connection_str, embed, embeddings, queries, truth, args.k, args.batch_size
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Time the writes and deletes of the ORM and the COPY vector stores.
+
+Writes random embeddings to a scratch collection in the configured database,
+once through the PGVector ORM and once through binary COPY, and deletes them
+again by id. Prints rows per second of each; the scratch collection is dropped
+afterwards.
+"""
+
+import argparse
+import random
+import time
+
+from core.config import get_api_settings
+from core.storage import get_engine, get_pgvector_connection_str
+from core.vector_store import BulkPGVector, SharedEnginePGVector
+from langchain.embeddings import FakeEmbeddings
+from langchain.vectorstores.pgvector import PGVector
+
+COLLECTION_NAME = "bench_vector_write"
+
+
+def bench(store: PGVector, rows: int, dimensions: int, batch_size: int) -> None:
+    rnd = random.Random(0)
+    ids = [f"bench-{i}" for i in range(rows)]
+    start = time.perf_counter()
+    for offset in range(0, rows, batch_size):
+        batch_ids = ids[offset : offset + batch_size]
+        store.add_embeddings(
+            texts=[f"chunk {id} " * 50 for id in batch_ids],
+            embeddings=[[rnd.random() for _ in range(dimensions)] for _ in batch_ids],
+            metadatas=[
+                {"source": f"https://example.com/{id}", "title": id} for id in batch_ids
+            ],
+            ids=batch_ids,
+        )
+    write_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for offset in range(0, rows, batch_size):
+        store.delete(ids[offset : offset + batch_size])
+    delete_seconds = time.perf_counter() - start
+
+    print(
+        f"{type(store).__name__:>20}: "
+        f"write {rows / write_seconds:10.0f} rows/s, "
+        f"delete {rows / delete_seconds:10.0f} rows/s"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    settings = get_api_settings()
+    kwargs = dict(
+        collection_name=COLLECTION_NAME,
+        connection_string=get_pgvector_connection_str(settings.pgvector),
+        embedding_function=FakeEmbeddings(size=args.dimensions),
+        engine=get_engine(settings),
+    )
+    bulk_store = BulkPGVector(
+        delete_batch_size=settings.indexing.cleanup_batch_size, **kwargs
+    )
+    try:
+        bench(
+            SharedEnginePGVector(**kwargs), args.rows, args.dimensions, args.batch_size
+        )
+        bench(bulk_store, args.rows, args.dimensions, args.batch_size)
+    finally:
+        bulk_store.delete_collection()
+
+
+if __name__ == "__main__":
+    main()
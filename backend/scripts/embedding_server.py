@@ -0,0 +1,49 @@
+"""Serve the configured embedding model to the API workers and ingests.
+
+Listens on `embed__server_url`, a Unix socket as unix:///path/to.sock or a
+localhost address as http://127.0.0.1:8765, see `core.embedding_server`.
+"""
+
+import logging
+import os
+from urllib.parse import urlparse
+
+import uvicorn
+from core.config import get_api_settings
+from core.embedding import get_cache_model_name, get_embeddings_model
+from core.embedding_server import create_app
+
+logging.basicConfig(
+    format="%(asctime)s - %(message)s",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    settings = get_api_settings()
+    embed = settings.embed
+    if not embed.server_url:
+        raise SystemExit("Set embed__server_url to the address to listen on.")
+    app = create_app(
+        # Not a client of itself
+        get_embeddings_model(embed.model_copy(update={"server_url": None})),
+        model_name=get_cache_model_name(embed),
+        normalize=embed.normalize,
+        batch_window=embed.server_batch_window_ms / 1000,
+        max_batch_size=embed.server_max_batch_size,
+    )
+
+    url = urlparse(embed.server_url)
+    logger.info(f"Serving {embed.name} on {embed.server_url}")
+    if url.scheme == "unix":
+        # Left behind by a server that was killed
+        if os.path.exists(url.path):
+            os.remove(url.path)
+        uvicorn.run(app, uds=url.path)
+    else:
+        uvicorn.run(app, host=url.hostname, port=url.port)
+
+
+if __name__ == "__main__":
+    main()
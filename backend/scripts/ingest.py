@@ -1,28 +1,63 @@
 """Load html from files, clean up, split, ingest into postgres vectors."""
+
+import asyncio
 import logging
 import os
 import re
 from pathlib import Path
-from typing import Callable, ClassVar
+from typing import Callable, ClassVar, Iterable, Iterator, Optional, Union
 from urllib.parse import urlparse
 
 import git
+import lxml.html
 from bs4 import BeautifulSoup, SoupStrainer
-from core.config import get_api_settings
+from core.config import IngestSettings, Parser, get_api_settings
 from core.constants import DB_COLLECTION_NAME, SQL_RECORD_MANAGAR_NAMESPACE
-from core.embedding import get_embeddings_model
+from core.document_sources import refresh_document_sources
+from core.embedding import get_embeddings
+from core.embedding_cache import CachedEmbeddings
 from core.indexing import index
-from core.parser import langchain_docs_extractor
-from core.storage import get_pgvector_connection_str, get_sql_record_manager
-from langchain.document_loaders import ArxivLoader, GitLoader, SitemapLoader
+from core.ingestion import TransformTask, transform_concurrently
+from core.ingestion_state import (
+    get_ingested_commit,
+    get_ingested_pages,
+    set_ingested_commit,
+    set_ingested_pages,
+)
+from core.metadata_index import create_metadata_index
+from core.page_cache import PageCache, fetch_pages
+from core.parser import (
+    LANGCHAIN_DOCS_TAGS,
+    get_lxml_text,
+    langchain_docs_extractor,
+    langchain_docs_extractor_lxml,
+    parse_html,
+)
+from core.storage import get_pgvector, get_sql_record_manager
+from core.text_search import create_text_search_index
+from core.vector_index import set_vector_storage
+from langchain.document_loaders import ArxivLoader, SitemapLoader
+from langchain.indexes._api import _batch
 from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
-from langchain.vectorstores.pgvector import PGVector
 from langchain_core.documents import Document
 from pydantic import BaseModel
+from sqlalchemy.engine import Engine
 
 FORCE_UPDATE = (os.environ.get("FORCE_UPDATE") or "false").lower() == "true"
 WEBSITE_LANGCHAIN = "https://python.langchain.com/"
 LOCAL_GITHUB_REPOS = "./data/github_repos"
+GITHUB_FILE_EXTENSION = ".py"
+# Programming languages of the repository files, by extension
+FILE_LANGUAGES = {
+    ".py": "python",
+    ".ipynb": "python",
+    ".js": "javascript",
+    ".ts": "typescript",
+    ".md": "markdown",
+}
+
+# Built per worker process by _init_splitters
+_SPLITTERS: dict[str, RecursiveCharacterTextSplitter] = {}
 
 
 class UnsupportedSchemeError(Exception):
@@ -50,6 +85,33 @@ class GitHubRepositoryHolder(BaseModel):
     local_path: str
 
 
+class GitIngestionPlan(BaseModel):
+    """What to ingest of a repository, given the commit ingested last time."""
+
+    clone_url: str
+    commit_sha: str
+    # Paths relative to the repository, None to load all files
+    changed_paths: Optional[list[str]]
+    unchanged_sources: list[str]
+    deleted_sources: list[str]
+
+
+class SitemapIngestionPlan(BaseModel):
+    """What to ingest of a sitemap, given the pages ingested last time."""
+
+    source: str
+    page_cache_path: str
+    # Sitemap entries of the pages to parse
+    changed_pages: list[dict]
+    unchanged_sources: list[str]
+    deleted_sources: list[str]
+    # By source, of all pages of the sitemap, stored once indexed
+    content_hashes: dict[str, str]
+
+
+IngestionPlan = Union[GitIngestionPlan, SitemapIngestionPlan]
+
+
 logging.basicConfig(
     filename="ingest.log",
     format="%(asctime)s - %(message)s",
@@ -58,19 +120,109 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def load_langchain_docs() -> list[Document]:
-    return SitemapLoader(
+def load_langchain_pages(block_size: int) -> Iterator[tuple[str, dict]]:
+    """Fetch the raw html of the pages of the sitemap, block by block.
+
+    Parsing the html is CPU bound and left to `parse_langchain_page`, so it can
+    run in a worker process. At most `block_size` pages are held in memory.
+    """
+    loader = SitemapLoader(
         f"{WEBSITE_LANGCHAIN}sitemap.xml",
         filter_urls=[WEBSITE_LANGCHAIN],
-        parsing_function=langchain_docs_extractor,
-        default_parser="lxml",
-        bs_kwargs={
-            "parse_only": SoupStrainer(
-                name=("article", "title", "html", "lang", "content")
-            ),
-        },
-        meta_function=_metadata_extractor,
-    ).load()
+    )
+    els = _get_sitemap_entries(loader)
+    for block in _batch(block_size, els):
+        pages = asyncio.run(loader.fetch_all([el["loc"].strip() for el in block]))
+        yield from zip(pages, block)
+
+
+def _get_sitemap_entries(loader: SitemapLoader) -> list[dict]:
+    sitemap = loader._scrape(loader.web_path, parser="xml")
+    return [el for el in loader.parse_sitemap(sitemap) if "loc" in el]
+
+
+def plan_sitemap_ingestion(
+    source: str,
+    sitemap_url: str,
+    filter_urls: list[str],
+    ingested_pages: dict[str, str],
+    ingest: IngestSettings,
+) -> SitemapIngestionPlan:
+    """Bring the page cache up to date and compare it with the ingested pages.
+
+    Pages are requested conditionally, see `fetch_pages`, and are only to be
+    parsed if their content differs from the one last ingested.
+    """
+    loader = SitemapLoader(sitemap_url, filter_urls=filter_urls)
+    els = _get_sitemap_entries(loader)
+    results = asyncio.run(
+        fetch_pages(
+            [(el["loc"].strip(), el.get("lastmod")) for el in els],
+            PageCache(Path(ingest.page_cache_path)),
+            concurrency=ingest.fetch_concurrency,
+            requests_per_second=ingest.requests_per_second,
+        )
+    )
+    plan = SitemapIngestionPlan(
+        source=source,
+        page_cache_path=ingest.page_cache_path,
+        changed_pages=[],
+        unchanged_sources=[],
+        deleted_sources=[],
+        content_hashes={},
+    )
+    statuses: dict[str, int] = {}
+    for el, result in zip(els, results):
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+        # The source of the documents of a page, see _metadata_extractor
+        page_source = el["loc"]
+        content_hash = result.content_hash or ingested_pages.get(page_source)
+        if content_hash is None:
+            continue
+        plan.content_hashes[page_source] = content_hash
+        if ingested_pages.get(page_source) == content_hash:
+            plan.unchanged_sources.append(page_source)
+        else:
+            plan.changed_pages.append(el)
+    plan.deleted_sources = [
+        page_source
+        for page_source in ingested_pages
+        if page_source not in plan.content_hashes
+    ]
+    logger.info(
+        f"{sitemap_url}: {statuses}, {len(plan.changed_pages)} changed, "
+        f"{len(plan.deleted_sources)} deleted pages"
+    )
+    return plan
+
+
+def load_planned_pages(plan: SitemapIngestionPlan) -> Iterator[tuple[str, dict]]:
+    """The raw html of the changed pages of the plan, from the page cache."""
+    cache = PageCache(Path(plan.page_cache_path))
+    for el in plan.changed_pages:
+        page = cache.get(el["loc"].strip())
+        if page is None:
+            logger.warning(f"Page {el['loc']} is missing from the page cache")
+            continue
+        yield cache.read_text(page.content_hash, page.encoding), el
+
+
+def parse_langchain_page(html: str, meta: dict, html_backend: str) -> list[Document]:
+    if html_backend == "lxml":
+        root = parse_html(html)
+        doc = Document(
+            page_content=langchain_docs_extractor_lxml(root),
+            metadata=_metadata_extractor_lxml(meta, root),
+        )
+    else:
+        soup = BeautifulSoup(
+            html, "lxml", parse_only=SoupStrainer(name=LANGCHAIN_DOCS_TAGS)
+        )
+        doc = Document(
+            page_content=langchain_docs_extractor(soup),
+            metadata=_metadata_extractor(meta, soup),
+        )
+    return split_doc(WEBSITE_LANGCHAIN, doc)
 
 
 def _metadata_extractor(meta: dict, soup: BeautifulSoup) -> dict:
@@ -86,6 +238,23 @@ def _metadata_extractor(meta: dict, soup: BeautifulSoup) -> dict:
     }
 
 
+def _metadata_extractor_lxml(meta: dict, root: lxml.html.HtmlElement) -> dict:
+    title = next(root.iter("title"), None)
+    description = next(
+        (el for el in root.iter("meta") if el.get("name") == "description"), None
+    )
+    html = next(root.iter("html"), None)
+    return {
+        "source": meta["loc"],
+        "title": get_lxml_text(title) if title is not None else "",
+        "description": (
+            description.get("content", "") if description is not None else ""
+        ),
+        "language": html.get("lang", "") if html is not None else "",
+        **meta,
+    }
+
+
 def add_missing_metadata(source: str, docs: list[Document]) -> None:
     for doc in docs:
         if "source" not in doc.metadata:
@@ -109,19 +278,150 @@ class GitRepository:
             repo = git.Repo.clone_from(repository.clone_url, repository.local_path)
         return GitRepository(repo_path, repo.head.reference)
 
-    def load_docs(self, file_filter: callable) -> list[Document]:
-        loader = GitLoader(
-            repo_path=self.repo_path,
-            branch=self._branch,
-            file_filter=file_filter,
+    @property
+    def commit_sha(self) -> str:
+        return self._branch.commit.hexsha
+
+    def tracked_paths(self) -> list[str]:
+        repo = git.Repo(self.repo_path)
+        return [
+            item.path
+            for item in repo.tree(self._branch.commit).traverse()
+            if isinstance(item, git.Blob)
+        ]
+
+    def diff_name_status(self, since_sha: str) -> tuple[list[str], list[str]]:
+        """The paths changed and deleted since the commit, see `git diff --name-status`.
+
+        Renames count as the deletion of the old and the addition of the new path.
+
+        Raises:
+            ValueError: The commit is not an ancestor of the branch, e.g. after a
+                force push.
+        """
+        repo = git.Repo(self.repo_path)
+        try:
+            is_ancestor = repo.is_ancestor(since_sha, self.commit_sha)
+        except git.GitCommandError:
+            is_ancestor = False
+        if not is_ancestor:
+            raise ValueError(f"{since_sha} is not an ancestor of {self.commit_sha}")
+
+        output = repo.git.diff(
+            "--name-status", "--no-renames", "-z", since_sha, self.commit_sha
         )
-        return loader.load()
+        fields = output.split("\0")
+        changed, deleted = [], []
+        for status, path in zip(fields[0::2], fields[1::2]):
+            (deleted if status == "D" else changed).append(path)
+        return changed, deleted
+
+    def load_docs(
+        self, file_filter: callable, paths: Optional[list[str]] = None
+    ) -> Iterator[Document]:
+        """Lazily load the text files of the branch, like GitLoader.load does.
+
+        Unlike GitLoader, files are not checked against .gitignore one `git`
+        call at a time, the tree only holds tracked files anyway. Only the given
+        paths, relative to the repository, are loaded if any.
+        """
+        repo = git.Repo(self.repo_path)
+        repo.git.checkout(self._branch)
+        if paths is None:
+            paths = self.tracked_paths()
+        for path in paths:
+            file_path = os.path.join(self.repo_path, path)
+            if file_filter and not file_filter(file_path):
+                continue
+            doc = _load_text_file(self.repo_path, file_path, os.path.basename(path))
+            if doc is not None:
+                yield doc
+
+
+def _load_text_file(
+    repo_path: str, file_path: str, file_name: str
+) -> Optional[Document]:
+    try:
+        with open(file_path, "rb") as f:
+            text_content = f.read().decode("utf-8")
+    except UnicodeDecodeError:
+        # loads only text files
+        return None
+    except OSError as e:
+        logger.warning(f"Error reading file {file_path}: {e}")
+        return None
+    rel_file_path = os.path.relpath(file_path, repo_path)
+    return Document(
+        page_content=text_content,
+        metadata={
+            "source": rel_file_path,
+            "file_path": rel_file_path,
+            "file_name": file_name,
+            "file_type": os.path.splitext(file_name)[1],
+        },
+    )
+
+
+def get_github_files_as_docs(
+    clone_url: str, file_extension: str, plan: Optional[GitIngestionPlan] = None
+) -> Iterator[Document]:
+    """Load the files of the repository, only the changed ones given a plan."""
+    repository_holder = _create_github_repository_holder(clone_url)
+    if plan is None:
+        git_repo = GitRepository.clone_or_pull(repository_holder)
+        return git_repo.load_docs(_file_ends_with_extension(file_extension))
+    # Pulled while planning, pulling again could move past the planned commit
+    repo = git.Repo(repository_holder.local_path)
+    git_repo = GitRepository(repository_holder.local_path, repo.head.reference)
+    return git_repo.load_docs(
+        _file_ends_with_extension(file_extension), plan.changed_paths
+    )
 
 
-def get_github_files_as_docs(clone_url: str, file_extension: str) -> list[Document]:
+def plan_git_ingestion(
+    clone_url: str, file_extension: str, ingested_sha: Optional[str]
+) -> GitIngestionPlan:
+    """Clone or pull the repository and diff it against the ingested commit.
+
+    Without an ingested commit, or if it is not in the history of the branch
+    anymore, all files are to be loaded.
+    """
     repository_holder = _create_github_repository_holder(clone_url)
     git_repo = GitRepository.clone_or_pull(repository_holder)
-    return git_repo.load_docs(_file_ends_with_extension(file_extension))
+    plan = GitIngestionPlan(
+        clone_url=clone_url,
+        commit_sha=git_repo.commit_sha,
+        changed_paths=None,
+        unchanged_sources=[],
+        deleted_sources=[],
+    )
+    if ingested_sha is None:
+        return plan
+    try:
+        changed, deleted = git_repo.diff_name_status(ingested_sha)
+    except ValueError as e:
+        logger.warning(f"Loading all files of {clone_url}: {e}")
+        return plan
+
+    file_filter = _file_ends_with_extension(file_extension)
+    changed = [path for path in changed if file_filter(path)]
+    skipped = set(changed)
+    plan.changed_paths = changed
+    plan.unchanged_sources = [
+        _get_repo_source(repository_holder.local_path, path)
+        for path in git_repo.tracked_paths()
+        if file_filter(path) and path not in skipped
+    ]
+    plan.deleted_sources = [
+        _get_repo_source(repository_holder.local_path, path)
+        for path in deleted
+        if file_filter(path)
+    ]
+    logger.info(
+        f"{clone_url} since {ingested_sha}: {len(changed)} changed, "
+        f"{len(plan.deleted_sources)} deleted files"
+    )
+    return plan
 
 
 def _create_github_repository_holder(clone_url: str) -> GitHubRepositoryHolder:
@@ -134,13 +434,13 @@ def _file_ends_with_extension(file_extension: str) -> Callable[[Path], bool]:
     return lambda file_path: file_path.endswith(file_extension)
 
 
-def get_arxiv_files_as_docs(query: str) -> list[Document]:
+def get_arxiv_files_as_docs(query: str) -> Iterator[Document]:
     """
     Get arxiv files transformed to langchain Document.
     query can be either search terms, arxiv url or a paper ID
     """
-    # TODO: add metadata source (arxiv), so I can filter on it.
-    return ArxivLoader(
+    # ArxivLoader has no lazy_load, but loads at most load_max_docs papers.
+    yield from ArxivLoader(
         query=_get_arxiv_id(query),
         load_max_docs=10,
         load_all_available_meta=True,
@@ -154,107 +454,272 @@ def _get_arxiv_id(potential_url: str) -> str:
     return potential_url
 
 
+def _init_splitters(chunk_size: int, chunk_overlap: int) -> None:
+    """Set up the splitters once per worker process."""
+    _SPLITTERS["en"] = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        add_start_index=True,
+        length_function=len,
+    )
+    _SPLITTERS["code"] = RecursiveCharacterTextSplitter.from_language(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        add_start_index=True,
+        length_function=len,
+        language=Language.PYTHON.value,
+    )
+
+
+def split_doc(source: str, doc: Document) -> list[Document]:
+    if source.startswith("https://github.com"):
+        splitter = _SPLITTERS["code"]
+    else:
+        splitter = _SPLITTERS["en"]
+    chunks = splitter.split_documents([doc])
+    add_missing_metadata(source, chunks)
+    return chunks
+
+
 def load_and_transform_docs(
     sources: list[str],
-    en_splitter: RecursiveCharacterTextSplitter,
-    code_splitter: RecursiveCharacterTextSplitter,
-) -> list[Document]:
-    transformed_docs = []
-    for source in sources:
-        docs = _load_docs(source)
-        logger.info(f"Loaded {len(docs)} docs from {source}")
-        if source.startswith("https://github.com"):
-            transformed_docs.extend(code_splitter.split_documents(docs))
-        else:
-            transformed_docs.extend(en_splitter.split_documents(docs))
-    add_missing_metadata(source, transformed_docs)
-    return transformed_docs
+    parser: Parser,
+    ingest: IngestSettings,
+    plans: Optional[dict[str, IngestionPlan]] = None,
+) -> Iterator[Document]:
+    """Lazily load, split and yield the chunks of all sources.
+
+    Sources are loaded concurrently, while parsing and splitting runs on a pool of
+    worker processes. Memory is bounded by the documents in flight, not by the
+    size of the corpus. Sources with a plan only load their changed files or pages.
+    """
+    plans = plans or {}
+    return transform_concurrently(
+        [
+            _load_transform_tasks(
+                source, ingest.block_size, parser.html_backend, plans.get(source)
+            )
+            for source in sources
+        ],
+        workers=ingest.workers,
+        source_concurrency=ingest.source_concurrency,
+        queue_size=ingest.queue_size,
+        initializer=_init_splitters,
+        initargs=(parser.chunk_size, parser.chunk_overlap),
+    )
 
 
-def _load_docs(source: str) -> list[str]:
+def _load_transform_tasks(
+    source: str,
+    block_size: int,
+    html_backend: str,
+    plan: Optional[IngestionPlan] = None,
+) -> Iterator[TransformTask]:
+    num_docs = 0
     if source.startswith("https://python.langchain.com"):
-        return load_langchain_docs()
-    elif source.startswith("https://github.com"):
-        docs = get_github_files_as_docs(clone_url=source, file_extension=".py")
-        _add_absolute_path_to_repo(source, docs)
-        return docs
+        pages = (
+            load_langchain_pages(block_size)
+            if plan is None
+            else load_planned_pages(plan)
+        )
+        for html, meta in pages:
+            num_docs += 1
+            # The language of a page is the one of its html element
+            meta = {**meta, "source_type": "docs", "repo": ""}
+            yield parse_langchain_page, (html, meta, html_backend)
+    else:
+        for doc in _load_docs(source, plan):
+            num_docs += 1
+            yield split_doc, (source, doc)
+    logger.info(f"Loaded {num_docs} docs from {source}")
+
+
+def _load_docs(
+    source: str, git_plan: Optional[GitIngestionPlan] = None
+) -> Iterator[Document]:
+    if source.startswith("https://github.com"):
+        docs = get_github_files_as_docs(
+            clone_url=source, file_extension=GITHUB_FILE_EXTENSION, plan=git_plan
+        )
+        return _add_source_tags(
+            _add_absolute_path_to_repo(source, docs), "github", _get_repo_name(source)
+        )
     elif source.startswith("https://arxiv.org"):
         docs = get_arxiv_files_as_docs(source)
-        _add_entry_id_as_source(docs)
-        return docs
+        return _add_source_tags(_add_entry_id_as_source(docs), "arxiv")
     else:
         raise ValueError(f"This source: {source} cannot be parsed.")
 
 
-def _add_absolute_path_to_repo(source: str, docs: list[Document]) -> None:
+def _add_absolute_path_to_repo(
+    source: str, docs: Iterable[Document]
+) -> Iterator[Document]:
     repository = _create_github_repository_holder(source)
     for doc in docs:
-        file_path_abs = Path(repository.local_path) / doc.metadata["file_path"]
-        doc.metadata["source"] = str(file_path_abs)
+        doc.metadata["source"] = _get_repo_source(
+            repository.local_path, doc.metadata["file_path"]
+        )
+        yield doc
+
+
+def _get_repo_source(local_path: str, file_path: str) -> str:
+    return str(Path(local_path) / file_path)
 
 
-def _add_entry_id_as_source(docs: list[Document]) -> None:
+def _get_repo_name(clone_url: str) -> str:
+    return urlparse(clone_url).path.strip("/").removesuffix(".git")
+
+
+def _add_source_tags(
+    docs: Iterable[Document], source_type: str, repo: str = ""
+) -> Iterator[Document]:
+    """Tag the docs with the metadata chats can be filtered by, see ChatFilters."""
+    for doc in docs:
+        doc.metadata["source_type"] = source_type
+        doc.metadata["repo"] = repo
+        doc.metadata["language"] = FILE_LANGUAGES.get(
+            doc.metadata.get("file_type", ""), ""
+        )
+        yield doc
+
+
+def _add_entry_id_as_source(docs: Iterable[Document]) -> Iterator[Document]:
     for doc in docs:
         doc.metadata["source"] = doc.metadata["entry_id"]
         doc.metadata["title"] = doc.metadata["Title"]
+        yield doc
+
+
+def plan_git_sources(sources: list[str], engine: Engine) -> dict[str, GitIngestionPlan]:
+    """Plan the ingestion of the git sources since their last ingested commits.
+
+    With FORCE_UPDATE all files are loaded.
+    """
+    return {
+        source: plan_git_ingestion(
+            source,
+            GITHUB_FILE_EXTENSION,
+            None
+            if FORCE_UPDATE
+            else get_ingested_commit(engine, SQL_RECORD_MANAGAR_NAMESPACE, source),
+        )
+        for source in sources
+        if source.startswith("https://github.com")
+    }
+
+
+def plan_sitemap_sources(
+    sources: list[str], engine: Engine, ingest: IngestSettings
+) -> dict[str, SitemapIngestionPlan]:
+    """Plan the ingestion of the sitemap sources in incremental sitemap mode.
+
+    With FORCE_UPDATE all pages are parsed, though still fetched conditionally.
+    """
+    if ingest.sitemap_mode != "incremental":
+        return {}
+    return {
+        source: plan_sitemap_ingestion(
+            source,
+            f"{WEBSITE_LANGCHAIN}sitemap.xml",
+            [WEBSITE_LANGCHAIN],
+            {}
+            if FORCE_UPDATE
+            else get_ingested_pages(engine, SQL_RECORD_MANAGAR_NAMESPACE, source),
+            ingest,
+        )
+        for source in sources
+        if source.startswith("https://python.langchain.com")
+    }
 
 
 def ingest_docs() -> None:
     settings = get_api_settings()
     logger.info("Loaded settings from environment variables")
 
-    en_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=settings.parser.chunk_size,
-        chunk_overlap=settings.parser.chunk_overlap,
-        add_start_index=True,
-        length_function=len,
-    )
-    code_splitter = RecursiveCharacterTextSplitter.from_language(
-        chunk_size=settings.parser.chunk_size,
-        chunk_overlap=settings.parser.chunk_overlap,
-        add_start_index=True,
-        length_function=len,
-        language=Language.PYTHON.value,
-    )
+    sources = [
+        # "https://github.com/langchain-ai/langchain",
+        "https://arxiv.org/abs/2401.01814",
+        "https://arxiv.org/abs/2308.04889",
+        "https://arxiv.org/abs/2304.01373",
+        "https://arxiv.org/abs/2307.09288",
+        # WEBSITE_LANGCHAIN,
+    ]
 
-    logger.info("Loading docs from sources...")
-    all_docs = load_and_transform_docs(
-        [
-            # "https://github.com/langchain-ai/langchain",
-            "https://arxiv.org/abs/2401.01814",
-            "https://arxiv.org/abs/2308.04889",
-            "https://arxiv.org/abs/2304.01373",
-            "https://arxiv.org/abs/2307.09288",
-            # WEBSITE_LANGCHAIN,
-        ],
-        en_splitter,
-        code_splitter,
-    )
+    record_manager = get_sql_record_manager(settings, SQL_RECORD_MANAGAR_NAMESPACE)
+    record_manager.create_schema()
+
+    plans = {
+        **plan_git_sources(sources, record_manager.engine),
+        **plan_sitemap_sources(sources, record_manager.engine, settings.ingest),
+    }
 
-    pg_connection_str = get_pgvector_connection_str(settings.pgvector)
-    embedding = get_embeddings_model(settings.embed.name)
-    vectorstore = PGVector(
-        collection_name=DB_COLLECTION_NAME,
-        connection_string=pg_connection_str,
-        embedding_function=embedding,
-        logger=logger,
+    logger.info("Loading docs from sources...")
+    docs = load_and_transform_docs(
+        sources,
+        settings.parser,
+        settings.ingest,
+        plans,
     )
 
-    record_manager = get_sql_record_manager(
-        settings.pgvector, SQL_RECORD_MANAGAR_NAMESPACE
+    embedding = get_embeddings(settings)
+    vectorstore = get_pgvector(settings, embedding, logger)
+    # Before writing as well, the embeddings are written in the stored precision
+    set_vector_storage(
+        record_manager.engine,
+        DB_COLLECTION_NAME,
+        settings.embed,
+        len(embedding.embed_query("dimensions")),
     )
-    record_manager.create_schema()
+    # Before writing, so the chunks are indexed as they are written instead of
+    # in one rewrite of the table
+    create_metadata_index(record_manager.engine)
+    if settings.retrieval.mode == "hybrid":
+        create_text_search_index(
+            record_manager.engine, settings.retrieval.text_search_config
+        )
 
     indexing_stats = index(
-        all_docs,
+        docs,
         record_manager,
         vectorstore,
+        batch_size=settings.indexing.batch_size,
         cleanup="full",
         source_id_key="source",
+        cleanup_batch_size=settings.indexing.cleanup_batch_size,
         force_update=FORCE_UPDATE,
+        pipeline=settings.indexing if settings.indexing.pipelined else None,
+        unchanged_source_ids=[
+            source for plan in plans.values() for source in plan.unchanged_sources
+        ],
+        deleted_source_ids=[
+            source for plan in plans.values() for source in plan.deleted_sources
+        ],
     )
+    # Only once indexed, a failed run is repeated from the same state
+    for plan in plans.values():
+        if isinstance(plan, GitIngestionPlan):
+            set_ingested_commit(
+                record_manager.engine,
+                SQL_RECORD_MANAGAR_NAMESPACE,
+                plan.clone_url,
+                plan.commit_sha,
+            )
+        else:
+            set_ingested_pages(
+                record_manager.engine,
+                SQL_RECORD_MANAGAR_NAMESPACE,
+                plan.source,
+                plan.content_hashes,
+            )
 
     logger.info(f"Indexing stats: {indexing_stats}")
+    if settings.doc_references.materialized:
+        num_sources = refresh_document_sources(
+            record_manager.engine, DB_COLLECTION_NAME
+        )
+        logger.info(f"Materialized {num_sources} document sources")
+    if isinstance(embedding, CachedEmbeddings):
+        logger.info(f"Embedding cache stats: {embedding.stats}")
 
     # maybe to make SQL calls to check if data is in the DB.
     # import psycopg2.connect
@@ -3,12 +3,13 @@
 import logging
 
 from core.config import get_api_settings
-from langchain.vectorstores.pgvector import PGVector
 
 from core.constants import DB_COLLECTION_NAME, SQL_RECORD_MANAGAR_NAMESPACE
+from core.document_sources import refresh_document_sources
 from core.embedding import get_embeddings_model
 from core.indexing import index
-from storage import get_pgvector_connection_str, get_sql_record_manager
+from core.ingestion_state import clear_ingestion_state
+from core.storage import get_pgvector, get_sql_record_manager
 
 
 logging.basicConfig(
@@ -21,15 +22,9 @@ logger = logging.getLogger(__name__)
 
 def purge() -> None:
     settings = get_api_settings()
-    pg_connection_str = get_pgvector_connection_str(settings.pgvector)
-    embedding = get_embeddings_model(settings.embed.name)
-    vectorstore = PGVector(
-        collection_name=DB_COLLECTION_NAME,
-        connection_string=pg_connection_str,
-        embedding_function=embedding,
-        logger=logger,
-    )
-    
+    embedding = get_embeddings_model(settings.embed)
+    vectorstore = get_pgvector(settings, embedding, logger)
+
     record_manager = get_sql_record_manager(settings, SQL_RECORD_MANAGAR_NAMESPACE)
     record_manager.create_schema()
 
@@ -42,6 +37,11 @@ def purge() -> None:
     )
 
     logger.info("Indexing stats: ", indexing_stats)
+    # The next ingest has to load all git files and sitemap pages again
+    clear_ingestion_state(record_manager.engine, SQL_RECORD_MANAGAR_NAMESPACE)
+    if settings.doc_references.materialized:
+        refresh_document_sources(record_manager.engine, DB_COLLECTION_NAME)
+
 
 if __name__ == "__main__":
-    purge()
\ No newline at end of file
+    purge()
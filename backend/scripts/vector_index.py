@@ -0,0 +1,69 @@
+"""Create, rebuild and validate the ANN index of the vector collection."""
+
+import argparse
+import logging
+
+import sqlalchemy as sa
+from core.config import get_api_settings
+from core.constants import DB_COLLECTION_NAME
+from core.storage import get_pgvector_connection_str
+from core.vector_index import (
+    create_vector_index,
+    measure_recall,
+    validate_vector_index,
+)
+
+logging.basicConfig(
+    format="%(asctime)s - %(message)s",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["create", "rebuild", "validate", "recall"])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    settings = get_api_settings()
+    engine = sa.create_engine(get_pgvector_connection_str(settings.pgvector))
+
+    if args.command in ("create", "rebuild"):
+        create_vector_index(
+            engine,
+            DB_COLLECTION_NAME,
+            settings.vector_index,
+            rebuild=args.command == "rebuild",
+            binary_quantized=settings.embed.binary_first_pass,
+        )
+    if args.command in ("create", "rebuild", "validate"):
+        problems = validate_vector_index(
+            engine,
+            DB_COLLECTION_NAME,
+            settings.vector_index,
+            settings.embed.binary_first_pass,
+        )
+        for problem in problems:
+            logger.warning(problem)
+        if not problems:
+            logger.info("Vector index is valid.")
+    if args.command == "recall":
+        report = measure_recall(
+            engine,
+            DB_COLLECTION_NAME,
+            settings.vector_index,
+            k=args.k,
+            num_queries=args.queries,
+            rescore_candidates=(
+                settings.embed.rescore_candidates
+                if settings.embed.binary_first_pass
+                else None
+            ),
+        )
+        logger.info(f"Recall report: {report}")
+
+
+if __name__ == "__main__":
+    main()
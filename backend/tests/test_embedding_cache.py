@@ -0,0 +1,64 @@
+from pathlib import Path
+
+import pytest
+import sqlalchemy as sa
+from core.embedding_cache import SQLEmbeddingStore
+
+
+@pytest.fixture
+def store(tmp_path: Path) -> SQLEmbeddingStore:
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'cache.sqlite'}")
+    return SQLEmbeddingStore(engine, max_entries=100)
+
+
+def count_evictions(store: SQLEmbeddingStore, monkeypatch) -> list[int]:
+    evictions = []
+    evict = store._evict
+
+    def counting_evict() -> None:
+        evictions.append(1)
+        evict()
+
+    monkeypatch.setattr(store, "_evict", counting_evict)
+    return evictions
+
+
+def test_evicts_least_recently_used_with_slack(
+    store: SQLEmbeddingStore, monkeypatch
+) -> None:
+    evictions = count_evictions(store, monkeypatch)
+    store.mset([(f"old{i}", b"x") for i in range(50)])
+    store.mset([(f"new{i}", b"x") for i in range(50)])
+    store.mget(["old0"])
+
+    store.mset([("one_too_many", b"x")])
+
+    assert len(evictions) == 1
+    keys = set(store.yield_keys())
+    assert len(keys) == 90
+    # The least recently accessed, not the last read
+    assert "old0" in keys
+    assert "old1" not in keys
+    assert "one_too_many" in keys
+
+    # The slack takes several writes before the next eviction
+    for i in range(10):
+        store.mset([(f"later{i}", b"x")])
+    assert len(evictions) == 1
+    store.mset([("later10", b"x")])
+    assert len(evictions) == 2
+    assert len(list(store.yield_keys())) == 90
+
+
+def test_overwrites_crossing_the_limit_evict_with_slack(
+    store: SQLEmbeddingStore, monkeypatch
+) -> None:
+    evictions = count_evictions(store, monkeypatch)
+    store.mset([(f"key{i}", b"x") for i in range(95)])
+    store.mset([(f"key{i}", b"y") for i in range(10)])
+
+    assert len(evictions) == 1
+    assert len(list(store.yield_keys())) == 90
+    # Not recounted on every write
+    store.mset([("key0", b"z")])
+    assert len(evictions) == 1
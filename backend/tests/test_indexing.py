@@ -0,0 +1,304 @@
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence
+
+import pytest
+from core.config import IndexingSettings
+from core.indexing import index
+from langchain.indexes import SQLRecordManager
+from langchain.schema.document import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+
+
+class InMemoryVectorStore(VectorStore):
+    """Vector store keeping the documents by id, without any search."""
+
+    def __init__(self) -> None:
+        self.docs: dict[str, Document] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return None
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[list[dict]] = None,
+        ids: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        with self.lock:
+            for id_, text, metadata in zip(ids, texts, metadatas):
+                self.docs[id_] = Document(page_content=text, metadata=metadata)
+        return list(ids)
+
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> bool:
+        with self.lock:
+            for id_ in ids or []:
+                self.docs.pop(id_, None)
+        return True
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any):
+        raise NotImplementedError
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs: Any):
+        raise NotImplementedError
+
+
+@pytest.fixture
+def record_manager(tmp_path: Path) -> SQLRecordManager:
+    # A file, an in memory database is per connection, i.e. per stage thread
+    record_manager = SQLRecordManager(
+        "test", db_url=f"sqlite:///{tmp_path / 'records.sqlite'}"
+    )
+    record_manager.create_schema()
+    return record_manager
+
+
+def make_docs(source: str, num_docs: int) -> list[Document]:
+    return [
+        Document(page_content=f"{source} {i}", metadata={"source": source})
+        for i in range(num_docs)
+    ]
+
+
+PIPELINE = IndexingSettings(queue_size=2, exists_workers=2, write_workers=1)
+
+
+@pytest.mark.parametrize("pipeline", [None, PIPELINE], ids=["sequential", "pipelined"])
+def test_counts_of_deleted_sources_and_forced_updates(
+    record_manager: SQLRecordManager, pipeline: Optional[IndexingSettings]
+) -> None:
+    vector_store = InMemoryVectorStore()
+    # One source per batch, the incremental cleanup after a batch deletes the
+    # not yet refreshed documents of its sources
+    index_args = dict(
+        batch_size=3, cleanup="incremental", source_id_key="source", pipeline=pipeline
+    )
+
+    result = index(
+        make_docs("a", 3) + make_docs("b", 3),
+        record_manager,
+        vector_store,
+        **index_args,
+    )
+    assert result["num_added"] == 6
+    assert result["num_updated"] == 0
+
+    result = index(
+        make_docs("a", 3) + make_docs("c", 3),
+        record_manager,
+        vector_store,
+        deleted_source_ids=["b"],
+        **index_args,
+    )
+    assert result["num_added"] == 3
+    assert result["num_skipped"] == 3
+    assert result["num_deleted"] == 3
+
+    result = index(
+        make_docs("a", 3),
+        record_manager,
+        vector_store,
+        force_update=True,
+        **index_args,
+    )
+    assert result["num_added"] == 0
+    assert result["num_updated"] == 3
+    assert sorted(doc.page_content for doc in vector_store.docs.values()) == [
+        "a 0",
+        "a 1",
+        "a 2",
+        "c 0",
+        "c 1",
+        "c 2",
+    ]
+
+
+class BlockingVectorStore(InMemoryVectorStore):
+    """Vector store whose writes wait until released, recording them."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.released = threading.Event()
+        self.written: list[str] = []
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs: Any) -> list[str]:
+        if not self.released.wait(timeout=10):
+            raise TimeoutError("Never released")
+        self.written.extend(ids)
+        return super().add_texts(texts, metadatas, ids, **kwargs)
+
+
+def wait_for(condition: Callable[[], bool]) -> None:
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_pipeline_applies_backpressure(record_manager: SQLRecordManager) -> None:
+    pipeline = IndexingSettings(
+        queue_size=1, exists_workers=1, embed_workers=1, write_workers=1
+    )
+    vector_store = BlockingVectorStore()
+    pulled = []
+
+    def docs() -> Iterator[Document]:
+        for i in range(1_000):
+            pulled.append(i)
+            yield Document(page_content=f"doc {i}", metadata={"source": "a"})
+
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(
+            index(
+                docs(), record_manager, vector_store, batch_size=10, pipeline=pipeline
+            )
+        )
+    )
+    thread.start()
+    try:
+        wait_for(lambda: len(pulled) >= 10)
+        time.sleep(0.5)
+        # One batch per stage worker, one per queue and one being hashed
+        assert len(pulled) <= 8 * 10
+    finally:
+        vector_store.released.set()
+        thread.join()
+
+    assert results[0]["num_added"] == 1_000
+    assert len(vector_store.docs) == 1_000
+
+
+def test_pipeline_raises_error_of_a_stage(record_manager: SQLRecordManager) -> None:
+    class FailingVectorStore(InMemoryVectorStore):
+        def add_texts(self, texts, metadatas=None, ids=None, **kwargs: Any):
+            if self.docs:
+                raise RuntimeError("Write failed")
+            return super().add_texts(texts, metadatas, ids, **kwargs)
+
+    vector_store = FailingVectorStore()
+    with pytest.raises(RuntimeError, match="Write failed"):
+        index(
+            make_docs("a", 100),
+            record_manager,
+            vector_store,
+            batch_size=10,
+            pipeline=PIPELINE,
+        )
+
+    assert len(vector_store.docs) == 10
+    # Only the written batch is recorded
+    assert len(record_manager.list_keys()) == 10
+    assert not [
+        thread for thread in threading.enumerate() if thread.name.startswith("index-")
+    ]
+
+
+def test_pipeline_writes_repeated_documents_once(
+    record_manager: SQLRecordManager,
+) -> None:
+    vector_store = BlockingVectorStore()
+    lookups = []
+    exists = record_manager.exists
+
+    def counting_exists(keys: Sequence[str]) -> list[bool]:
+        lookups.append(keys)
+        return exists(keys)
+
+    record_manager.exists = counting_exists
+    docs = make_docs("a", 3)
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(
+            index(
+                # The second batch repeats the first, not yet written
+                docs + docs,
+                record_manager,
+                vector_store,
+                batch_size=3,
+                pipeline=PIPELINE,
+            )
+        )
+    )
+    thread.start()
+    try:
+        wait_for(lambda: len(lookups) == 2)
+    finally:
+        vector_store.released.set()
+        thread.join()
+
+    assert len(vector_store.written) == 3
+    assert results[0]["num_added"] == 3
+    assert results[0]["num_skipped"] == 3
+
+
+def test_pipeline_cleans_up_changed_sources_incrementally(
+    record_manager: SQLRecordManager,
+) -> None:
+    vector_store = InMemoryVectorStore()
+    index_args = dict(
+        batch_size=3, cleanup="incremental", source_id_key="source", pipeline=PIPELINE
+    )
+    index(
+        make_docs("a", 3) + make_docs("b", 3),
+        record_manager,
+        vector_store,
+        **index_args,
+    )
+
+    changed = [
+        Document(page_content=f"changed {i}", metadata={"source": "a"})
+        for i in range(3)
+    ]
+    result = index(changed, record_manager, vector_store, **index_args)
+
+    assert result["num_added"] == 3
+    assert result["num_deleted"] == 3
+    # Sources not indexed again are kept
+    assert sorted(doc.page_content for doc in vector_store.docs.values()) == [
+        "b 0",
+        "b 1",
+        "b 2",
+        "changed 0",
+        "changed 1",
+        "changed 2",
+    ]
+    assert set(record_manager.list_keys()) == set(vector_store.docs)
+
+
+def test_forced_update_keeps_vectors_of_concurrent_writes(
+    record_manager: SQLRecordManager,
+) -> None:
+    vector_store = InMemoryVectorStore()
+    pipeline = IndexingSettings(queue_size=2, exists_workers=1, write_workers=2)
+    index_args = dict(
+        batch_size=3, cleanup="incremental", source_id_key="source", pipeline=pipeline
+    )
+    # One source over two batches
+    index(make_docs("a", 6), record_manager, vector_store, **index_args)
+
+    update = record_manager.update
+    delayed = threading.Event()
+
+    def slow_first_update(keys: Sequence[str], **kwargs: Any) -> None:
+        # The record update after the first write, while the other batch is
+        # written and cleans up the source
+        if kwargs.get("group_ids") is not None and not delayed.is_set():
+            delayed.set()
+            time.sleep(0.3)
+        update(keys, **kwargs)
+
+    record_manager.update = slow_first_update
+    index(
+        make_docs("a", 6), record_manager, vector_store, force_update=True, **index_args
+    )
+
+    assert set(record_manager.list_keys()) == set(vector_store.docs)
@@ -0,0 +1,134 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator
+
+from aiohttp import web
+from core.page_cache import FetchResult, PageCache, fetch_pages
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+
+class StandInServer:
+    """Local stand-in for a docs site, recording the requests it answers.
+
+    Pages answer with an ETag and Last-Modified, and 304 to a request carrying
+    them. Paths in `failing` answer 500.
+    """
+
+    def __init__(self) -> None:
+        self.requests: list[tuple[str, dict[str, str], float]] = []
+        self.failing: set[str] = set()
+        self.base_url = ""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests.append((request.path, dict(request.headers), time.monotonic()))
+        if request.path in self.failing:
+            return web.Response(status=500)
+        headers = {"ETag": ETAG, "Last-Modified": LAST_MODIFIED}
+        if request.headers.get("If-None-Match") == ETAG:
+            return web.Response(status=304, headers=headers)
+        return web.Response(
+            text=f"<html>{request.path}</html>",
+            content_type="text/html",
+            headers=headers,
+        )
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    def requests_to(self, path: str) -> list[dict[str, str]]:
+        return [headers for p, headers, _ in self.requests if p == path]
+
+
+@asynccontextmanager
+async def stand_in_server() -> AsyncIterator[StandInServer]:
+    server = StandInServer()
+    app = web.Application()
+    app.router.add_get("/{path:.*}", server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    server.base_url = f"http://{host}:{port}"
+    try:
+        yield server
+    finally:
+        await runner.cleanup()
+
+
+def test_conditional_fetches(tmp_path: Path) -> None:
+    async def run() -> tuple[StandInServer, list[list[FetchResult]]]:
+        async with stand_in_server() as server:
+            cache = PageCache(tmp_path)
+            url = server.url("/page")
+            results = []
+            for lastmod in ("2024-01-01", "2024-01-01", "2024-02-01"):
+                results.append(await fetch_pages([(url, lastmod)], cache, 4, 0))
+            return server, results
+
+    server, results = asyncio.run(run())
+    (fetched,), (unchanged,), (not_modified,) = results
+
+    assert fetched.status == "fetched"
+    assert fetched.content_hash is not None
+    # Same sitemap lastmod, not requested at all
+    assert unchanged.status == "lastmod"
+    assert unchanged.content_hash == fetched.content_hash
+    # New sitemap lastmod, revalidated with the validators of the cached fetch
+    assert not_modified.status == "not_modified"
+    assert not_modified.content_hash == fetched.content_hash
+
+    first, revalidation = server.requests_to("/page")
+    assert "If-None-Match" not in first
+    assert "If-Modified-Since" not in first
+    assert revalidation["If-None-Match"] == ETAG
+    assert revalidation["If-Modified-Since"] == LAST_MODIFIED
+
+    cache = PageCache(tmp_path)
+    assert cache.read_text(fetched.content_hash) == "<html>/page</html>"
+    assert cache.get(server.url("/page")).lastmod == "2024-02-01"
+
+
+def test_failed_fetch_keeps_cached_page(tmp_path: Path) -> None:
+    async def run() -> tuple[FetchResult, list[FetchResult]]:
+        async with stand_in_server() as server:
+            cache = PageCache(tmp_path)
+            (cached,) = await fetch_pages([(server.url("/page"), "1")], cache, 4, 0)
+            server.failing.update({"/page", "/new"})
+            failed = await fetch_pages(
+                [(server.url("/page"), "2"), (server.url("/new"), "2")], cache, 4, 0
+            )
+            return cached, failed
+
+    cached, (failed, failed_uncached) = asyncio.run(run())
+
+    assert failed.status == "failed"
+    assert failed.content_hash == cached.content_hash
+    assert failed_uncached.status == "failed"
+    assert failed_uncached.content_hash is None
+
+
+def test_requests_to_a_host_are_spaced(tmp_path: Path) -> None:
+    requests_per_second = 10
+
+    async def run() -> StandInServer:
+        async with stand_in_server() as server:
+            await fetch_pages(
+                [(server.url(f"/page{i}"), None) for i in range(5)],
+                PageCache(tmp_path),
+                concurrency=5,
+                requests_per_second=requests_per_second,
+            )
+            return server
+
+    server = asyncio.run(run())
+
+    times = sorted(at for _, _, at in server.requests)
+    assert len(times) == 5
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    # Some slack for the timer resolution of the event loop
+    assert min(gaps) >= 0.9 / requests_per_second
@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup, SoupStrainer
+from core.parser import (
+    LANGCHAIN_DOCS_TAGS,
+    langchain_docs_extractor,
+    langchain_docs_extractor_lxml,
+    parse_html,
+)
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def docs_page() -> str:
+    return (DATA_DIR / "docs_page.html").read_text(encoding="utf-8")
+
+
+@pytest.fixture
+def expected_markdown() -> str:
+    return (DATA_DIR / "docs_page.md").read_text(encoding="utf-8")
+
+
+def test_bs4_extractor_matches_golden_markdown(
+    docs_page: str, expected_markdown: str
+) -> None:
+    soup = BeautifulSoup(
+        docs_page, "lxml", parse_only=SoupStrainer(name=LANGCHAIN_DOCS_TAGS)
+    )
+    assert langchain_docs_extractor(soup) == expected_markdown
+
+
+def test_lxml_extractor_matches_golden_markdown(
+    docs_page: str, expected_markdown: str
+) -> None:
+    assert langchain_docs_extractor_lxml(parse_html(docs_page)) == expected_markdown
+
+
+def test_golden_markdown_covers_the_handled_tags(expected_markdown: str) -> None:
+    for fragment in (
+        # Headings
+        "# Quick start",
+        "###### Last",
+        # Links
+        "[link](/docs)",
+        # Code blocks with and without language
+        "```python\nimport os\n",
+        "```\nno language\n```",
+        # Tables
+        "| Name | Value x |\n| ---- | ---- |",
+        # Tabs container
+        "Python\nPython **tab**",
+        # Lists
+        "- First [item](/first)",
+        "2. Two `code`",
+    ):
+        assert fragment in expected_markdown
@@ -0,0 +1,112 @@
+import asyncio
+import re
+from typing import Optional
+
+from core.rephrase import HistoryAwareRetrieval, needs_rephrasing
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.messages import AIMessage, HumanMessage
+from langchain.schema.retriever import BaseRetriever
+from langchain.schema.runnable import RunnableLambda
+
+HISTORY = [
+    HumanMessage(content="What is LangChain?"),
+    AIMessage(content="A framework for developing applications powered by LLMs."),
+]
+
+
+class WordEmbeddings(Embeddings):
+    """Bag of words embeddings, standing in for the query embedding model."""
+
+    def __init__(self) -> None:
+        self.vocabulary: dict[str, int] = {}
+
+    def embed_query(self, text: str) -> list[float]:
+        words = re.findall(r"\w+", text.lower())
+        for word in words:
+            self.vocabulary.setdefault(word, len(self.vocabulary))
+        vector = [0.0] * 64
+        for word in words:
+            vector[self.vocabulary[word]] += 1.0
+        return vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class RecordingRetriever(BaseRetriever):
+    """Retriever returning one document per query, recording the queries."""
+
+    embedding: Embeddings
+    queries: list[str] = []
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def with_filter(
+        self, metadata_filter: Optional[dict[str, str]]
+    ) -> "RecordingRetriever":
+        return self
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        self.queries.append(query)
+        return [Document(page_content=query)]
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        return self._get_relevant_documents(query, run_manager=run_manager)
+
+
+def create_retrieval(standalone: str) -> HistoryAwareRetrieval:
+    return HistoryAwareRetrieval(
+        RunnableLambda(lambda inputs: standalone),
+        RecordingRetriever(embedding=WordEmbeddings(), queries=[]),
+        mode="speculative",
+        cache_size=16,
+    )
+
+
+def retrieve(
+    retrieval: HistoryAwareRetrieval, question: str, use_async: bool
+) -> list[Document]:
+    inputs = {"question": question, "chat_history": HISTORY}
+    if use_async:
+        return asyncio.run(retrieval.ainvoke(inputs, {}))
+    return retrieval.invoke(inputs, {})
+
+
+def test_speculation_kept_for_reworded_question() -> None:
+    # Flagged for "there" and "also", the LLM drops the "also"
+    question = "Is there also a way to stream the output of an LLMChain?"
+    standalone = "Is there a way to stream the output of an LLMChain?"
+    assert needs_rephrasing(question)
+
+    for use_async in (False, True):
+        retrieval = create_retrieval(standalone)
+        docs = retrieve(retrieval, question, use_async)
+
+        assert [doc.page_content for doc in docs] == [question]
+        assert retrieval.retriever.queries == [question]
+        assert retrieval.stats["speculation_kept"] == 1
+        assert retrieval.stats["speculation_discarded"] == 0
+
+
+def test_speculation_discarded_for_resolved_reference() -> None:
+    question = "How do I install it?"
+    standalone = "How do I install LangChain?"
+
+    for use_async in (False, True):
+        retrieval = create_retrieval(standalone)
+        docs = retrieve(retrieval, question, use_async)
+
+        assert [doc.page_content for doc in docs] == [standalone]
+        assert retrieval.retriever.queries[-1] == standalone
+        assert retrieval.stats["speculation_kept"] == 0
+        assert retrieval.stats["speculation_discarded"] == 1
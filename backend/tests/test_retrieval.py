@@ -0,0 +1,48 @@
+import sqlalchemy as sa
+from core.retrieval import (
+    FILTER_PLAN_CACHE_SIZE,
+    AsyncPGVectorRetriever,
+    FilteredSearchPlan,
+)
+from langchain.embeddings import FakeEmbeddings
+from sqlalchemy.ext.asyncio import create_async_engine
+
+
+def create_retriever() -> AsyncPGVectorRetriever:
+    # Never connected
+    return AsyncPGVectorRetriever(
+        embedding=FakeEmbeddings(size=4),
+        engine=sa.create_engine("postgresql+psycopg2://localhost/test"),
+        async_engine=create_async_engine("postgresql+asyncpg://localhost/test"),
+        collection_name="test",
+        record_manager_namespace="test",
+    )
+
+
+def test_filter_plans_are_shared_and_bounded() -> None:
+    retriever = create_retriever()
+    first = retriever.with_filter({"source": "0"})
+    first._plan(None)
+    assert retriever.with_filter({"source": "0"})._get_cached_plan() == (
+        FilteredSearchPlan()
+    )
+
+    for i in range(1, FILTER_PLAN_CACHE_SIZE + 10):
+        retriever.with_filter({"source": str(i)})._plan(None)
+
+    assert len(retriever._filter_plans) == FILTER_PLAN_CACHE_SIZE
+    # The least recently used
+    assert first._get_cached_plan() is None
+
+
+def test_expired_filter_plans_are_dropped(monkeypatch) -> None:
+    retriever = create_retriever()
+    now = [1_000.0]
+    monkeypatch.setattr("core.retrieval.time.monotonic", lambda: now[0])
+    for i in range(10):
+        retriever.with_filter({"source": str(i)})._plan(None)
+
+    now[0] += 3_600
+    retriever.with_filter({"source": "new"})._plan(None)
+
+    assert len(retriever._filter_plans) == 1
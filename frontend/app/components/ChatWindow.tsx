@@ -12,7 +12,6 @@ import "highlight.js/styles/gradient-dark.css";
 import MyTable from "./MyTable";
 
 import { fetchEventSource } from "@microsoft/fetch-event-source";
-import { applyPatch } from "fast-json-patch";
 
 import "react-toastify/dist/ReactToastify.css";
 import {
@@ -60,7 +59,6 @@ export function ChatWindow(props: {
     setIsLoading(true);
 
     let accumulatedMessage = "";
-    let runId: string | undefined = undefined;
     let sources: Source[] | undefined = undefined;
     let messageIndex: number | null = null;
 
@@ -86,9 +84,7 @@ export function ChatWindow(props: {
     };
     marked.setOptions({ renderer });
     try {
-      const sourceStepName = "FindDocs";
-      let streamedResponse: Record<string, any> = {};
-      await fetchEventSource(apiBaseUrl + "/chat/stream_log", {
+      await fetchEventSource(apiBaseUrl + "/api/v1/chat/stream", {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
@@ -104,7 +100,6 @@ export function ChatWindow(props: {
               conversation_id: conversationId,
             },
           },
-          include_names: [sourceStepName],
         }),
         openWhenHidden: true,
         onerror(err) {
@@ -119,54 +114,38 @@ export function ChatWindow(props: {
             setIsLoading(false);
             return;
           }
-          if (msg.event === "data" && msg.data) {
-            const chunk = JSON.parse(msg.data);
-            streamedResponse = applyPatch(
-              streamedResponse,
-              chunk.ops,
-            ).newDocument;
+          if (msg.event === "error") {
+            throw new Error(JSON.parse(msg.data));
+          }
+          if (msg.event === "sources") {
+            // Sent once retrieved, before the first token of the answer
+            sources = JSON.parse(msg.data);
+          } else if (msg.event === "data" && msg.data) {
+            accumulatedMessage += JSON.parse(msg.data);
+          } else {
+            return;
+          }
+          const parsedResult = marked.parse(accumulatedMessage);
+
+          setMessages((prevMessages) => {
+            let newMessages = [...prevMessages];
             if (
-              Array.isArray(
-                streamedResponse?.logs?.[sourceStepName]?.final_output?.output,
-              )
+              messageIndex === null ||
+              newMessages[messageIndex] === undefined
             ) {
-              sources = streamedResponse.logs[
-                sourceStepName
-              ].final_output.output.map((doc: Record<string, any>) => ({
-                url: doc.metadata.source,
-                title: doc.metadata.title,
-              }));
+              messageIndex = newMessages.length;
+              newMessages.push({
+                id: Math.random().toString(),
+                content: parsedResult.trim(),
+                sources: sources,
+                role: "assistant",
+              });
+            } else if (newMessages[messageIndex] !== undefined) {
+              newMessages[messageIndex].content = parsedResult.trim();
+              newMessages[messageIndex].sources = sources;
             }
-            if (streamedResponse.id !== undefined) {
-              runId = streamedResponse.id;
-            }
-            if (Array.isArray(streamedResponse?.streamed_output)) {
-              accumulatedMessage = streamedResponse.streamed_output.join("");
-            }
-            const parsedResult = marked.parse(accumulatedMessage);
-
-            setMessages((prevMessages) => {
-              let newMessages = [...prevMessages];
-              if (
-                messageIndex === null ||
-                newMessages[messageIndex] === undefined
-              ) {
-                messageIndex = newMessages.length;
-                newMessages.push({
-                  id: Math.random().toString(),
-                  content: parsedResult.trim(),
-                  runId: runId,
-                  sources: sources,
-                  role: "assistant",
-                });
-              } else if (newMessages[messageIndex] !== undefined) {
-                newMessages[messageIndex].content = parsedResult.trim();
-                newMessages[messageIndex].runId = runId;
-                newMessages[messageIndex].sources = sources;
-              }
-              return newMessages;
-            });
-          }
+            return newMessages;
+          });
         },
       });
     } catch (e) {